@@ -9,7 +9,16 @@ from angler.derivatives import unpack_derivs
 from angler.filter import deps_drhob, drhob_drhot
 from angler.constants import *
 
-def adjoint_linear_Ez(simulation, b_aj, averaging=False, solver=DEFAULT_SOLVER, matrix_format=DEFAULT_MATRIX_FORMAT):
+def _solve_transpose(simulation, b_aj, solver=None):
+    # solves A.T x = b_aj, reusing the factors of A from the forward solve
+    # if a different solver is requested explicitly, A.T is factored from scratch
+
+    if solver is None:
+        return simulation.factors.solve(b_aj, transpose=True)
+    return solver_direct(simulation.A.T, b_aj, solver=solver)
+
+
+def adjoint_linear_Ez(simulation, b_aj, averaging=False, solver=None, matrix_format=DEFAULT_MATRIX_FORMAT):
     # Compute the adjoint field for a linear problem
     # Note: the correct definition requires simulating with the transpose matrix A.T
     EPSILON_0_ = EPSILON_0*simulation.L0
@@ -18,15 +27,14 @@ def adjoint_linear_Ez(simulation, b_aj, averaging=False, solver=DEFAULT_SOLVER,
 
     (Nx, Ny) = (simulation.Nx, simulation.Ny)
     M = Nx*Ny
-    A = simulation.A
 
-    ez = solver_direct(A.T, b_aj, solver=solver)
+    ez = _solve_transpose(simulation, b_aj, solver=solver)
     Ez = ez.reshape((Nx, Ny))
 
     return Ez
 
 
-def adjoint_linear_Hz(simulation, b_aj, averaging=False, solver=DEFAULT_SOLVER, matrix_format=DEFAULT_MATRIX_FORMAT):
+def adjoint_linear_Hz(simulation, b_aj, averaging=False, solver=None, matrix_format=DEFAULT_MATRIX_FORMAT):
     # Compute the adjoint field for a linear problem
     # Note: the correct definition requires simulating with the transpose matrix A.T
     EPSILON_0_ = EPSILON_0*simulation.L0
@@ -35,9 +43,8 @@ def adjoint_linear_Hz(simulation, b_aj, averaging=False, solver=DEFAULT_SOLVER,
 
     (Nx, Ny) = (simulation.Nx, simulation.Ny)
     M = Nx*Ny
-    A = simulation.A
 
-    hz = solver_direct(A.T, b_aj, solver=solver)
+    hz = _solve_transpose(simulation, b_aj, solver=solver)
     (Dyb, Dxb, Dxf, Dyf) = unpack_derivs(simulation.derivs) 
     (Dyb_T, Dxb_T, Dxf_T, Dyf_T) = (Dyb.T, Dxb.T, Dxf.T, Dyf.T)
 
@@ -62,7 +69,7 @@ def adjoint_linear_Hz(simulation, b_aj, averaging=False, solver=DEFAULT_SOLVER,
 
 
 def adjoint_kerr_Ez(simulation, b_aj,
-                     averaging=False, solver=DEFAULT_SOLVER, matrix_format=DEFAULT_MATRIX_FORMAT):
+                     averaging=False, solver=None, matrix_format=DEFAULT_MATRIX_FORMAT):
     # Compute the adjoint field for a nonlinear problem
     # Note: written only for Ez!
 
@@ -73,6 +80,17 @@ def adjoint_kerr_Ez(simulation, b_aj,
     (Nx, Ny) = (simulation.Nx, simulation.Ny)
     M = Nx*Ny
 
+    b_aj = b_aj.reshape((-1,))
+
+    # the Jacobian factored by the nonlinear solve (at the converged field) is reused,
+    # the adjoint is then a single transposed solve of its real-equivalent form
+    if solver is None and simulation.jacobian_nl is not None:
+        ez = np.conj(simulation.jacobian_nl.solve(np.conj(b_aj), transpose=True))
+        return ez.reshape((Nx, Ny))
+
+    if solver is None:
+        solver = simulation.solver
+
     Ez = simulation.fields_nl['Ez']
     Anl = simulation.A + simulation.Anl
     dAde = omega**2*EPSILON_0_*simulation.dnl_de
@@ -80,9 +98,9 @@ def adjoint_kerr_Ez(simulation, b_aj,
     C11 = Anl + sp.spdiags((dAde*Ez).reshape((-1,)), 0, M, M, format=matrix_format)
     C12 = sp.spdiags((np.conj(dAde)*Ez).reshape((-1)), 0, M, M, format=matrix_format)
     C_full = sp.vstack((sp.hstack((C11, C12)), np.conj(sp.hstack((C12, C11)))))
-    b_aj = b_aj.reshape((-1,))
 
-    ez = solver_direct(C_full.T, np.vstack((b_aj, np.conj(b_aj))), solver=solver)
+    ez = solver_direct(C_full.T, np.vstack((b_aj, np.conj(b_aj))), solver=solver,
+                       **simulation.solver_options)
 
     if np.linalg.norm(ez[range(M)] - np.conj(ez[range(M, 2*M)])) > 1e-8:
         print('Adjoint field and conjugate do not match; something might be wrong')
@@ -0,0 +1,249 @@
+import numpy as np
+import numpy.linalg as la
+
+from angler.linalg import Complex2RealSystem
+from angler.nonlinear_solvers import nl_eq_and_jac
+from angler.sweep import light_copy
+
+""" CONTINUATION
+
+    Power sweeps of nonlinear simulations.  The source is linear in its amplitude s
+    and the input power W_in scales with s^2, so the mode is set up and normalized
+    only once.  The nonlinear problem
+        f(E, s) = (A + Anl(E)) E - 1j omega s src = 0
+    is then followed in s, each solve starting from the previous solution, and the
+    real-equivalent Jacobian keeps its sparsity pattern (and symbolic factorization)
+    for the whole sweep.
+
+    'natural' continuation steps through the requested amplitudes in order, with a
+    secant predictor and Newton corrector at fixed s.
+
+    'arclength' continuation (pseudo arc-length, Keller) instead parametrizes the branch
+    by its length in (E, s), solving for s together with E.  It follows the branch around
+    the folds where ds/dE changes sign, so the bistable parts of the curve (hysteresis)
+    are traced instead of being jumped over.  Lengths are measured relative to the
+    current point, so a step h changes E and s by about h (relative), like the
+    log-spaced amplitudes of a natural sweep.
+"""
+
+
+class _PowerProblem:
+    """ f(E, s) = 0 for a simulation with source s*src and its Jacobian """
+
+    def __init__(self, simulation):
+
+        if simulation.pol != 'Ez':
+            raise ValueError("power continuation needs the Ez polarization, given {}".format(simulation.pol))
+        if len(simulation.modes) == 0:
+            raise ValueError("need a mode source to scan the power, use simulation.add_mode()")
+
+        # a private copy, with the mode source set up (and normalized) once, at unit amplitude
+        self.simulation = light_copy(simulation)
+        mode = self.simulation.modes[0]
+        mode.scale = 1
+        mode.setup_src(self.simulation)
+        self.src = np.copy(self.simulation.src)
+        self.W_unit = self.simulation.W_in
+
+        self.shape = self.simulation.eps_r.shape
+        self.b = 1j*self.simulation.omega*self.src.reshape((-1,))
+        self.system = None
+
+    def power(self, s):
+        return self.W_unit*s**2
+
+    def linear(self, s):
+        # the linear field at amplitude s
+        E = self.simulation.factors.solve(s*self.b)
+        self.simulation.clear_factors()
+        return np.reshape(E, (-1,))
+
+    def residual(self, E, s):
+        # f(E, s) and factors of the Jacobian df/dE at (E, s)
+
+        self.simulation.src = s*self.src
+        (f, Jac11, Jac12) = nl_eq_and_jac(self.simulation, Ez=E.reshape(self.shape))
+        if self.system is None or not self.system.update(Jac11, Jac12):
+            self.clear()
+            self.system = Complex2RealSystem(Jac11, Jac12, solver=self.simulation.solver,
+                                             **self.simulation.solver_options)
+            self.system.update(Jac11, Jac12)
+        return f
+
+    def solve(self, b):
+        # solves J x = b with the Jacobian of the last call to residual()
+        return self.system.solve(b)
+
+    def fields(self, E, s):
+        # sets the nonlinear fields of the simulation for the solution E at amplitude s
+
+        sim = self.simulation
+        sim.src = s*self.src
+        sim.compute_nl(E.reshape(self.shape))
+        (Hx, Hy, Ez) = sim._fields_from_X(E, sim.eps_r + sim.eps_nl)
+        sim.fields_nl['Hx'] = Hx
+        sim.fields_nl['Hy'] = Hy
+        sim.fields_nl['Ez'] = Ez
+        return sim
+
+    def clear(self):
+        if self.system is not None:
+            self.system.clear()
+        self.system = None
+
+
+def _newton(problem, E, s, conv_threshold, max_num_iter):
+    # solves f(E, s) = 0 for E at fixed s, returns E, convergence and number of iterations
+
+    convergence = np.inf
+    for istep in range(max_num_iter):
+        f = problem.residual(E, s)
+        dE = problem.solve(f)
+        E = E - dE
+        convergence = la.norm(dE)/la.norm(E)
+        if convergence < conv_threshold:
+            break
+    return E, convergence, istep + 1
+
+
+def _newton_arclength(problem, E_pred, s_pred, tangent, weights, conv_threshold, max_num_iter):
+    # solves f(E, s) = 0 together with <tangent, (E, s) - (E_pred, s_pred)> = 0
+    # by bordering: with J z1 = f and J z2 = df/ds, dE = -z1 - ds z2
+
+    (tE, ts) = tangent
+    (wE, ws) = weights
+    df_ds = -problem.b
+
+    (E, s) = (E_pred, s_pred)
+    convergence = np.inf
+    for istep in range(max_num_iter):
+        f = problem.residual(E, s)
+        z1 = problem.solve(f)
+        z2 = problem.solve(df_ds)
+        N = wE*np.real(np.vdot(tE, E - E_pred)) + ws*ts*(s - s_pred)
+        ds = (wE*np.real(np.vdot(tE, z1)) - N)/(ws*ts - wE*np.real(np.vdot(tE, z2)))
+        dE = -z1 - ds*z2
+        E = E + dE
+        s = s + ds
+        convergence = max(la.norm(dE)/la.norm(E), abs(ds/s))
+        if convergence < conv_threshold:
+            break
+    return E, s, convergence, istep + 1
+
+
+def _normalize(tE, ts, weights):
+    # scales the tangent to unit length in the weighted norm
+    (wE, ws) = weights
+    norm = np.sqrt(wE*np.real(np.vdot(tE, tE)) + ws*ts**2)
+    return (tE/norm, ts/norm)
+
+
+def _weights(E, s):
+    # relative lengths around the point (E, s)
+    return (1/np.real(np.vdot(E, E)), 1/s**2)
+
+
+def power_sweep(simulation, s_list, probes, method='natural', conv_threshold=1e-10,
+                max_num_iter=20, max_steps=None, pbar=None):
+    """ Computes the nonlinear transmission of a simulation as a function of the
+        amplitude of its (first) mode source.
+        probes is a list of functions of the simulation giving the power out of each port
+        (using the nonlinear fields, nl=True).
+        method='natural' solves at each amplitude of s_list, in order.
+        method='arclength' traces the branch from s_list[0] to s_list[-1] in steps of
+        about the spacing of s_list (adaptively refined), following folds.
+        The simulation passed in is not modified.
+        Returns (scales, powers, transmissions) with the amplitude, input power and a list
+        of the transmissions (probe / input power) for each probe at each point.
+    """
+
+    if method not in ('natural', 'arclength'):
+        raise ValueError("method must be one of {{'natural', 'arclength'}}, given {}".format(method))
+
+    s_list = np.asarray(s_list, dtype=float)
+    if s_list.size < 2 or np.any(s_list <= 0) or np.any(np.diff(s_list) <= 0):
+        raise ValueError("s_list must have at least two positive, increasing amplitudes")
+
+    problem = _PowerProblem(simulation)
+    scales = []
+    transmissions = [[] for _ in probes]
+
+    def _record(E, s, convergence):
+        if convergence > conv_threshold:
+            print("the simulation did not converge at s={}, reached {}".format(s, convergence))
+        sim = problem.fields(E, s)
+        scales.append(s)
+        for probe_index, probe in enumerate(probes):
+            transmissions[probe_index].append(probe(sim) / problem.power(s))
+
+    # first point, from the linear field
+    (E, convergence, _) = _newton(problem, problem.linear(s_list[0]), s_list[0],
+                                  conv_threshold, max_num_iter)
+    _record(E, s_list[0], convergence)
+
+    if method == 'natural':
+        (E_prev, s_prev) = (None, None)
+        for i, s in enumerate(s_list[1:]):
+            # secant predictor (scaling the linear field for the first step)
+            if E_prev is None:
+                E_start = E*s/scales[-1]
+            else:
+                E_start = E + (s - scales[-1])/(scales[-1] - s_prev)*(E - E_prev)
+            (E_prev, s_prev) = (E, scales[-1])
+            (E, convergence, _) = _newton(problem, E_start, s, conv_threshold, max_num_iter)
+            _record(E, s, convergence)
+            if pbar is not None:
+                pbar.update(i + 2)
+
+    else:
+        s_max = s_list[-1]
+        h_max = np.max(np.log(s_list[1:]/s_list[:-1]))
+        h_min = h_max/1e3
+        h = h_max
+        if max_steps is None:
+            max_steps = 20*s_list.size
+
+        # initial tangent: J dE/ds = -df/ds, increasing s
+        s = s_list[0]
+        problem.residual(E, s)
+        tangent = _normalize(problem.solve(problem.b), 1.0, _weights(E, s))
+
+        progress = 0
+        for _ in range(max_steps):
+            weights = _weights(E, s)
+            E_pred = E + h*tangent[0]
+            s_pred = s + h*tangent[1]
+            (E_new, s_new, convergence, num_iter) = _newton_arclength(problem, E_pred, s_pred, tangent, weights,
+                                                                      conv_threshold, max_num_iter)
+
+            if convergence > conv_threshold or s_new <= 0:
+                # retry with a shorter step
+                h = h/2
+                if h < h_min:
+                    print("the continuation stopped at s={}, the step became too small".format(s))
+                    break
+                continue
+
+            if s_new >= s_max:
+                # last point, exactly at s_max, from the secant through the step
+                E_end = E + (s_max - s)/(s_new - s)*(E_new - E)
+                (E, convergence, _) = _newton(problem, E_end, s_max, conv_threshold, max_num_iter)
+                _record(E, s_max, convergence)
+                break
+
+            tangent = _normalize(E_new - E, s_new - s, _weights(E_new, s_new))
+            (E, s) = (E_new, s_new)
+            _record(E, s, convergence)
+
+            if num_iter <= 4:
+                h = min(1.5*h, h_max)
+
+            if pbar is not None:
+                progress = max(progress, int(s_list.size*np.log(s/s_list[0])/np.log(s_max/s_list[0])))
+                pbar.update(progress)
+        else:
+            print("the continuation stopped at s={} after {} steps".format(s, max_steps))
+
+    problem.clear()
+    scales = np.array(scales)
+    return scales, problem.power(scales), transmissions
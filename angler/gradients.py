@@ -11,210 +11,159 @@ from angler.linalg import grid_average
 
 """ This is where the gradients are defined
     These are selected when you define an objective function
-"""
-
-def grad_linear_Ez(optimization, dJ, Ez, args):
-    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
 
-    b_aj = -dJ(*args)
-    Ez_aj = adjoint_linear_Ez(optimization.simulation, b_aj)
+    The gradient of each argument of J is an adjoint source (adjoint_source), mapping the partial
+    derivative with respect to a field component to a source for the solved component (Ez or Hz),
+    followed by an adjoint solve and the sensitivity.  The adjoint problem is linear in its source,
+    so Optimization.compute_dJ sums the sources of all the linear (and of all the nonlinear)
+    arguments and calls grad_linear (grad_kerr) once.
+"""
 
-    EPSILON_0_ = EPSILON_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-    dAdeps = optimization.design_region*omega**2*EPSILON_0_
+def filter_terms(optimization):
+    """ (eps_m - 1) * drhob/drhot at the current density, the diagonal part of deps/drho
+        (shared by all gradient terms while Optimization.compute_dJ stores it) """
 
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
+    stored = getattr(optimization, '_filter_terms', None)
+    if stored is not None:
+        return stored
 
-    filt_mat = drhot_drho(optimization.W)
+    rho_t = rho2rhot(optimization.simulation.rho, optimization.W)
     proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
+    return (optimization.eps_m - 1)*proj_mat
 
-    Ez_vec = np.reshape(Ez, (-1,))
-
-    dAdeps_vec = np.reshape(dAdeps, (-1,))
-    dfdrho = eps_mat*filt_mat.multiply(Ez_vec*proj_mat*dAdeps_vec)
-    Ez_aj_vec = np.reshape(Ez_aj, (-1,))
-    sensitivity_vec = dfdrho.dot(Ez_aj_vec)        
+def sensitivity(optimization, dfdeps):
+    """ gradient with respect to rho from the gradient with respect to eps (dA/deps * E * E_aj per cell).
+        vector-jacobian product through the projection and filter, deps/drho = diag(terms) W,
+        so no N x N matrix is formed """
 
-    return 1*np.real(np.reshape(sensitivity_vec, rho.shape))
+    rho = optimization.simulation.rho
+    dfdrhot = filter_terms(optimization)*np.reshape(dfdeps, (-1,))
+    return np.real(np.reshape(drhot_drho(optimization.W).T.dot(dfdrhot), rho.shape))
 
-def grad_linear_Hx(optimization, dJ, Ez, args):
-    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
+def _T_eps_inv(simulation, averaging=False):
+    # 1/(eps_0 eps_r) on the x and y grids, for the Hz polarization
 
-    # get the adjoint Ez corresponding to Hx
-    Dyb = optimization.simulation.derivs['Dyb']
-    partial = -dJ(*args)
-    partial_vec = partial.reshape((-1,))
+    EPSILON_0_ = EPSILON_0*simulation.L0
+    eps_tot = simulation.eps_r
+    M = eps_tot.size
 
-    MU_0_ = MU_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
+    if averaging:
+        vector_eps_x = grid_average(EPSILON_0_*(eps_tot), 'x').reshape((-1,))
+        vector_eps_y = grid_average(EPSILON_0_*(eps_tot), 'y').reshape((-1,))
+    else:
+        vector_eps_x = EPSILON_0_*(eps_tot).reshape((-1,))
+        vector_eps_y = EPSILON_0_*(eps_tot).reshape((-1,))
 
-    b_aj_vec = -1/1j/omega/MU_0_ * Dyb.T.dot(partial_vec)
-    b_aj = b_aj_vec.reshape(Ez.shape)
+    T_eps_x_inv = sp.spdiags(1/vector_eps_x, 0, M, M,
+                          format=DEFAULT_MATRIX_FORMAT)
+    T_eps_y_inv = sp.spdiags(1/vector_eps_y, 0, M, M,
+                          format=DEFAULT_MATRIX_FORMAT)
+    return (T_eps_x_inv, T_eps_y_inv)
 
-    # rest is the same
-    Ez_aj = adjoint_linear_Ez(optimization.simulation, b_aj)
+def adjoint_source(optimization, component, partial, averaging=False):
+    """ adjoint source for the solved field (Ez or Hz) of the partial derivative (-dJ/dF)
+        of the objective with respect to the field component F """
 
-    EPSILON_0_ = EPSILON_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-    dAdeps = optimization.design_region*omega**2*EPSILON_0_
+    simulation = optimization.simulation
+    MU_0_ = MU_0*simulation.L0
+    omega = simulation.omega
+    partial_vec = np.reshape(partial, (-1,))
 
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
+    if component in ('Ez', 'Hz'):
+        return partial
 
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
+    elif component == 'Hx':
+        Dyb = simulation.derivs['Dyb']
+        b_aj_vec = -1/1j/omega/MU_0_ * Dyb.T.dot(partial_vec)
 
-    Ez_vec = np.reshape(Ez, (-1,))
+    elif component == 'Hy':
+        Dxb = simulation.derivs['Dxb']
+        b_aj_vec = 1/1j/omega/MU_0_ * Dxb.T.dot(partial_vec)
 
-    dAdeps_vec = np.reshape(dAdeps, (-1,))
-    dfdrho = eps_mat*filt_mat.multiply(Ez_vec*proj_mat*dAdeps_vec)
-    Ez_aj_vec = np.reshape(Ez_aj, (-1,))
-    sensitivity_vec = dfdrho.dot(Ez_aj_vec)        
+    elif component == 'Ex':
+        Dyb = simulation.derivs['Dyf']
+        (_, T_eps_y_inv) = _T_eps_inv(simulation, averaging=averaging)
+        b_aj_vec = 1/1j/omega * T_eps_y_inv.dot(Dyb.T).dot(partial_vec)
 
-    return 1*np.real(np.reshape(sensitivity_vec, rho.shape))
+    elif component == 'Ey':
+        Dxb = simulation.derivs['Dxf']
+        (T_eps_x_inv, _) = _T_eps_inv(simulation, averaging=averaging)
+        b_aj_vec = -1/1j/omega * T_eps_x_inv.dot(Dxb.T).dot(partial_vec)
 
-def grad_linear_Hy(optimization, dJ, Ez, args):
-    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
+    else:
+        raise ValueError("Invalid field component: {}".format(component))
 
-    # get the adjoint Ez corresponding to Hx
-    Dxb = optimization.simulation.derivs['Dxb']
-    partial = -dJ(*args)
-    partial_vec = partial.reshape((-1,))
+    return b_aj_vec.reshape(np.shape(partial))
 
-    MU_0_ = MU_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
+def grad_linear(optimization, Fz, b_aj, averaging=False):
+    """ gradient of the linear fields for the (summed) adjoint source b_aj of the solved field Fz """
 
-    b_aj_vec = 1/1j/omega/MU_0_ * Dxb.T.dot(partial_vec)
-    b_aj = b_aj_vec.reshape(Ez.shape)
+    if optimization.simulation.pol == 'Hz':
+        return _grad_linear_Hz(optimization, Fz, b_aj, averaging=averaging)
 
-    # rest is the same
     Ez_aj = adjoint_linear_Ez(optimization.simulation, b_aj)
 
     EPSILON_0_ = EPSILON_0*optimization.simulation.L0
     omega = optimization.simulation.omega
     dAdeps = optimization.design_region*omega**2*EPSILON_0_
 
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
-
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
+    return sensitivity(optimization, dAdeps*Fz*Ez_aj)
 
-    Ez_vec = np.reshape(Ez, (-1,))
+def grad_kerr(optimization, Fz_nl, b_aj):
+    """ gradient of the nonlinear fields for the (summed) adjoint source b_aj of the solved field Fz_nl """
 
-    dAdeps_vec = np.reshape(dAdeps, (-1,))
-    dfdrho = eps_mat*filt_mat.multiply(Ez_vec*proj_mat*dAdeps_vec)
-    Ez_aj_vec = np.reshape(Ez_aj, (-1,))
-    sensitivity_vec = dfdrho.dot(Ez_aj_vec)        
+    if optimization.simulation.pol == 'Hz':
+        raise NotImplementedError("need to write gradient for kerr Hz")
 
-    return 1*np.real(np.reshape(sensitivity_vec, rho.shape))
-
-def grad_kerr_Ez(optimization, dJ, Ez_nl, args):
-    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
-
-    b_aj = -dJ(*args)
     Ez_aj = adjoint_kerr_Ez(optimization.simulation, b_aj)
-    optimization.simulation.compute_nl(Ez_nl)
+    optimization.simulation.compute_nl(Fz_nl)
 
     EPSILON_0_ = EPSILON_0*optimization.simulation.L0
     omega = optimization.simulation.omega
     dAdeps = optimization.design_region*omega**2*EPSILON_0_
     dAnldeps = dAdeps + optimization.design_region*omega**2*EPSILON_0_*optimization.simulation.dnl_deps
 
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
-
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
-
-    Ez_vec = np.reshape(Ez_nl, (-1,))
+    return sensitivity(optimization, dAnldeps*Fz_nl*Ez_aj)
 
-    dfdrho = eps_mat*filt_mat.multiply(Ez_vec*proj_mat*np.reshape(dAnldeps, (-1,)))
-    return 1*np.real(np.reshape(dfdrho.dot(np.reshape(Ez_aj, (-1,))), rho.shape))
-
-
-def grad_kerr_Hx(optimization, dJ, Ez_nl, args):
-
-    # get the adjoint source corresponding to Hx
-    Dyb = optimization.simulation.derivs['Dyb']
-    partial = -dJ(*args)
-    partial_vec = partial.reshape((-1,))
-
-    MU_0_ = MU_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
+def grad_linear_Ez(optimization, dJ, Ez, args):
+    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
 
-    b_aj_vec = -1/1j/omega/MU_0_ * Dyb.T.dot(partial_vec)
-    b_aj = b_aj_vec.reshape(Ez.shape)
+    b_aj = adjoint_source(optimization, 'Ez', -dJ(*args))
+    return grad_linear(optimization, Ez, b_aj)
 
-    # everything else is the same
-    Ez_aj = adjoint_kerr_Ez(optimization.simulation, b_aj)
-    optimization.simulation.compute_nl(Ez_nl)
+def grad_linear_Hx(optimization, dJ, Ez, args):
+    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
 
-    EPSILON_0_ = EPSILON_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-    dAdeps = optimization.design_region*omega**2*EPSILON_0_
-    dAnldeps = dAdeps + optimization.design_region*omega**2*EPSILON_0_*optimization.simulation.dnl_deps
+    # get the adjoint Ez corresponding to Hx
+    b_aj = adjoint_source(optimization, 'Hx', -dJ(*args))
+    return grad_linear(optimization, Ez, b_aj)
 
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
+def grad_linear_Hy(optimization, dJ, Ez, args):
+    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
 
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
+    # get the adjoint Ez corresponding to Hy
+    b_aj = adjoint_source(optimization, 'Hy', -dJ(*args))
+    return grad_linear(optimization, Ez, b_aj)
 
-    Ez_vec = np.reshape(Ez_nl, (-1,))
+def grad_kerr_Ez(optimization, dJ, Ez_nl, args):
+    """gives the nonlinear field gradient: partial J/ partial * E_nl dE_nl / deps"""
 
-    dfdrho = eps_mat*filt_mat.multiply(Ez_vec*proj_mat*np.reshape(dAnldeps, (-1,)))
-    return 1*np.real(np.reshape(dfdrho.dot(np.reshape(Ez_aj, (-1,))), rho.shape))
+    b_aj = adjoint_source(optimization, 'Ez', -dJ(*args))
+    return grad_kerr(optimization, Ez_nl, b_aj)
 
+def grad_kerr_Hx(optimization, dJ, Ez_nl, args):
+    """gives the nonlinear field gradient: partial J/ partial * E_nl dE_nl / deps"""
 
+    # get the adjoint source corresponding to Hx
+    b_aj = adjoint_source(optimization, 'Hx', -dJ(*args))
+    return grad_kerr(optimization, Ez_nl, b_aj)
 
 def grad_kerr_Hy(optimization, dJ, Ez_nl, args):
-    """gives the linear field gradient: partial J/ partial * E_lin dE_lin / deps"""
+    """gives the nonlinear field gradient: partial J/ partial * E_nl dE_nl / deps"""
 
     # get the adjoint source corresponding to Hy
-    Dxb = optimization.simulation.derivs['Dxb']
-    partial = -dJ(*args)
-    partial_vec = partial.reshape((-1,))
-
-    MU_0_ = MU_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-
-    b_aj_vec = 1/1j/omega/MU_0_ * Dxb.T.dot(partial_vec)
-    b_aj = b_aj_vec.reshape(Ez.shape)
-
-    # everything else is the same
-    Ez_aj = adjoint_kerr_Ez(optimization.simulation, b_aj)
-    optimization.simulation.compute_nl(Ez_nl)
-
-    EPSILON_0_ = EPSILON_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-    dAdeps = optimization.design_region*omega**2*EPSILON_0_
-    dAnldeps = dAdeps + optimization.design_region*omega**2*EPSILON_0_*optimization.simulation.dnl_deps
-
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
-
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
-
-    Ez_vec = np.reshape(Ez_nl, (-1,))
-
-    dfdrho = eps_mat*filt_mat.multiply(Ez_vec*proj_mat*np.reshape(dAnldeps, (-1,)))
-    return 1*np.real(np.reshape(dfdrho.dot(np.reshape(Ez_aj, (-1,))), rho.shape))
-
+    b_aj = adjoint_source(optimization, 'Hy', -dJ(*args))
+    return grad_kerr(optimization, Ez_nl, b_aj)
 
 
 
@@ -225,217 +174,58 @@ def grad_kerr_Hy(optimization, dJ, Ez_nl, args):
 ####################################################################################################################################
 
 
-def grad_linear_Hz(optimization, dJ, Hz, args, averaging=False):
+def _grad_linear_Hz(optimization, Hz, b_aj, averaging=False):
 
     EPSILON_0_ = EPSILON_0 * optimization.simulation.L0
-    MU_0_ = MU_0*optimization.simulation.L0
     omega = optimization.simulation.omega
     Dxb = optimization.simulation.derivs['Dxf']
     Dyb = optimization.simulation.derivs['Dyf']
 
-    eps_tot = optimization.simulation.eps_r
-    M = eps_tot.size
-
-    if averaging:
-        eps_x = grid_average(EPSILON_0_*(eps_tot), 'x')
-        vector_eps_x = eps_x.reshape((-1,))
-        eps_y = grid_average(EPSILON_0_*(eps_tot), 'y')
-        vector_eps_y = eps_y.reshape((-1,))
-    else:
-        vector_eps_x = EPSILON_0_*(eps_tot).reshape((-1,))
-        vector_eps_y = EPSILON_0_*(eps_tot).reshape((-1,))
-
-    T_eps_x_inv = sp.spdiags(1/vector_eps_x, 0, M, M,
-                          format=DEFAULT_MATRIX_FORMAT)
-    T_eps_y_inv = sp.spdiags(1/vector_eps_y, 0, M, M,
-                          format=DEFAULT_MATRIX_FORMAT)
+    (T_eps_x_inv, T_eps_y_inv) = _T_eps_inv(optimization.simulation, averaging=averaging)
 
     # get fields
     Hz_vec = np.reshape(Hz, (-1,))
     Ex_vec =  1/1j/omega * T_eps_y_inv.dot(Dyb).dot(Hz_vec)
-    Ey_vec = -1/1j/omega * T_eps_x_inv.dot(Dxb).dot(Hz_vec) 
+    Ey_vec = -1/1j/omega * T_eps_x_inv.dot(Dxb).dot(Hz_vec)
 
     # adjoint
-    # partial = -dJ(*args)
-    # partial_vec = partial.reshape((-1,))
-
-    b_aj = -dJ(*args)
-    (Ex_aj, Ey_aj) = adjoint_linear_Hz(optimization.simulation, b_aj, averaging=averaging)   
-    Ex_aj_vec = np.reshape(Ex_aj, (-1,)).T
-    Ey_aj_vec = np.reshape(Ey_aj, (-1,)).T
-
-    # set up filtering bits
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
-
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
+    (Ex_aj, Ey_aj) = adjoint_linear_Hz(optimization.simulation, b_aj, averaging=averaging)
+    Ex_aj_vec = np.reshape(Ex_aj, (-1,))
+    Ey_aj_vec = np.reshape(Ey_aj, (-1,))
 
     if averaging:
 
         design_region_x = grid_average(optimization.design_region, 'x')
-        dAdeps_x = design_region_x*omega**2*EPSILON_0_            
+        dAdeps_x = design_region_x*omega**2*EPSILON_0_
         design_region_y = grid_average(optimization.design_region, 'y')
         dAdeps_y = design_region_y*omega**2*EPSILON_0_
         dAdeps_vec_x = np.reshape(dAdeps_x, (-1,))
         dAdeps_vec_y = np.reshape(dAdeps_y, (-1,))
-        dfdrho_x = eps_mat*filt_mat.multiply(Ex_vec*proj_mat*dAdeps_vec_x)
-        dfdrho_y = eps_mat*filt_mat.multiply(Ey_vec*proj_mat*dAdeps_vec_x)
-        sensitivity_vec = dfdrho_x.dot(Ex_aj_vec) + dfdrho_y.dot(Ey_aj_vec)    
 
     else:
 
         dAdeps = optimization.design_region*omega**2*EPSILON_0_    # Note: physical constants go here if need be!
-        dAdeps_vec = np.reshape(dAdeps, (-1,))
-        dfdrho_x = eps_mat*filt_mat.multiply(Ex_vec*proj_mat*dAdeps_vec)
-        dfdrho_y = eps_mat*filt_mat.multiply(Ey_vec*proj_mat*dAdeps_vec)
-        sensitivity_vec = dfdrho_x.dot(Ex_aj_vec) + dfdrho_y.dot(Ey_aj_vec)    
+        dAdeps_vec_x = np.reshape(dAdeps, (-1,))
+        dAdeps_vec_y = dAdeps_vec_x
 
-    return 1*np.real(np.reshape(sensitivity_vec, rho.shape))    
+    dfdeps = dAdeps_vec_x*Ex_vec*Ex_aj_vec + dAdeps_vec_y*Ey_vec*Ey_aj_vec
 
-def grad_linear_Ex(optimization, dJ, Hz, args, averaging=False):
-
-    EPSILON_0_ = EPSILON_0 * optimization.simulation.L0
-    MU_0_ = MU_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-    Dxb = optimization.simulation.derivs['Dxf']
-    Dyb = optimization.simulation.derivs['Dyf']
+    return sensitivity(optimization, dfdeps)
 
-    eps_tot = optimization.simulation.eps_r
-    M = eps_tot.size
-
-    if averaging:
-        eps_x = grid_average(EPSILON_0_*(eps_tot), 'x')
-        vector_eps_x = eps_x.reshape((-1,))
-        eps_y = grid_average(EPSILON_0_*(eps_tot), 'y')
-        vector_eps_y = eps_y.reshape((-1,))
-    else:
-        vector_eps_x = EPSILON_0_*(eps_tot).reshape((-1,))
-        vector_eps_y = EPSILON_0_*(eps_tot).reshape((-1,))
-
-    T_eps_x_inv = sp.spdiags(1/vector_eps_x, 0, M, M,
-                          format=DEFAULT_MATRIX_FORMAT)
-    T_eps_y_inv = sp.spdiags(1/vector_eps_y, 0, M, M,
-                          format=DEFAULT_MATRIX_FORMAT)
-
-    # get fields
-    Hz_vec = np.reshape(Hz, (-1,))
-    Ex_vec =  1/1j/omega * T_eps_y_inv.dot(Dyb).dot(Hz_vec)
-    Ey_vec = -1/1j/omega * T_eps_x_inv.dot(Dxb).dot(Hz_vec) 
-
-    partial = -dJ(*args)
-    partial_vec = partial.reshape((-1,))
-
-    b_aj_vec =  1/1j/omega * T_eps_y_inv.dot(Dyb.T).dot(partial_vec)
-    b_aj = b_aj_vec.reshape(Hz.shape)
-
-    (Ex_aj, Ey_aj) = adjoint_linear_Hz(optimization.simulation, b_aj, averaging=averaging)   
-    Ex_aj_vec = np.reshape(Ex_aj, (-1,)).T
-    Ey_aj_vec = np.reshape(Ey_aj, (-1,)).T
-
-    # set up filtering bits
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
-
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
-
-    if averaging:
-
-        design_region_x = grid_average(optimization.design_region, 'x')
-        dAdeps_x = design_region_x*omega**2*EPSILON_0_            
-        design_region_y = grid_average(optimization.design_region, 'y')
-        dAdeps_y = design_region_y*omega**2*EPSILON_0_
-        dAdeps_vec_x = np.reshape(dAdeps_x, (-1,))
-        dAdeps_vec_y = np.reshape(dAdeps_y, (-1,))
-        dfdrho_x = eps_mat*filt_mat.multiply(Ex_vec*proj_mat*dAdeps_vec_x)
-        dfdrho_y = eps_mat*filt_mat.multiply(Ey_vec*proj_mat*dAdeps_vec_x)
-        sensitivity_vec = dfdrho_x.dot(Ex_aj_vec) + dfdrho_y.dot(Ey_aj_vec)    
+def grad_linear_Hz(optimization, dJ, Hz, args, averaging=False):
 
-    else:
+    b_aj = adjoint_source(optimization, 'Hz', -dJ(*args), averaging=averaging)
+    return grad_linear(optimization, Hz, b_aj, averaging=averaging)
 
-        dAdeps = optimization.design_region*omega**2*EPSILON_0_    # Note: physical constants go here if need be!
-        dAdeps_vec = np.reshape(dAdeps, (-1,))
-        dfdrho_x = eps_mat*filt_mat.multiply(Ex_vec*proj_mat*dAdeps_vec)
-        dfdrho_y = eps_mat*filt_mat.multiply(Ey_vec*proj_mat*dAdeps_vec)
-        sensitivity_vec = dfdrho_x.dot(Ex_aj_vec) + dfdrho_y.dot(Ey_aj_vec)    
+def grad_linear_Ex(optimization, dJ, Hz, args, averaging=False):
 
-    return 1*np.real(np.reshape(sensitivity_vec, rho.shape)) 
+    b_aj = adjoint_source(optimization, 'Ex', -dJ(*args), averaging=averaging)
+    return grad_linear(optimization, Hz, b_aj, averaging=averaging)
 
 def grad_linear_Ey(optimization, dJ, Hz, args, averaging=False):
 
-    EPSILON_0_ = EPSILON_0 * optimization.simulation.L0
-    MU_0_ = MU_0*optimization.simulation.L0
-    omega = optimization.simulation.omega
-    Dxb = optimization.simulation.derivs['Dxf']
-    Dyb = optimization.simulation.derivs['Dyf']
-
-    eps_tot = optimization.simulation.eps_r
-    M = eps_tot.size
-
-    if averaging:
-        eps_x = grid_average(EPSILON_0_*(eps_tot), 'x')
-        vector_eps_x = eps_x.reshape((-1,))
-        eps_y = grid_average(EPSILON_0_*(eps_tot), 'y')
-        vector_eps_y = eps_y.reshape((-1,))
-    else:
-        vector_eps_x = EPSILON_0_*(eps_tot).reshape((-1,))
-        vector_eps_y = EPSILON_0_*(eps_tot).reshape((-1,))
-
-    T_eps_x_inv = sp.spdiags(1/vector_eps_x, 0, M, M,
-                          format=DEFAULT_MATRIX_FORMAT)
-    T_eps_y_inv = sp.spdiags(1/vector_eps_y, 0, M, M,
-                          format=DEFAULT_MATRIX_FORMAT)
-
-    # get fields
-    Hz_vec = np.reshape(Hz, (-1,))
-    Ex_vec =  1/1j/omega * T_eps_y_inv.dot(Dyb).dot(Hz_vec)
-    Ey_vec = -1/1j/omega * T_eps_x_inv.dot(Dxb).dot(Hz_vec) 
-
-    partial = -dJ(*args)
-    partial_vec = partial.reshape((-1,))
-
-    b_aj_vec = -1/1j/omega * T_eps_x_inv.dot(Dxb.T).dot(partial_vec)
-    b_aj = b_aj_vec.reshape(Hz.shape)
-
-    (Ex_aj, Ey_aj) = adjoint_linear_Hz(optimization.simulation, b_aj, averaging=averaging)   
-    Ex_aj_vec = np.reshape(Ex_aj, (-1,)).T
-    Ey_aj_vec = np.reshape(Ey_aj, (-1,)).T
-
-    # set up filtering bits
-    rho = optimization.simulation.rho
-    rho_t = rho2rhot(rho, optimization.W)
-    rho_b = rhot2rhob(rho_t, eta=optimization.eta, beta=optimization.beta)
-    eps_mat = (optimization.eps_m - 1)
-
-    filt_mat = drhot_drho(optimization.W)
-    proj_mat = drhob_drhot(rho_t, eta=optimization.eta, beta=optimization.beta)
-
-    if averaging:
-
-        design_region_x = grid_average(optimization.design_region, 'x')
-        dAdeps_x = design_region_x*omega**2*EPSILON_0_            
-        design_region_y = grid_average(optimization.design_region, 'y')
-        dAdeps_y = design_region_y*omega**2*EPSILON_0_
-        dAdeps_vec_x = np.reshape(dAdeps_x, (-1,))
-        dAdeps_vec_y = np.reshape(dAdeps_y, (-1,))
-        dfdrho_x = eps_mat*filt_mat.multiply(Ex_vec*proj_mat*dAdeps_vec_x)
-        dfdrho_y = eps_mat*filt_mat.multiply(Ey_vec*proj_mat*dAdeps_vec_x)
-        sensitivity_vec = dfdrho_x.dot(Ex_aj_vec) + dfdrho_y.dot(Ey_aj_vec)    
-
-    else:
-
-        dAdeps = optimization.design_region*omega**2*EPSILON_0_    # Note: physical constants go here if need be!
-        dAdeps_vec = np.reshape(dAdeps, (-1,))
-        dfdrho_x = eps_mat*filt_mat.multiply(Ex_vec*proj_mat*dAdeps_vec)
-        dfdrho_y = eps_mat*filt_mat.multiply(Ey_vec*proj_mat*dAdeps_vec)
-        sensitivity_vec = dfdrho_x.dot(Ex_aj_vec) + dfdrho_y.dot(Ey_aj_vec)    
-
-    return 1*np.real(np.reshape(sensitivity_vec, rho.shape))
+    b_aj = adjoint_source(optimization, 'Ey', -dJ(*args), averaging=averaging)
+    return grad_linear(optimization, Hz, b_aj, averaging=averaging)
 
 def grad_kerr_Hz(optimization, dJ, Ez_nl, args):
     raise NotImplementedError("need to write gradient for kerr Hz")
@@ -445,4 +235,3 @@ def grad_kerr_Ex(optimization, dJ, Ez_nl, args):
 
 def grad_kerr_Ey(optimization, dJ, Ez_nl, args):
     raise NotImplementedError("need to write gradient for kerr Ey")
-
@@ -8,12 +8,26 @@ try:
 except:
     SOLVER = 'scipy'
 
+try:
+    import scikits.umfpack as umfpack
+    HAS_UMFPACK = True
+except:
+    HAS_UMFPACK = False
+
+try:
+    import psutil
+except:
+    psutil = None
+
+import os
 from time import time
+from inspect import signature
+from collections import OrderedDict
 
 from angler.constants import DEFAULT_MATRIX_FORMAT, DEFAULT_SOLVER
 from angler.constants import EPSILON_0, MU_0
 from angler.pml import S_create
-from angler.derivatives import createDws
+from angler.derivatives import createDws, unpack_derivs
 
 
 def grid_average(center_array, w):
@@ -42,6 +56,49 @@ def is_equal(matrix1, matrix2):
     return (matrix1 != matrix2).nnz == 0
 
 
+# PML and derivative operators of the grids used so far (at most OPERATOR_CACHE_SIZE of each)
+_operator_cache = OrderedDict()
+OPERATOR_CACHE_SIZE = 4
+
+
+def _cached(key, create):
+    # returns the cached value for key, or creates it, evicting the least recently used
+    if key in _operator_cache:
+        _operator_cache.move_to_end(key)
+        return _operator_cache[key]
+    value = create()
+    _operator_cache[key] = value
+    if len(_operator_cache) > OPERATOR_CACHE_SIZE:
+        _operator_cache.popitem(last=False)
+    return value
+
+
+def unstretched_derivs(N, xrange, yrange, matrix_format=DEFAULT_MATRIX_FORMAT):
+    # (Dxf, Dxb, Dyf, Dyb) without the PML, memoized by grid
+    # NOTE: the operators are shared, they must not be modified in place
+
+    N = np.asarray(N)
+    dl = dL(N, xrange, yrange)
+    key = ('D', tuple(N), tuple(dl), matrix_format)
+    return _cached(key, lambda: tuple(createDws(w, s, dl, N, matrix_format=matrix_format)
+                                      for (w, s) in (('x', 'f'), ('x', 'b'), ('y', 'f'), ('y', 'b'))))
+
+
+def create_operators(omega, L0, N, NPML, xrange, yrange, matrix_format=DEFAULT_MATRIX_FORMAT):
+    # (Sxf, Sxb, Syf, Syb, Dxf, Dxb, Dyf, Dyb) with the PML at omega, memoized by (omega, N, NPML, dl, L0)
+    # NOTE: the operators are shared, they must not be modified in place
+
+    N = np.asarray(N)
+    key = ('S', omega, tuple(N), tuple(NPML), tuple(dL(N, xrange, yrange)), L0, matrix_format)
+
+    def _create():
+        (Sxf, Sxb, Syf, Syb) = S_create(omega, L0, N, NPML, xrange, yrange, matrix_format=matrix_format)
+        (Dxf, Dxb, Dyf, Dyb) = unstretched_derivs(N, xrange, yrange, matrix_format=matrix_format)
+        return (Sxf, Sxb, Syf, Syb, Sxf.dot(Dxf), Sxb.dot(Dxb), Syf.dot(Dyf), Syb.dot(Dyb))
+
+    return _cached(key, _create)
+
+
 def construct_A(omega, xrange, yrange, eps_r, NPML, pol, L0,
                 averaging=True,
                 timing=False,
@@ -57,13 +114,9 @@ def construct_A(omega, xrange, yrange, eps_r, NPML, pol, L0,
         vector_eps_z = EPSILON_0_*eps_r.reshape((-1,))
         T_eps_z = sp.spdiags(vector_eps_z, 0, M, M, format=matrix_format)
 
-        (Sxf, Sxb, Syf, Syb) = S_create(omega, L0, N, NPML, xrange, yrange, matrix_format=matrix_format)
-
-        # Construct derivate matrices
-        Dyb = Syb.dot(createDws('y', 'b', dL(N, xrange, yrange), N, matrix_format=matrix_format))
-        Dxb = Sxb.dot(createDws('x', 'b', dL(N, xrange, yrange), N, matrix_format=matrix_format))
-        Dxf = Sxf.dot(createDws('x', 'f', dL(N, xrange, yrange), N, matrix_format=matrix_format))
-        Dyf = Syf.dot(createDws('y', 'f', dL(N, xrange, yrange), N, matrix_format=matrix_format))
+        # derivative matrices with the PML
+        (_, _, _, _, Dxf, Dxb, Dyf, Dyb) = create_operators(omega, L0, N, NPML, xrange, yrange,
+                                                             matrix_format=matrix_format)
 
         A = (Dxf*1/MU_0_).dot(Dxb) \
             + (Dyf*1/MU_0_).dot(Dyb) \
@@ -83,13 +136,9 @@ def construct_A(omega, xrange, yrange, eps_r, NPML, pol, L0,
         T_eps_x_inv = sp.spdiags(1/vector_eps_x, 0, M, M, format=matrix_format)
         T_eps_y_inv = sp.spdiags(1/vector_eps_y, 0, M, M, format=matrix_format)
 
-        (Sxf, Sxb, Syf, Syb) = S_create(omega, L0, N, NPML, xrange, yrange, matrix_format=matrix_format)
-
-        # Construct derivate matrices
-        Dyb = Syb.dot(createDws('y', 'b', dL(N, xrange, yrange), N, matrix_format=matrix_format))
-        Dxb = Sxb.dot(createDws('x', 'b', dL(N, xrange, yrange), N, matrix_format=matrix_format))
-        Dxf = Sxf.dot(createDws('x', 'f', dL(N, xrange, yrange), N, matrix_format=matrix_format))
-        Dyf = Syf.dot(createDws('y', 'f', dL(N, xrange, yrange), N, matrix_format=matrix_format))
+        # derivative matrices with the PML
+        (_, _, _, _, Dxf, Dxb, Dyf, Dyb) = create_operators(omega, L0, N, NPML, xrange, yrange,
+                                                             matrix_format=matrix_format)
 
         A =   Dxf.dot(T_eps_x_inv).dot(Dxb) \
             + Dyf.dot(T_eps_y_inv).dot(Dyb) \
@@ -108,6 +157,224 @@ def construct_A(omega, xrange, yrange, eps_r, NPML, pol, L0,
     return (A, derivs)
 
 
+def _triple_product_entries(Dl, Dr):
+    # entries of Dl.diag(v).Dr as (row, col, k, coef) with value sum_k coef*v[k]
+    Dl = Dl.tocsc()
+    Dr = Dr.tocsr()
+    M = Dl.shape[1]
+    kl = np.repeat(np.arange(M), np.diff(Dl.indptr))
+    reps = np.diff(Dr.indptr)[kl]
+    il = np.repeat(np.arange(Dl.nnz), reps)
+    offsets = np.arange(il.size) - np.repeat(np.cumsum(reps) - reps, reps)
+    ir = np.repeat(Dr.indptr[kl], reps) + offsets
+    rows = Dl.indices[il].astype(np.int64)
+    cols = Dr.indices[ir].astype(np.int64)
+    return (rows, cols, kl[il], Dl.data[il]*Dr.data[ir])
+
+
+class _RowScaled:
+    # diag(s).D applied to vectors, without forming the product
+
+    def __init__(self, s, D):
+        self.s = s
+        self.D = D
+
+    def dot(self, x):
+        return self.s*self.D.dot(x)
+
+
+class SystemMatrix:
+    """ Sparsity pattern and omega/grid/PML dependent part of the system matrix.
+
+        The entries of A are affine in the permittivity (eps_r for Ez,
+        1/eps_r on the edges for Hz), so A.data = base + G.dot(params).
+        Changing eps_r only recomputes A.data and never rebuilds the operators.
+        The pattern and the (unstretched) derivative products dont depend on omega
+        either, so set_omega() only recomputes the PML stretching and base, G.
+    """
+
+    def __init__(self, omega, xrange, yrange, shape, NPML, pol, L0, averaging=True):
+
+        if pol not in ('Ez', 'Hz'):
+            raise ValueError("something went wrong and pol is not one of Ez, Hz, instead was given {}".format(pol))
+
+        N = np.asarray(shape)
+        M = int(np.prod(N))
+
+        self.key = (tuple(xrange), tuple(yrange), tuple(shape), tuple(NPML), pol, L0, averaging)
+        self.xrange = xrange
+        self.yrange = yrange
+        self.shape = tuple(shape)
+        self.NPML = NPML
+        self.pol = pol
+        self.L0 = L0
+        self.averaging = averaging
+        self.M = M
+
+        # derivative operators without the PML
+        (Dxf, Dxb, Dyf, Dyb) = unstretched_derivs(N, xrange, yrange, matrix_format='csr')
+        self._D0 = {'Dyb' : Dyb, 'Dxb' : Dxb, 'Dxf' : Dxf, 'Dyf' : Dyf}
+
+        # entries of Dxf.T.Dxb and Dyf.T.Dyb, the PML stretching only rescales them
+        (xr, xc, xk, xv) = _triple_product_entries(self._D0['Dxf'], self._D0['Dxb'])
+        (yr, yc, yk, yv) = _triple_product_entries(self._D0['Dyf'], self._D0['Dyb'])
+        self._x_entries = (xr, xk)
+        self._y_entries = (yr, yk)
+        self._coef = np.concatenate((xv, yv))
+        self._k = np.concatenate((xk, yk + (M if pol == 'Hz' else 0)))
+
+        # the union with the diagonal, in canonical (sorted) CSR order
+        diag = np.arange(M, dtype=np.int64)
+        keys = np.concatenate((xr*M + xc, yr*M + yc, diag*M + diag))
+        (unique_keys, position) = np.unique(keys, return_inverse=True)
+        position = position.reshape((-1,))
+        self.indices = (unique_keys % M).astype(np.int32)
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(unique_keys // M, minlength=M)))).astype(np.int32)
+        self.nnz = unique_keys.size
+        self._pos_lap = position[:-M]
+        self._pos_diag = position[-M:]
+
+        # the PML factors are S = 1/(1 - q/omega), with q = 1j sigma/eps_0 independent of omega
+        self._pml_q = [(1 - 1/S.diagonal())*omega for S in self._S_create(omega)]
+
+        self.set_omega(omega)
+
+    def set_omega(self, omega):
+        # recomputes the PML stretched operators and the omega dependent values
+
+        M = self.M
+        self.omega = omega
+
+        self.derivs = self.stretched_derivs(omega)
+        stretch = self._stretch(omega)
+
+        diag = np.arange(M, dtype=np.int64)
+        if self.pol == 'Ez':
+            # laplacian is fixed, the omega**2*T_eps diagonal is parameterized by eps_r
+            (pos_const, const) = (self._pos_lap, stretch/(MU_0*self.L0))
+            (pos_param, param_index, param) = (self._pos_diag, diag, omega**2*EPSILON_0*self.L0*np.ones(M))
+            self.num_params = M
+        else:
+            # Dxf.T_eps_x_inv.Dxb + Dyf.T_eps_y_inv.Dyb is parameterized by 1/eps on the edges
+            (pos_const, const) = (self._pos_diag, omega**2*MU_0*self.L0*np.ones(M))
+            (pos_param, param_index, param) = (self._pos_lap, self._k, stretch)
+            self.num_params = 2*M
+
+        self.base = sp.csr_matrix((const, (pos_const, np.zeros(pos_const.size, dtype=np.int64))),
+                                  shape=(self.nnz, 1), dtype=np.complex128).toarray().reshape((-1,))
+        self.G = sp.csr_matrix((param, (pos_param, param_index)),
+                               shape=(self.nnz, self.num_params), dtype=np.complex128)
+
+    def _stretch(self, omega, derivative=False):
+        # PML stretching of the laplacian entries, or its derivative with respect to omega
+
+        (Sxf, Sxb, Syf, Syb) = self._stretch_factors(omega)
+        ((xr, xk), (yr, yk)) = (self._x_entries, self._y_entries)
+        if not derivative:
+            return np.concatenate((Sxf[xr]*Sxb[xk], Syf[yr]*Syb[yk]))*self._coef
+
+        # the factors are S = 1/(1 - 1j sigma/(omega eps_0)), so dS/domega = S (1 - S) / omega
+        (dSxf, dSxb, dSyf, dSyb) = [S*(1 - S)/omega for S in (Sxf, Sxb, Syf, Syb)]
+        return np.concatenate((dSxf[xr]*Sxb[xk] + Sxf[xr]*dSxb[xk],
+                               dSyf[yr]*Syb[yk] + Syf[yr]*dSyb[yk]))*self._coef
+
+    def _stretch_factors(self, omega):
+        # diagonals of (Sxf, Sxb, Syf, Syb) at omega, without the operator cache
+        return [1/(1 - q/omega) for q in self._pml_q]
+
+    def _assemble(self, omega, eps_r, derivative=False):
+        # values of A (or of dA/domega) at omega for eps_r, without changing the stored values
+
+        M = self.M
+        stretch = self._stretch(omega, derivative=derivative)
+        omega2 = 2*omega if derivative else omega**2
+
+        data = np.zeros(self.nnz, dtype=np.complex128)
+        if self.pol == 'Ez':
+            np.add.at(data, self._pos_lap, stretch/(MU_0*self.L0))
+            np.add.at(data, self._pos_diag, omega2*EPSILON_0*self.L0*eps_r.reshape((-1,)))
+        else:
+            np.add.at(data, self._pos_diag, omega2*MU_0*self.L0*np.ones(M))
+            np.add.at(data, self._pos_lap, stretch*self.params(eps_r)[self._k])
+        return data
+
+    def _csr(self, data, matrix_format):
+        A = sp.csr_matrix((data, self.indices.copy(), self.indptr.copy()), shape=(self.M, self.M))
+        A.has_sorted_indices = True
+        return A.asformat(matrix_format)
+
+    def omega_derivative(self, eps_r, matrix_format=DEFAULT_MATRIX_FORMAT):
+        """ dA/domega at the current omega for eps_r (same sparsity pattern as A) """
+        return self._csr(self._assemble(self.omega, eps_r, derivative=True), matrix_format)
+
+    def build_at(self, omega, eps_r, matrix_format=DEFAULT_MATRIX_FORMAT):
+        """ A at another omega for eps_r, without changing this SystemMatrix or the operator cache """
+        return self._csr(self._assemble(omega, eps_r), matrix_format)
+
+    def dot_at(self, omega, eps_r, x):
+        """ A(omega).dot(x) for eps_r, through the derivative operators (cheaper than building A) """
+
+        x = np.reshape(x, (-1,))
+        (Dyb, Dxb, Dxf, Dyf) = unpack_derivs(self.derivs_at(omega))
+        if self.pol == 'Ez':
+            return ((Dxf.dot(Dxb.dot(x)) + Dyf.dot(Dyb.dot(x)))/(MU_0*self.L0) +
+                    omega**2*EPSILON_0*self.L0*eps_r.reshape((-1,))*x)
+        (eps_x_inv, eps_y_inv) = np.split(self.params(eps_r), 2)
+        return (Dxf.dot(eps_x_inv*Dxb.dot(x)) + Dyf.dot(eps_y_inv*Dyb.dot(x)) +
+                omega**2*MU_0*self.L0*x)
+
+    def derivs_at(self, omega):
+        """ the derivative operators with the PML at omega, for products with vectors only """
+
+        (Sxf, Sxb, Syf, Syb) = self._stretch_factors(omega)
+        D0 = self._D0
+        return {'Dyb' : _RowScaled(Syb, D0['Dyb']), 'Dxb' : _RowScaled(Sxb, D0['Dxb']),
+                'Dxf' : _RowScaled(Sxf, D0['Dxf']), 'Dyf' : _RowScaled(Syf, D0['Dyf'])}
+
+    def _operators(self, omega):
+        return create_operators(omega, self.L0, self.shape, self.NPML, self.xrange, self.yrange, matrix_format='csr')
+
+    def _S_create(self, omega):
+        return self._operators(omega)[:4]
+
+    def stretched_derivs(self, omega):
+        # the derivative operators with the PML at omega (without changing the stored values)
+
+        (_, _, _, _, Dxf, Dxb, Dyf, Dyb) = self._operators(omega)
+        return {'Dyb' : Dyb, 'Dxb' : Dxb, 'Dxf' : Dxf, 'Dyf' : Dyf}
+
+    def matches(self, xrange, yrange, shape, NPML, pol, L0, averaging=True):
+        # whether this pattern can be used for a grid (at any omega)
+        return self.key == (tuple(xrange), tuple(yrange), tuple(shape), tuple(NPML), pol, L0, averaging)
+
+    def params(self, eps_r):
+        # the permittivity dependent values that enter A
+        if self.pol == 'Ez':
+            return eps_r.reshape((-1,))
+        EPSILON_0_ = EPSILON_0*self.L0
+        if self.averaging:
+            vector_eps_x = grid_average(EPSILON_0_*eps_r, 'x').reshape((-1,))
+            vector_eps_y = grid_average(EPSILON_0_*eps_r, 'y').reshape((-1,))
+        else:
+            vector_eps_x = EPSILON_0_*eps_r.reshape((-1,))
+            vector_eps_y = EPSILON_0_*eps_r.reshape((-1,))
+        return np.concatenate((1/vector_eps_x, 1/vector_eps_y))
+
+    def data(self, eps_r):
+        return self.base + self.G.dot(self.params(eps_r))
+
+    def build(self, eps_r, matrix_format=DEFAULT_MATRIX_FORMAT):
+        # makes a new A matrix for eps_r
+        return self._csr(self.data(eps_r), matrix_format)
+
+    def update(self, A, eps_r):
+        # writes the values for eps_r into A (built by self.build()) in place
+        if not sp.isspmatrix_csr(A) or A.nnz != self.nnz:
+            raise ValueError("A does not share the sparsity pattern of this SystemMatrix")
+        A.data[:] = self.data(eps_r)
+        return A
+
+
 def solver_eigs(A, Neigs, guess_value=0, guess_vector=None, timing=False):
     # solves for the eigenmodes of A
 
@@ -120,7 +387,7 @@ def solver_eigs(A, Neigs, guess_value=0, guess_vector=None, timing=False):
     return (values, vectors)
 
 
-def solver_direct(A, b, timing=False, solver=SOLVER):
+def solver_direct(A, b, timing=False, solver=SOLVER, **solver_options):
     # solves linear system of equations
 
     b = b.astype(np.complex128)
@@ -132,56 +399,617 @@ def solver_direct(A, b, timing=False, solver=SOLVER):
     if timing:
         t = time()
 
-    if solver.lower() == 'pardiso':
-        pSolve = pardisoSolver(A, mtype=13) # Matrix is complex unsymmetric due to SC-PML
-        pSolve.factor()
-        x = pSolve.solve(b)
-        pSolve.clear()
+    factors = factorize(A, solver=solver, **solver_options)
+    x = factors.solve(b)
+    factors.clear()
+
+    if timing:
+        print('Linear system solve took {:.2f} seconds'.format(time()-t))
+
+    return x
+
+
+""" LINEAR SOLVER BACKENDS
+
+    Each backend is a Factorization subclass, registered by name in SOLVER_BACKENDS.
+    A backend is constructed with the matrix A and factors it lazily on the first solve.
+    It declares what it can do in 'capabilities':
+        factor:     computes factors that are reused for every solve
+        solve:      solves A x = b
+        transpose:  solves A.T x = b with the same factors (used by the adjoint)
+        refactor:   refactors a matrix with the same sparsity pattern numerically only
+"""
+
+
+class Factorization:
+    """ Base class for the linear solver backends.
+        Holds a reusable factorization of a sparse system matrix A.
+        The factors are computed on the first solve and then serve both
+        A x = b and A.T x = b (adjoint) with back-substitutions only.
+    """
+
+    name = None
+    capabilities = {'factor': True, 'solve': True, 'transpose': True, 'refactor': False}
+
+    def __init__(self, A, **solver_options):
+        # options that a backend doesnt understand are ignored, so that the
+        # same solver_options can be used with solver='auto'
+
+        self.A = A
+        self.solver = self.name
+        self._factors = None
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    @property
+    def dtype(self):
+        return np.complex128 if np.iscomplexobj(self.A.data) else np.float64
+
+    @property
+    def is_factored(self):
+        return self._factors is not None
+
+    def factor(self, timing=False):
+        # computes the factors of A (if they arent already stored)
+
+        if self.is_factored:
+            return
+
+        if timing:
+            t = time()
+
+        self._factor()
+
+        if timing:
+            print('Factorization took {:.2f} seconds'.format(time()-t))
+
+    def refactor(self, A, timing=False):
+        # replaces A by a matrix with the same sparsity pattern
+        # backends that cant reuse their analysis just factor from scratch (lazily)
+
+        if not self.is_factored or not self.capabilities['refactor']:
+            self.clear()
+            self.A = A
+            return
+
+        if timing:
+            t = time()
+
+        self.A = A
+        self._refactor()
+
+        if timing:
+            print('Numerical refactorization took {:.2f} seconds'.format(time()-t))
+
+    def solve(self, b, transpose=False, timing=False):
+        # solves A x = b (or A.T x = b if transpose) using the stored factors
+        # b of shape (M, K) is treated as a block of K right hand sides
+
+        if transpose and not self.capabilities['transpose']:
+            raise ValueError("the '{}' solver cant solve the transposed system".format(self.name))
+
+        b = np.asarray(b).astype(self.dtype)
+        if b.ndim != 2 or b.shape[0] != self.A.shape[0]:
+            b = b.reshape((-1,))
+
+        if not b.any():
+            return np.zeros(b.shape, dtype=self.dtype)
+
+        self.factor(timing=timing)
+
+        if timing:
+            t = time()
+
+        x = self._solve(b, transpose)
+
+        if timing:
+            print('Back-substitution took {:.2f} seconds'.format(time()-t))
+
+        return x
+
+    def clear(self):
+        # releases the factors
+        self._factors = None
+
+    def __getstate__(self):
+        # factors cant be pickled or copied, they are recomputed lazily instead
+        state = self.__dict__.copy()
+        state['_factors'] = None
+        return state
+
+    def _factor(self):
+        raise NotImplementedError
+
+    def _refactor(self):
+        raise NotImplementedError
+
+    def _solve(self, b, transpose):
+        raise NotImplementedError
+
+
+class ScipyFactorization(Factorization):
+    """ SuperLU factorization from scipy (always available)
+        SuperLU cant reuse a symbolic analysis, so a refactor reuses the
+        fill-reducing column ordering of the first factorization instead.
+    """
+
+    name = 'scipy'
+    capabilities = {'factor': True, 'solve': True, 'transpose': True, 'refactor': True}
+
+    def _factor(self):
+        self._factors = spl.splu(self.A.tocsc())
+        # A[:, q] = Pr.T L U with the natural column ordering
+        self._q = np.argsort(self._factors.perm_c)
+        self._permuted = False
+
+    def _refactor(self):
+        # drop the old factors first, so that only one set is in memory
+        self._factors = None
+        self._factors = spl.splu(self.A.tocsc()[:, self._q], permc_spec='NATURAL')
+        self._permuted = True
+
+    def _solve(self, b, transpose):
+        if not self._permuted:
+            return self._factors.solve(b, trans='T' if transpose else 'N')
+        if transpose:
+            return self._factors.solve(b[self._q], trans='T')
+        x = np.empty(b.shape, dtype=np.result_type(b, self._factors.L.dtype))
+        x[self._q] = self._factors.solve(b)
+        return x
+
 
-    elif solver.lower() == 'scipy':
-        x = spl.spsolve(A, b)
+class UmfpackFactorization(Factorization):
+    """ UMFPACK factorization from scikit-umfpack (if installed) """
+
+    name = 'umfpack'
+    capabilities = {'factor': True, 'solve': True, 'transpose': True, 'refactor': True}
+
+    @classmethod
+    def is_available(cls):
+        return HAS_UMFPACK
+
+    def _csc(self):
+        A = self.A.tocsc()
+        A.sort_indices()
+        return A
+
+    def _factor(self):
+        A = self._csc()
+        family = ('z' if self.dtype == np.complex128 else 'd') + ('l' if A.indices.dtype == np.int64 else 'i')
+        self._factors = umfpack.UmfpackContext(family)
+        self._factors.numeric(A)
+        self._A_csc = A
+
+    def _refactor(self):
+        # the symbolic analysis stored in the context is reused by numeric()
+        self._A_csc = self._csc()
+        self._factors.numeric(self._A_csc)
+
+    def _solve(self, b, transpose):
+        # note: UMFPACK_Aat is the plain (not conjugate) transpose
+        system = umfpack.UMFPACK_Aat if transpose else umfpack.UMFPACK_A
+        if b.ndim == 2:
+            return np.stack([self._solve(b[:, i], transpose) for i in range(b.shape[1])], axis=1)
+        return self._factors.solve(system, self._A_csc, b, autoTranspose=False)
+
+    def clear(self):
+        self._factors = None
+        self._A_csc = None
+
+
+class PardisoFactorization(Factorization):
+    """ MKL pardiso factorization from pyMKL (if installed) """
+
+    name = 'pardiso'
+    capabilities = {'factor': True, 'solve': True, 'transpose': True, 'refactor': True}
+
+    @classmethod
+    def is_available(cls):
+        return SOLVER == 'pardiso'
+
+    def _csr(self):
+        A = self.A.tocsr()
+        A.sort_indices()
+        return A
+
+    def _factor(self):
+        # mtype 13 = complex unsymmetric (due to SC-PML), 11 = real unsymmetric
+        mtype = 13 if self.dtype == np.complex128 else 11
+        self._factors = pardisoSolver(self._csr(), mtype=mtype)
+        self._factors.factor()
+
+    def _refactor(self):
+        # phase 22 is the numerical factorization only, reusing the reordering of phase 11
+        self._factors.a[:] = self._csr().data
+        self._factors.run_pardiso(22)
+
+    def _solve(self, b, transpose):
+        # iparm[11] = 2 tells pardiso to solve with the transposed factors
+        if b.ndim == 2:
+            b = np.asfortranarray(b)
+        self._factors.iparm[11] = 2 if transpose else 0
+        x = self._factors.solve(b)
+        self._factors.iparm[11] = 0
+        return x
+
+    def clear(self):
+        # pardiso keeps the factors in MKL memory until cleared
+        if self.is_factored:
+            self._factors.clear()
+        self._factors = None
+
+
+ITERATIVE_METHODS = {
+    'gmres': spl.gmres,
+    'bicgstab': spl.bicgstab,
+    'qmr': spl.qmr
+}
+
+
+def shifted_laplacian(A, mass, shift=1-0.5j):
+    # returns A with its mass term (omega^2*eps for Ez) scaled by a complex shift
+    # this damped operator is much easier to factor approximately than A itself
+
+    M = A.shape[0]
+    return A + sp.spdiags((shift - 1)*np.reshape(mass, (-1,)), 0, M, M, format=DEFAULT_MATRIX_FORMAT)
+
+
+def build_preconditioner(A, preconditioner='ilu', mass=None, shift=1-0.5j,
+                         drop_tol=1e-5, fill_factor=10):
+    # incomplete LU factors used to precondition the iterative solvers
+    # returns an object with a .solve(b, trans) method (or None)
+
+    if preconditioner is None:
+        return None
+
+    elif preconditioner == 'ilu':
+        return spl.spilu(A.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor)
+
+    elif preconditioner == 'shifted_laplacian':
+        if mass is None:
+            raise ValueError("the shifted laplacian preconditioner needs the mass term of A")
+        P = shifted_laplacian(A, mass, shift=shift)
+        return spl.spilu(P.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor)
 
     else:
-        raise ValueError('Invalid solver choice: {}, options are pardiso or scipy'.format(str(solver)))
+        raise ValueError("Invalid preconditioner choice: {}, options are 'ilu', 'shifted_laplacian' or None".format(str(preconditioner)))
+
+
+def tolerance_kwargs(method, tol):
+    # the relative tolerance argument of a scipy iterative method (scipy renamed tol -> rtol)
+    if 'rtol' in signature(method).parameters:
+        return {'rtol': tol}
+    return {'tol': tol}
+
+
+def solver_iterative(A, b, x0=None, method='gmres', precond=None, tol=1e-8,
+                     maxiter=1000, transpose=False, callback=None, timing=False,
+                     restart=50):
+    # solves A x = b (or A.T x = b if transpose) with a preconditioned Krylov method
+    # precond is an (incomplete) factorization of A with a .solve(b, trans) method
+    # restart is the gmres Krylov subspace size (20, the scipy default, can stagnate)
+
+    if method not in ITERATIVE_METHODS:
+        raise ValueError('Invalid iterative method: {}, options are {}'.format(str(method), list(ITERATIVE_METHODS)))
+
+    dtype = np.complex128 if np.iscomplexobj(A.data) or np.iscomplexobj(b) else np.float64
+    b = np.asarray(b).astype(dtype).reshape((-1,))
+
+    if not b.any():
+        return np.zeros(b.shape, dtype=dtype)
+
+    if transpose:
+        A = A.T
+    A = A.tocsr()
+
+    kwargs = {'x0': x0, 'maxiter': maxiter, 'callback': callback}
+    kwargs.update(tolerance_kwargs(ITERATIVE_METHODS[method], tol))
+
+    if precond is not None:
+        # rmatvec (the adjoint of the preconditioner) is only used by qmr
+        if transpose:
+            matvec = lambda r: precond.solve(r.astype(dtype), trans='T')
+            rmatvec = lambda r: np.conj(precond.solve(np.conj(r).astype(dtype), trans='N'))
+        else:
+            matvec = lambda r: precond.solve(r.astype(dtype), trans='N')
+            rmatvec = lambda r: precond.solve(r.astype(dtype), trans='H')
+        Minv = spl.LinearOperator(A.shape, dtype=dtype, matvec=matvec, rmatvec=rmatvec)
+        if method == 'qmr':
+            kwargs['M1'] = Minv
+            kwargs['M2'] = spl.LinearOperator(A.shape, dtype=dtype,
+                                              matvec=lambda r: r, rmatvec=lambda r: r)
+        else:
+            kwargs['M'] = Minv
+
+    if method == 'gmres':
+        kwargs['callback_type'] = 'pr_norm'
+        kwargs['restart'] = restart
 
     if timing:
-        print('Linear system solve took {:.2f} seconds'.format(time()-t))
+        t = time()
+
+    (x, info) = ITERATIVE_METHODS[method](A, b, **kwargs)
+
+    if timing:
+        print('Iterative solve took {:.2f} seconds'.format(time()-t))
+
+    if info > 0:
+        print("the iterative solver did not converge to tol={} in {} iterations".format(tol, info))
+    elif info < 0:
+        raise ValueError('iterative solver ({}) failed with illegal input or breakdown'.format(method))
 
     return x
 
 
-def solver_complex2real(A11, A12, b, timing=False, solver=SOLVER):
+class IterativeSolver(Factorization):
+    """ Solves with a preconditioned Krylov method instead of a factorization.
+        The preconditioner is built once per A and every solve is warm-started
+        from the previous solution (of the same, or a previous, system).
+    """
+
+    name = 'iterative'
+    capabilities = {'factor': False, 'solve': True, 'transpose': True, 'refactor': False}
+
+    def __init__(self, A, method='gmres', preconditioner='ilu', tol=1e-8, maxiter=1000,
+                 mass=None, shift=1-0.5j, drop_tol=1e-5, fill_factor=10, x_prev=None,
+                 restart=50, **solver_options):
+
+        # without a mass term (e.g. for the real-equivalent nonlinear systems)
+        # the shifted laplacian cant be formed, so fall back to plain ILU
+        if preconditioner == 'shifted_laplacian' and (mass is None or np.size(mass) != A.shape[0]):
+            preconditioner = 'ilu'
+
+        super().__init__(A)
+        self.method = method
+        self.preconditioner = preconditioner
+        self.tol = tol
+        self.maxiter = maxiter
+        self.restart = restart
+        self.mass = mass
+        self.shift = shift
+        self.drop_tol = drop_tol
+        self.fill_factor = fill_factor
+        self.num_iters = 0
+
+        # previous solutions of A x = b and A.T x = b, used as starting guesses
+        self.x_prev = {False: None, True: None}
+        if x_prev is not None:
+            self.x_prev.update(x_prev)
+
+    @property
+    def is_factored(self):
+        return self._factors is not None or self.preconditioner is None
+
+    def _factor(self):
+        # builds the preconditioner
+        self._factors = build_preconditioner(self.A, preconditioner=self.preconditioner,
+                                             mass=self.mass, shift=self.shift,
+                                             drop_tol=self.drop_tol, fill_factor=self.fill_factor)
+
+    def solve(self, b, transpose=False, timing=False, matrix=None):
+        # solves A x = b (or A.T x = b if transpose)
+        # if matrix is given, solves that system instead, preconditioned with the factors of A
+        # (used by the nonlinear solvers, where A + Anl is close to A)
+
+        A = self.A if matrix is None else matrix
+        b = np.asarray(b)
+        if b.ndim == 2 and b.shape[0] == A.shape[0]:
+            return np.stack([self.solve(b[:, i], transpose=transpose, timing=timing, matrix=matrix)
+                             for i in range(b.shape[1])], axis=1)
+
+        self.factor(timing=timing)
+
+        iters = [0]
+        def _count(_):
+            iters[0] += 1
+
+        x0 = self.x_prev[transpose]
+        if x0 is not None and x0.size != A.shape[0]:
+            x0 = None
+
+        x = solver_iterative(A, b, x0=x0, method=self.method, precond=self._factors,
+                             tol=self.tol, maxiter=self.maxiter, transpose=transpose,
+                             callback=_count, timing=timing, restart=self.restart)
+
+        self.num_iters = iters[0]
+        if x.any():
+            self.x_prev[transpose] = x
+        return x
+
+
+SOLVER_BACKENDS = OrderedDict()
+
+# fraction of the free memory that the LU factors may use before 'auto' goes iterative
+AUTO_MEMORY_FRACTION = 0.5
+
+# empirical fill of the LU factors for 2D FDFD matrices: nnz(L + U) ~ c * M * log2(M)
+LU_FILL_CONSTANT = 12
+
+
+def register_solver(backend):
+    # adds a Factorization subclass to the registry of linear solvers
+    SOLVER_BACKENDS[backend.name] = backend
+    return backend
+
+
+for _backend in (PardisoFactorization, UmfpackFactorization, ScipyFactorization, IterativeSolver):
+    register_solver(_backend)
+
+
+def available_solvers():
+    # names of the registered backends that can be used on this machine
+    return [name for name, backend in SOLVER_BACKENDS.items() if backend.is_available()]
+
+
+def available_memory():
+    # free memory in bytes (None if it cant be determined)
+
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES')*os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def estimate_lu_memory(A):
+    # rough estimate of the memory (bytes) needed by the LU factors of A
+
+    M = A.shape[0]
+    nnz_factors = LU_FILL_CONSTANT*M*np.log2(max(M, 2))
+    bytes_per_entry = np.dtype(A.dtype).itemsize + 4     # value and (int32) index
+    return nnz_factors*bytes_per_entry
+
+
+def select_solver(A):
+    # picks the fastest available backend from the size of A and the free memory
+    # direct solvers are preferred (pardiso > umfpack > scipy) as long as their factors fit
+
+    memory = available_memory()
+    if memory is None or estimate_lu_memory(A) < AUTO_MEMORY_FRACTION*memory:
+        for name in ('pardiso', 'umfpack', 'scipy'):
+            if SOLVER_BACKENDS[name].is_available():
+                return name
+    return 'iterative'
+
+
+def get_solver(solver=SOLVER, A=None):
+    # returns the backend class registered under the name 'solver'
+    # solver='auto' picks one based on the matrix A
+
+    name = solver.lower()
+    if name == 'auto':
+        if A is None:
+            raise ValueError("solver='auto' needs the matrix to choose a backend")
+        name = select_solver(A)
+
+    if name not in SOLVER_BACKENDS:
+        raise ValueError('Invalid solver choice: {}, options are {} or auto'.format(str(solver), list(SOLVER_BACKENDS)))
+
+    backend = SOLVER_BACKENDS[name]
+    if not backend.is_available():
+        raise ValueError("The '{}' solver is not available on this machine, available solvers are {}".format(name, available_solvers()))
+
+    return backend
+
+
+def factorize(A, solver=SOLVER, **solver_options):
+    # returns an (unfactored) solver object for A from the requested backend
+    return get_solver(solver, A)(A, **solver_options)
+
+
+class Complex2RealSystem:
+    """ Real-equivalent form of A11 x + A12 x* = b, a 2Mx2M real linear system.
+
+        The block sparsity pattern is built once and update() only rewrites its
+        values, so a sequence of systems with the same pattern (e.g. Newton
+        iterations) is refactored numerically, reusing the ordering / symbolic
+        analysis of the first one.
+    """
+
+    def __init__(self, A11, A12, solver=SOLVER, **solver_options):
+
+        A11 = A11.tocsr()
+        A12 = A12.tocsr()
+        M = A11.shape[0]
+        self.M = M
+        self.solver = solver
+        self.solver_options = solver_options
+        self.factors = None
+
+        # the diagonal blocks hold the real parts and the off-diagonal blocks the imaginary
+        # parts (nonzero in the PML only), plus A12 which changes with E.
+        # structural zeros are left out as they would only add fill to the factors
+        def _pattern(*matrices):
+            P = sp.csr_matrix((M, M))
+            for A in matrices:
+                A = A.tocoo()
+                nonzero = A.data != 0
+                P = P + sp.csr_matrix((np.ones(nonzero.sum()), (A.row[nonzero], A.col[nonzero])), shape=(M, M))
+            P.data[:] = 1
+            return P
+
+        P_re = _pattern(np.real(A11), A12, sp.eye(M))
+        P_im = _pattern(np.imag(A11), A12)
+        Areal = sp.bmat([[P_re, P_im], [P_im, P_re]], format='csr')
+        Areal.sum_duplicates()
+        Areal.sort_indices()
+        self.Areal = Areal
+        self._keys = np.repeat(np.arange(2*M, dtype=np.int64), np.diff(Areal.indptr))*2*M + Areal.indices
+
+    def _add_block(self, data, block, A, part, sign):
+        # adds sign*part(A) to one of the four blocks of data, False if it doesnt fit the pattern
+
+        A = A.tocoo()
+        values = part(A.data)
+        nonzero = values != 0
+        rows = A.row[nonzero].astype(np.int64) + self.M*block[0]
+        cols = A.col[nonzero].astype(np.int64) + self.M*block[1]
+        keys = rows*2*self.M + cols
+        pos = np.minimum(np.searchsorted(self._keys, keys), self._keys.size - 1)
+        if np.any(self._keys[pos] != keys):
+            return False
+        np.add.at(data, pos, sign*values[nonzero])
+        return True
+
+    def update(self, A11, A12, timing=False):
+        # sets the values of A11 and A12 and (re)factors the real-equivalent system
+        # returns False if the new values dont fit the pattern and the system must be rebuilt
+
+        # [Re(A11) + Re(A12), -Im(A11) + Im(A12); Im(A11) + Im(A12), Re(A11) - Re(A12)]
+        data = np.zeros(self.Areal.nnz)
+        blocks = [((0, 0), A11, np.real, 1), ((0, 0), A12, np.real, 1),
+                  ((0, 1), A11, np.imag, -1), ((0, 1), A12, np.imag, 1),
+                  ((1, 0), A11, np.imag, 1), ((1, 0), A12, np.imag, 1),
+                  ((1, 1), A11, np.real, 1), ((1, 1), A12, np.real, -1)]
+        for (block, A, part, sign) in blocks:
+            if not self._add_block(data, block, A, part, sign):
+                return False
+        self.Areal = sp.csr_matrix((data, self.Areal.indices, self.Areal.indptr), shape=self.Areal.shape)
+
+        if self.factors is None:
+            self.factors = factorize(self.Areal, solver=self.solver, **self.solver_options)
+        else:
+            self.factors.refactor(self.Areal, timing=timing)
+        return True
+
+    def solve(self, b, transpose=False, timing=False):
+        # solves for x given b (complex)
+        # with transpose, the real-equivalent system is transposed, this gives the adjoint
+        # of A11 x + A12 x* = b as conj(solve(conj(b), transpose=True))
+
+        b = np.asarray(b).astype(np.complex128).reshape((-1,))
+        if not b.any():
+            return np.zeros(b.shape, dtype=np.complex128)
+        x = self.factors.solve(np.hstack((np.real(b), np.imag(b))), transpose=transpose, timing=timing)
+        return x[:self.M] + 1j*x[self.M:]
+
+    def clear(self):
+        if self.factors is not None:
+            self.factors.clear()
+        self.factors = None
+
+
+def solver_complex2real(A11, A12, b, timing=False, solver=SOLVER, **solver_options):
     # solves linear system of equations [A11, A12; A21*, A22*]*[x; x*] = [b; b*]
 
     b = b.astype(np.complex128)
     b = b.reshape((-1,))
-    N = b.size
 
     if not b.any():
         return np.zeros(b.shape)
 
-    b_re = np.real(b).astype(np.float64)
-    b_im = np.imag(b).astype(np.float64)
-
-    Areal = sp.vstack((sp.hstack((np.real(A11) + np.real(A12), - np.imag(A11) + np.imag(A12))),
-                       sp.hstack((np.imag(A11) + np.imag(A12), np.real(A11) - np.real(A12)))))
-
     if timing:
         t = time()
 
-    if solver.lower() == 'pardiso':
-        pSolve = pardisoSolver(Areal, mtype=11)  # Matrix is real unsymmetric
-        pSolve.factor()
-        x = pSolve.solve(np.hstack((b_re, b_im)))
-        pSolve.clear()
-
-    elif solver.lower() == 'scipy':
-        x = spsolve(Areal, np.hstack((b_re, b_im)))
-
-    else:
-        raise ValueError('Invalid solver choice: {}, options are pardiso or scipy'.format(str(solver)))
+    system = Complex2RealSystem(A11, A12, solver=solver, **solver_options)
+    system.update(A11, A12)
+    x = system.solve(b)
+    system.clear()
 
     if timing:
         print('Linear system solve took {:.2f} seconds'.format(time()-t))
 
-    return (x[:N] + 1j*x[N:2*N])
+    return x
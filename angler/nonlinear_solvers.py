@@ -2,15 +2,20 @@ import numpy as np
 import numpy.linalg as la
 import scipy.sparse as sp
 import scipy.sparse.linalg as spl
+from collections import OrderedDict
 from copy import deepcopy
 
-from scipy.optimize import newton_krylov, anderson
-
-from angler.linalg import grid_average, solver_direct, solver_complex2real
+from angler.linalg import (grid_average, solver_direct, solver_complex2real, Complex2RealSystem,
+						   tolerance_kwargs, factorize)
 from angler.derivatives import unpack_derivs
 from angler.constants import (DEFAULT_LENGTH_SCALE, DEFAULT_MATRIX_FORMAT,
 							  DEFAULT_SOLVER, EPSILON_0, MU_0)
 
+# factors of the linear A and its Green's function on the nonlinear cells, for schur_solve,
+# keyed by A and the cells (least recently used are dropped)
+_green_cache = OrderedDict()
+GREEN_CACHE_SIZE = 2
+
 
 def born_solve(simulation,
 			   Estart=None, conv_threshold=1e-10, max_num_iter=50,
@@ -55,12 +60,81 @@ def born_solve(simulation,
 
 	return (Fx, Fy, Fz, conv_array)
 
+def anderson_solve(simulation,
+				   Estart=None, conv_threshold=1e-10, max_num_iter=50,
+				   averaging=True, history=5, mixing=1.0):
+	# solves for the nonlinear fields with the Born iteration, accelerated by Anderson mixing
+
+	# Each iteration costs one Born step, F -> G(F) (a solve with eps_nl(F)).  Instead of F <- G(F),
+	# the next field is the combination of the last (history + 1) iterates that minimizes the
+	# linearized residual R = G(F) - F (least squares, over real coefficients as G is not analytic in F).
+	# Safeguard: if the residual grows, the history is dropped and a plain (mixed) Born step is taken.
+
+	# Stores convergence parameters
+	conv_array = np.zeros((max_num_iter, 1))
+
+	# Defne the starting field for the simulation
+	if Estart is None:
+		if simulation.fields[simulation.pol] is None:
+			(_, _, Fz) = simulation.solve_fields()
+		else:
+			Fz = deepcopy(simulation.fields[simulation.pol])
+	else:
+		Fz = Estart
+
+	shape = Fz.shape
+	F = np.reshape(Fz, (-1,))
+	dF_history = []
+	dR_history = []
+	(F_prev, R_prev) = (None, None)
+
+	for istep in range(max_num_iter):
+
+		# born step
+		simulation.compute_nl(F.reshape(shape))
+		(Fx, Fy, Fz) = simulation.solve_fields(include_nl=True)
+		G = np.reshape(Fz, (-1,))
+		R = G - F
+
+		# get convergence and break
+		convergence = la.norm(R)/la.norm(G)
+		conv_array[istep] = convergence
+		if convergence < conv_threshold:
+			break
+
+		if R_prev is not None:
+			if la.norm(R) > la.norm(R_prev):
+				dF_history = []
+				dR_history = []
+			else:
+				dF_history = (dF_history + [F - F_prev])[-history:]
+				dR_history = (dR_history + [R - R_prev])[-history:]
+		(F_prev, R_prev) = (F, R)
+
+		if len(dR_history) > 0:
+			dF = np.stack(dF_history, axis=1)
+			dR = np.stack(dR_history, axis=1)
+			gamma = la.lstsq(np.vstack((np.real(dR), np.imag(dR))),
+							 np.hstack((np.real(R), np.imag(R))), rcond=1e-12)[0]
+			F = F + mixing*R - (dF + mixing*dR).dot(gamma)
+		else:
+			F = F + mixing*R
+
+	if convergence > conv_threshold:
+		print("the simulation did not converge, reached {}".format(convergence))
+
+	return (Fx, Fy, Fz, conv_array)
+
 def newton_solve(simulation,
 				 Estart=None, conv_threshold=1e-10, max_num_iter=50,
-				 averaging=True, solver=DEFAULT_SOLVER, jac_solver='c2r',
+				 averaging=True, solver=None, jac_solver='c2r',
 				 matrix_format=DEFAULT_MATRIX_FORMAT):
 	# solves for the nonlinear fields using Newton's method
 
+	# by default, use the linear solver of the simulation
+	if solver is None:
+		solver = simulation.solver
+
 	# Stores convergence parameters
 	conv_array = np.zeros((max_num_iter, 1))
 
@@ -77,6 +151,10 @@ def newton_solve(simulation,
 		else:
 			Ez = Estart
 
+		# the real-equivalent Jacobian keeps its sparsity pattern between iterations,
+		# so it is analyzed once and only refactored numerically afterwards
+		system = None
+
 		# Solve iteratively
 		for istep in range(max_num_iter):
 			Eprev = Ez
@@ -87,11 +165,13 @@ def newton_solve(simulation,
 			# Note: Newton's method is defined as a linear problem to avoid inverting the Jacobian
 			# Namely, J*(x_n - x_{n-1}) = -f(x_{n-1}), where J = df/dx(x_{n-1})
 
-			Ediff = solver_complex2real(Jac11, Jac12, fx,
-										solver=solver, timing=False)
-			# Abig = sp.sp_vstack((sp.sp_hstack((Jac11, Jac12)), \
-			#   sp.sp_hstack((np.conj(Jac12), np.conj(Jac11)))))
-			# Ediff = solver_direct(Abig, np.vstack((fx, np.conj(fx))))
+			if system is None or not system.update(Jac11, Jac12):
+				if system is not None:
+					system.clear()
+				system = Complex2RealSystem(Jac11, Jac12, solver=solver,
+											**simulation.solver_options)
+				system.update(Jac11, Jac12)
+			Ediff = system.solve(fx)
 
 			Ez = Eprev - Ediff[range(Nbig)].reshape(simulation.Nx, simulation.Ny)
 
@@ -103,6 +183,15 @@ def newton_solve(simulation,
 			if convergence < conv_threshold:
 				break
 
+		# the factored Jacobian is kept for the adjoint only if converged, when it was factored
+		# within conv_threshold of the returned field (otherwise the adjoint builds its own)
+		if convergence < conv_threshold:
+			simulation.set_jacobian_nl(system)
+		else:
+			if system is not None:
+				system.clear()
+			simulation.clear_jacobian_nl()
+
 		# Solve the fdfd problem with the final eps_nl
 		simulation.compute_nl(Ez)
 		(Hx, Hy, Ez) = simulation.solve_fields(include_nl=True)
@@ -115,6 +204,360 @@ def newton_solve(simulation,
 	else:
 		raise ValueError('Invalid polarization: {}'.format(str(self.pol)))
 
+def hybrid_solve(simulation,
+				 Estart=None, conv_threshold=1e-10, max_num_iter=50,
+				 averaging=True, solver=None, max_born=20, min_born=3, max_rate=0.5,
+				 min_damping=1/64, verbose=False, matrix_format=DEFAULT_MATRIX_FORMAT):
+	# solves for the nonlinear fields with Born iterations while they contract fast,
+	# then with damped Newton steps.
+
+	# Born (one linear solve per step) is kept while |dE_n| / |dE_{n-1}| <= max_rate.
+	# After min_born steps, a poorer rate (slow, oscillating or diverging iterations)
+	# switches to Newton, starting from the best Born iterate.  Each Newton step is
+	# backtracked (halving the step, down to min_damping) until |f| decreases.
+	# max_num_iter counts the Born and Newton iterations together.
+	# The decisions are printed with verbose=True and stored in simulation.nl_stats['log']
+
+	# by default, use the linear solver of the simulation
+	if solver is None:
+		solver = simulation.solver
+
+	log = []
+	def _log(message):
+		log.append(message)
+		if verbose:
+			print(message)
+
+	# Stores convergence parameters
+	conv_array = np.zeros((max_num_iter, 1))
+
+	# Defne the starting field for the simulation
+	if Estart is None:
+		if simulation.fields[simulation.pol] is None:
+			(_, _, Fz) = simulation.solve_fields()
+		else:
+			Fz = deepcopy(simulation.fields[simulation.pol])
+	else:
+		Fz = Estart
+
+	# Born iterations, while they contract
+	(F_best, conv_best) = (Fz, np.inf)
+	conv_prev = np.inf
+	convergence = np.inf
+	num_born = 0
+	for istep in range(min(max_born, max_num_iter)):
+
+		Fprev = Fz
+		simulation.compute_nl(Fprev)
+		(Fx, Fy, Fz) = simulation.solve_fields(include_nl=True)
+		num_born += 1
+
+		convergence = la.norm(Fz - Fprev)/la.norm(Fz)
+		conv_array[istep] = convergence
+		if convergence < conv_threshold:
+			_log("born converged in {} steps".format(num_born))
+			break
+
+		if convergence < conv_best:
+			(F_best, conv_best) = (Fz, convergence)
+
+		rate = convergence/conv_prev
+		conv_prev = convergence
+		if num_born >= min_born and rate > max_rate:
+			_log("born step {}: contraction rate {:.3g} > {}, switching to newton".format(num_born, rate, max_rate))
+			break
+	else:
+		if num_born < max_num_iter:
+			_log("born did not converge in {} steps, switching to newton".format(num_born))
+
+	num_newton = 0
+	if convergence >= conv_threshold and num_born < max_num_iter:
+
+		if simulation.pol != 'Ez':
+			raise ValueError('angler doesnt support newton method for Hz polarization yet')
+
+		# damped Newton, from the best Born iterate
+		Nbig = simulation.Nx*simulation.Ny
+		Ez = np.reshape(F_best, (simulation.Nx, simulation.Ny))
+		system = None
+		for istep in range(num_born, max_num_iter):
+			Eprev = Ez
+
+			(fx, Jac11, Jac12) = nl_eq_and_jac(simulation, Ez=Eprev,
+											   matrix_format=matrix_format)
+			if system is None or not system.update(Jac11, Jac12):
+				if system is not None:
+					system.clear()
+				system = Complex2RealSystem(Jac11, Jac12, solver=solver,
+											**simulation.solver_options)
+				system.update(Jac11, Jac12)
+			Ediff = system.solve(fx)[range(Nbig)].reshape(simulation.Nx, simulation.Ny)
+			num_newton += 1
+
+			# backtracking line search on |f| (Armijo condition)
+			f_norm = la.norm(fx)
+			damping = 1.0
+			while True:
+				Ez = Eprev - damping*Ediff
+				f_norm_new = la.norm(nl_eq_and_jac(simulation, Ez=Ez, compute_jac=False,
+												   matrix_format=matrix_format))
+				if f_norm_new <= (1 - 1e-4*damping)*f_norm or damping <= min_damping:
+					break
+				damping = damping/2
+			if damping < 1:
+				_log("newton step {}: damped by {}, |f| {:.3g} -> {:.3g}".format(num_newton, damping, f_norm, f_norm_new))
+
+			convergence = la.norm(Ez - Eprev)/la.norm(Ez)
+			conv_array[istep] = convergence
+			if convergence < conv_threshold:
+				_log("newton converged in {} steps".format(num_newton))
+				break
+
+		# the factored Jacobian is kept for the adjoint only if converged, when it was factored
+		# within conv_threshold of the returned field (otherwise the adjoint builds its own)
+		if convergence < conv_threshold:
+			simulation.set_jacobian_nl(system)
+		else:
+			if system is not None:
+				system.clear()
+			simulation.clear_jacobian_nl()
+
+		# fields of the final eps_nl (from Ez, without another solve)
+		simulation.compute_nl(Ez)
+		(Fx, Fy, Fz) = simulation._fields_from_X(Ez, simulation.eps_r + simulation.eps_nl,
+												 averaging=averaging, matrix_format=matrix_format)
+
+	simulation.nl_stats = {'born_steps': num_born, 'newton_steps': num_newton, 'log': log}
+
+	if convergence > conv_threshold:
+		print("the simulation did not converge, reached {}".format(convergence))
+
+	return (Fx, Fy, Fz, conv_array)
+
+
+def chord_solve(simulation,
+				Estart=None, conv_threshold=1e-10, max_num_iter=50,
+				averaging=True, solver=None, max_rate=0.5,
+				matrix_format=DEFAULT_MATRIX_FORMAT):
+	# solves for the nonlinear fields with the chord (modified Newton) method:
+	# the Newton steps J*(x_n - x_{n-1}) = f(x_{n-1}) reuse one factorized Jacobian
+	# for as long as the iteration contracts by at least max_rate per step.
+
+	# The first Jacobian is the linear A (simulation.factors, usually already factored),
+	# which turns the first steps into Born iterations.  When the contraction rate
+	# |dE_n| / |dE_{n-1}| exceeds max_rate, the Jacobian is refactored at the current
+	# field; a step that grew with a stale Jacobian is undone first.
+	# The counts of factorizations and back-substitutions are stored in simulation.nl_stats
+
+	if simulation.pol != 'Ez':
+		raise ValueError('angler doesnt support newton method for Hz polarization yet')
+
+	# by default, use the linear solver of the simulation
+	if solver is None:
+		solver = simulation.solver
+
+	# Stores convergence parameters
+	conv_array = np.zeros((max_num_iter, 1))
+
+	# num. columns and rows of A
+	Nbig = simulation.Nx*simulation.Ny
+
+	# Defne the starting field for the simulation
+	if Estart is None:
+		if simulation.fields['Ez'] is None:
+			(_, _, Ez) = simulation.solve_fields()
+		else:
+			Ez = deepcopy(simulation.fields['Ez'])
+	else:
+		Ez = Estart
+
+	Ez = np.reshape(Ez, (simulation.Nx, simulation.Ny))
+
+	# the linear factorization is counted if this solve computes it
+	num_factorizations = int(simulation._factors is None)
+	num_solves = 0
+	jac_solve = simulation.factors.solve
+	system = None
+	refresh = False
+	conv_prev = np.inf
+
+	for istep in range(max_num_iter):
+		Eprev = Ez
+
+		if refresh:
+			# factor the Jacobian at the current field (same pattern, so only numerically)
+			(fx, Jac11, Jac12) = nl_eq_and_jac(simulation, Ez=Eprev,
+											   matrix_format=matrix_format)
+			if system is None or not system.update(Jac11, Jac12):
+				if system is not None:
+					system.clear()
+				system = Complex2RealSystem(Jac11, Jac12, solver=solver,
+											**simulation.solver_options)
+				system.update(Jac11, Jac12)
+			jac_solve = system.solve
+			num_factorizations += 1
+			refresh = False
+			conv_prev = np.inf
+		else:
+			fx = nl_eq_and_jac(simulation, Ez=Eprev, compute_jac=False,
+							   matrix_format=matrix_format)
+
+		Ediff = jac_solve(fx)
+		num_solves += 1
+
+		Ez = Eprev - Ediff[range(Nbig)].reshape(simulation.Nx, simulation.Ny)
+
+		# get convergence and break
+		convergence = la.norm(Ez - Eprev)/la.norm(Ez)
+		conv_array[istep] = convergence
+
+		# if below threshold, break and return
+		if convergence < conv_threshold:
+			break
+
+		rate = convergence/conv_prev
+		if rate > 1:
+			# the stale Jacobian made things worse, step back and refactor
+			Ez = Eprev
+			refresh = True
+		elif rate > max_rate:
+			refresh = True
+		else:
+			conv_prev = convergence
+
+	if system is not None:
+		system.clear()
+
+	simulation.nl_stats = {'factorizations': num_factorizations, 'solves': num_solves}
+
+	# fields of the final eps_nl (from Ez, without another factorization)
+	simulation.compute_nl(Ez)
+	(Hx, Hy, Ez) = simulation._fields_from_X(Ez, simulation.eps_r + simulation.eps_nl,
+											 averaging=averaging, matrix_format=matrix_format)
+
+	if convergence > conv_threshold:
+		print("the simulation did not converge, reached {}".format(convergence))
+
+	return (Hx, Hy, Ez, conv_array)
+
+
+def schur_solve(simulation,
+				Estart=None, conv_threshold=1e-10, max_num_iter=50,
+				averaging=True, max_nl_cells=4000, block_size=256):
+	# solves for the nonlinear fields by Newton's method on the nonlinear cells only
+
+	# A E = b - Anl(E) E and Anl is zero outside the nonlinear cells, so with the linear field
+	# E0 = A^-1 b and G = A^-1 restricted to the nonlinear cells (columns of the Green's function),
+	# the field x on the nonlinear cells solves
+	#   g(x) = x + G (d(x) x) - E0 = 0,    d = omega^2 eps_0 eps_nl(x)
+	# a dense system of the size of the nonlinear region.  G costs one solve with the factors of A
+	# per nonlinear cell, but is kept between calls with the same A (e.g. over a power sweep).
+	# The full field is one more solve, with the final nonlinear term as a source.
+	# The convergence is measured on the nonlinear cells.
+
+	if simulation.pol != 'Ez':
+		raise ValueError('angler doesnt support newton method for Hz polarization yet')
+
+	index = np.unique(np.concatenate([np.zeros(0, dtype=int)] + [nli.index for nli in simulation.nonlinearity]))
+	num_cells = index.size
+	if num_cells > max_nl_cells:
+		raise ValueError("the nonlinear region has {} cells, more than max_nl_cells={}, "
+						 "use another solver_nl".format(num_cells, max_nl_cells))
+
+	# Stores convergence parameters
+	conv_array = np.zeros((max_num_iter, 1))
+
+	(factors, G) = _green_function(simulation, index, block_size)
+	(Gr, Gi) = (np.real(G), np.imag(G))
+
+	b = 1j*simulation.omega*np.reshape(simulation.src, (-1,))
+	E0 = factors.solve(b)[index]
+
+	# Defne the starting field for the simulation
+	if Estart is None:
+		if simulation.fields['Ez'] is None:
+			x = E0
+		else:
+			x = np.reshape(simulation.fields['Ez'], (-1,))[index]
+	else:
+		x = np.reshape(Estart, (-1,))[index]
+
+	scale = simulation.omega**2*EPSILON_0*simulation.L0
+	E = np.zeros(simulation.Nx*simulation.Ny, dtype=np.complex128)
+
+	convergence = np.inf
+	for istep in range(max_num_iter):
+
+		E[index] = x
+		simulation.compute_nl(E.reshape((simulation.Nx, simulation.Ny)))
+		d = scale*np.reshape(simulation.eps_nl, (-1,))[index]
+		dAde = scale*np.reshape(simulation.dnl_de, (-1,))[index]
+		g = x + G.dot(d*x) - E0
+
+		# g'(x) v = v + G (a v + c v*), in real-equivalent form [Re v; Im v]
+		a = d + dAde*x
+		c = np.conj(dAde)*x
+		(M11, M12, M21, M22) = (np.real(a) + np.real(c), np.imag(c) - np.imag(a),
+								np.imag(a) + np.imag(c), np.real(a) - np.real(c))
+		jac = np.block([[Gr*M11 - Gi*M21, Gr*M12 - Gi*M22],
+						[Gi*M11 + Gr*M21, Gi*M12 + Gr*M22]])
+		jac[np.diag_indices(2*num_cells)] += 1
+
+		dx = la.solve(jac, np.hstack((np.real(g), np.imag(g))))
+		xprev = x
+		x = x - (dx[:num_cells] + 1j*dx[num_cells:])
+
+		# get convergence and break
+		convergence = la.norm(x - xprev)/la.norm(x)
+		conv_array[istep] = convergence
+
+		# if below threshold, break and return
+		if convergence < conv_threshold:
+			break
+
+	if convergence > conv_threshold:
+		print("the simulation did not converge, reached {}".format(convergence))
+
+	# the full field, with the nonlinear term of the final x as a source
+	E[index] = x
+	simulation.compute_nl(E.reshape((simulation.Nx, simulation.Ny)))
+	rhs = np.copy(b)
+	rhs[index] -= scale*np.reshape(simulation.eps_nl, (-1,))[index]*x
+	Ez = factors.solve(rhs)
+
+	(Hx, Hy, Ez) = simulation._fields_from_X(Ez, simulation.eps_r + simulation.eps_nl,
+											 averaging=averaging)
+
+	return (Hx, Hy, Ez, conv_array)
+
+
+def _green_function(simulation, index, block_size):
+	# factors of the linear A and (A^-1)[index, index], cached by A and index
+
+	A = simulation.A.tocsr()
+	key = (A.shape, A.indptr.tobytes(), A.indices.tobytes(), A.data.tobytes(), index.tobytes(),
+		   simulation.solver)
+	if key in _green_cache:
+		_green_cache.move_to_end(key)
+		return _green_cache[key]
+
+	# a factorization of its own, so clearing the one of the simulation doesnt affect the cache
+	factors = factorize(A, solver=simulation.solver, **simulation.solver_options)
+	Nbig = A.shape[0]
+	G = np.zeros((index.size, index.size), dtype=np.complex128)
+	for start in range(0, index.size, block_size):
+		columns = index[start:start + block_size]
+		rhs = np.zeros((Nbig, columns.size), dtype=np.complex128)
+		rhs[columns, np.arange(columns.size)] = 1
+		G[:, start:start + columns.size] = factors.solve(rhs)[index, :]
+
+	_green_cache[key] = (factors, G)
+	if len(_green_cache) > GREEN_CACHE_SIZE:
+		(_, (old_factors, _)) = _green_cache.popitem(last=False)
+		old_factors.clear()
+	return _green_cache[key]
+
+
 def nl_eq_and_jac(simulation,
 				  averaging=True, Ex=None, Ey=None, Ez=None, compute_jac=True,
 				  matrix_format=DEFAULT_MATRIX_FORMAT):
@@ -136,7 +579,6 @@ def nl_eq_and_jac(simulation,
 		fE = fE.reshape(-1,)
 
 		if compute_jac:
-			simulation.compute_nl(Ez)
 			dAde = (simulation.dnl_de).reshape((-1,))*omega**2*EPSILON_0_
 			Jac11 = Anl + sp.spdiags(dAde*Ez.reshape((-1,)), 0, Nbig, Nbig, format=matrix_format)
 			Jac12 = sp.spdiags(np.conj(dAde)*Ez.reshape((-1,)), 0, Nbig, Nbig, format=matrix_format)
@@ -154,9 +596,20 @@ def nl_eq_and_jac(simulation,
 
 
 def newton_krylov_solve(simulation, Estart=None, conv_threshold=1e-10, max_num_iter=50,
-				 averaging=True, solver=DEFAULT_SOLVER, jac_solver='c2r',
-				 matrix_format=DEFAULT_MATRIX_FORMAT):
-	# THIS DOESNT WORK YET! 
+				 averaging=True, matrix_format=DEFAULT_MATRIX_FORMAT,
+				 krylov_restart=50, krylov_maxiter=20):
+	# solves for the nonlinear fields using Newton's method, with the Newton steps
+	# J*(x_n - x_{n-1}) = f(x_{n-1}) solved by GMRES instead of factoring the Jacobian.
+
+	# J(v) = Jac11 v + Jac12 v* is only real-linear, so GMRES works on [Re v; Im v].
+	# Only products with the (complex, M x M) Jacobian from nl_eq_and_jac are needed,
+	# never the 2M x 2M real-equivalent system.  GMRES is preconditioned with the
+	# factorization of the linear A (simulation.factors, computed once), which is
+	# close to J when the nonlinear change of the permittivity is small.
+	# The tolerance of each GMRES solve follows the nonlinear residual (inexact Newton).
+
+	if simulation.pol != 'Ez':
+		raise ValueError('angler doesnt support newton method for Hz polarization yet')
 
 	# Stores convergence parameters
 	conv_array = np.zeros((max_num_iter, 1))
@@ -167,23 +620,57 @@ def newton_krylov_solve(simulation, Estart=None, conv_threshold=1e-10, max_num_i
 	# Defne the starting field for the simulation
 	if Estart is None:
 		if simulation.fields['Ez'] is None:
-			(_, _, E0) = simulation.solve_fields()
+			(_, _, Ez) = simulation.solve_fields()
 		else:
-			E0 = deepcopy(simulation.fields['Ez'])
+			Ez = deepcopy(simulation.fields['Ez'])
 	else:
-		E0 = Estart
+		Ez = Estart
+
+	Ez = np.reshape(Ez, (simulation.Nx, simulation.Ny))
+	b_norm = la.norm(simulation.src)*simulation.omega
+
+	_to_real = lambda z: np.hstack((np.real(z), np.imag(z)))
+	_to_complex = lambda x: x[:Nbig] + 1j*x[Nbig:]
+
+	factors = simulation.factors
+	precond = spl.LinearOperator((2*Nbig, 2*Nbig), dtype=np.float64,
+								 matvec=lambda x: _to_real(factors.solve(_to_complex(x))))
+
+	for istep in range(max_num_iter):
+		Eprev = Ez
 
-	E0 = np.reshape(E0, (-1,))
+		(fx, Jac11, Jac12) = nl_eq_and_jac(simulation, Ez=Eprev,
+										   matrix_format=matrix_format)
 
-	# funtion for roots
-	def _f(E):
-		E = np.reshape(E, simulation.eps_r.shape)
-		fx = nl_eq_and_jac(simulation, Ez=E, compute_jac=False, matrix_format=matrix_format)
-		return np.reshape(fx, (-1,))
+		jac = spl.LinearOperator((2*Nbig, 2*Nbig), dtype=np.float64,
+								 matvec=lambda x: _to_real(Jac11.dot(_to_complex(x)) + Jac12.dot(np.conj(_to_complex(x)))))
 
-	print(_f(E0))
+		# the first guess is the preconditioned residual
+		rhs = _to_real(fx)
+		tol = max(min(0.1, la.norm(fx)/b_norm), 1e-14)
+		(x, info) = spl.gmres(jac, rhs, x0=precond.matvec(rhs), M=precond,
+							  restart=krylov_restart, maxiter=krylov_maxiter,
+							  **tolerance_kwargs(spl.gmres, tol))
+
+		Ez = Eprev - _to_complex(x).reshape(simulation.Nx, simulation.Ny)
+
+		# get convergence and break
+		convergence = la.norm(Ez - Eprev)/la.norm(Ez)
+		conv_array[istep] = convergence
+
+		# if below threshold, break and return
+		if convergence < conv_threshold:
+			break
+
+		if not np.isfinite(convergence):
+			raise ValueError("the newton-krylov iteration diverged at step {}".format(istep))
+
+	if convergence > conv_threshold:
+		print("the simulation did not converge, reached {}".format(convergence))
 
-	E_nl = newton_krylov(_f, E0, verbose=True)
+	# fields of the final eps_nl (from Ez, without another solve)
+	simulation.compute_nl(Ez)
+	(Hx, Hy, Ez) = simulation._fields_from_X(Ez, simulation.eps_r + simulation.eps_nl,
+											 averaging=averaging, matrix_format=matrix_format)
 
-	# I'm returning these in place of Hx and Hy to not break things
-	return (E_nl, E_nl, E_nl, conv_array)
+	return (Hx, Hy, Ez, conv_array)
@@ -35,5 +35,26 @@ class Nonlinearity:
             self.dnl_de = kerr_nl_de
             self.dnl_deps = kerr_nl_deps
 
+            # the (flat) indices of the nonlinear region and 3*chi*nl_region there, for add_to()
+            self.index = np.flatnonzero(nl_region)
+            self.weight = 3*chi*np.ravel(nl_region)[self.index]
+
         else:
             raise AssertionError("Only 'kerr' type nonlinearity is currently supported") 
+
+    def add_to(self, e, eps_r, eps_nl, dnl_de, dnl_deps):
+        # adds eps_nl, dnl_de and dnl_deps of the field e to the (flat) arrays given,
+        # evaluating |e|^2 once and only on the nonlinear region
+
+        e_nl = np.ravel(e)[self.index]
+        e_conj = np.conj(e_nl)
+        intensity = np.real(e_nl*e_conj)
+        if self.eps_scale:
+            factor = self.weight/(self.eps_max - 1)
+            eps_factor = factor*(np.ravel(eps_r)[self.index] - 1)
+            eps_nl[self.index] += eps_factor*intensity
+            dnl_de[self.index] += eps_factor*e_conj
+            dnl_deps[self.index] += factor*intensity
+        else:
+            eps_nl[self.index] += self.weight*intensity
+            dnl_de[self.index] += self.weight*e_conj
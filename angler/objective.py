@@ -1,4 +1,4 @@
-from autograd import grad
+from autograd import grad, value_and_grad
 import numpy as np
 
 from angler.gradients import *
@@ -60,6 +60,7 @@ class Objective():
     def J(self, J_new):
         # when objective function is reset, re-solve for the partials
         self._J = J_new
+        self._cache = None
         self._autograd_J()
         self._get_gradients()
 
@@ -75,6 +76,45 @@ class Objective():
             dJ_list.append(grad(self._J, arg_index))
         self.dJ_list = dJ_list
 
+        # J and all of its partials from one trace of the objective
+        self._value_and_grad = value_and_grad(lambda args: self._J(*args))
+
+    def _cached(self, args):
+        # the cache entry if it was stored for these (exactly equal) arguments
+        if self._cache is None:
+            return None
+        cached_args = self._cache[0]
+        if len(cached_args) != len(args):
+            return None
+        for (cached_arg, arg) in zip(cached_args, args):
+            if np.shape(cached_arg) != np.shape(arg) or not np.array_equal(cached_arg, arg):
+                return None
+        return self._cache
+
+    def value(self, *args):
+        """ J(*args), reusing the last evaluation at the same arguments """
+
+        cached = self._cached(args)
+        if cached is not None:
+            return cached[1]
+
+        J_value = self._J(*args)
+        self._cache = ([np.copy(arg) for arg in args], J_value, None)
+        return J_value
+
+    def value_and_partials(self, *args):
+        """ J(*args) and the list of its partials with respect to each argument,
+            from a single trace of the objective (cached for the last arguments) """
+
+        cached = self._cached(args)
+        if cached is not None and cached[2] is not None:
+            return cached[1], cached[2]
+
+        (J_value, partials) = self._value_and_grad(tuple(args))
+        partials = list(partials)
+        self._cache = ([np.copy(arg) for arg in args], J_value, partials)
+        return J_value, partials
+
     def _get_gradients(self):
         # loads in the gradient functions from the arg_list
         grad_fn_list = []
@@ -7,6 +7,11 @@ from scipy.optimize import minimize, fmin_l_bfgs_b
 from autograd import grad
 
 from angler.constants import *
+from angler import sweep
+from angler.continuation import power_sweep
+from angler.reduced import ReducedModel
+from angler.simulation import LOWRANK_MAX_RANK
+from angler.gradients import filter_terms, adjoint_source, grad_linear, grad_kerr
 from angler.filter import (eps2rho, rho2eps, get_W, deps_drhob, drhob_drhot,
                     drhot_drho, rho2rhot, drhot_drho, rhot2rhob)
 
@@ -80,8 +85,8 @@ class Optimization():
         # stores all of the fields for the objective function in self.field_arg_list
         self._solve_objfn_arg_fields(simulation)
 
-        # pass these arguments to the objective function
-        return self.objective.J(*self.field_arg_list)
+        # pass these arguments to the objective function (reusing a traced evaluation from compute_dJ)
+        return self.objective.value(*self.field_arg_list)
 
     def compute_dJ(self, simulation, design_region):
         """ Returns the current grad of a simulation"""
@@ -89,20 +94,49 @@ class Optimization():
         # stores all of the fields for the objective function in self.field_arg_list
         self._solve_objfn_arg_fields(simulation)
 
-        # sum up gradient contributions from each argument in J
+        # the projection and filter terms are shared by all the contributions
+        self._filter_terms = None
+        self._filter_terms = filter_terms(self)
+
+        # the adjoint problems are linear in their sources, so the sources of all the linear
+        # (and all the nonlinear) arguments are summed and solved for at once
+        # (the partials of all the arguments come from a single trace of the objective)
+        (_, partials) = self.objective.value_and_partials(*self.field_arg_list)
+        sources = {False: 0, True: 0}
+        for partial, arg in zip(partials, self.objective.arg_list):
+            sources[arg.nl] = sources[arg.nl] + adjoint_source(self, arg.component, -partial)
+
+        # sum up gradient contributions from the linear and nonlinear arguments in J
         gradient_sum = 0
-        for gradient_fn, dJ, arg in zip(self.objective.grad_fn_list, self.objective.dJ_list, self.objective.arg_list):
-            if not arg.nl:
-                Fz = simulation.fields[simulation.pol]
-            else:
-                Fz = simulation.fields_nl[simulation.pol]
-            gradient = gradient_fn(self, dJ, Fz, self.field_arg_list)
-            gradient_sum += gradient
+        try:
+            if any(not arg.nl for arg in self.objective.arg_list):
+                gradient_sum += grad_linear(self, simulation.fields[simulation.pol], sources[False])
+            if any(arg.nl for arg in self.objective.arg_list):
+                gradient_sum += grad_kerr(self, simulation.fields_nl[simulation.pol], sources[True])
+        finally:
+            self._filter_terms = None
 
         return gradient_sum
 
-    def check_deriv(self, Npts=5, d_rho=1e-3):
-        """ Returns a list of analytical and numerical derivatives to check grad accuracy"""
+    def check_deriv(self, Npts=5, d_rho=1e-3, method='auto'):
+        """ Returns a list of analytical and numerical derivatives to check grad accuracy
+            method='lowrank' reuses the factorization of A for each perturbed pixel
+            (see Simulation.solve_fields_lowrank), method='full' re-solves a copy of
+            the simulation.  method='auto' (default) uses 'lowrank' when one pixel of rho
+            changes few enough cells of eps through the filter, and 'full' otherwise
+            or for nonlinear objectives.
+            method='directional' compares directional derivatives along Npts random
+            directions over the whole design region instead (see _check_deriv_directional).
+        """
+
+        if method not in ('auto', 'lowrank', 'full', 'directional'):
+            raise ValueError("method must be one of 'auto', 'lowrank', 'full' or 'directional', given {}".format(method))
+        if method == 'directional':
+            return self._check_deriv_directional(Ndirs=Npts, d_rho=d_rho)
+        if not self.objective.is_linear():
+            method = 'full'
+        elif method == 'auto':
+            method = 'lowrank' if self._lowrank_fits() else 'full'
 
         self.fields_current = False
         self.simulation.eps_r = rho2eps(rho=self.simulation.rho, eps_m=self.eps_m, W=self.W,
@@ -126,19 +160,24 @@ class Optimization():
             # create a new, perturbed permittivity
             rho_new = copy.deepcopy(self.simulation.rho)
             rho_new[pt[0], pt[1]] += d_rho
-
-            # make a copy of the current simulation
-            sim_new = copy.deepcopy(self.simulation)
             eps_new = rho2eps(rho=rho_new, eps_m=self.eps_m, W=self.W,
                               eta=self.eta, beta=self.beta)
 
-            sim_new.rho = rho_new
-            sim_new.eps_r = eps_new
+            if method == 'lowrank':
+                # low rank update of the current solution, the simulation is not changed
+                fields = self.simulation.solve_fields_lowrank(eps_new)
+                J_new = self.objective.J(*[fields[arg.component] for arg in self.objective.arg_list])
 
-            self.fields_current = False
+            else:
+                # make a copy of the current simulation
+                sim_new = copy.deepcopy(self.simulation)
+                sim_new.rho = rho_new
+                sim_new.eps_r = eps_new
+
+                self.fields_current = False
 
-            # solve for the fields with this new permittivity
-            J_new = self.compute_J(sim_new)
+                # solve for the fields with this new permittivity
+                J_new = self.compute_J(sim_new)
 
             # compute the numerical grad
             grad_num = (J_new - J_orig) / d_rho
@@ -149,6 +188,63 @@ class Optimization():
 
         return avm_grads, num_grads
 
+    def _lowrank_fits(self, max_rank=LOWRANK_MAX_RANK):
+        # whether a pixel of rho changes few enough columns of A for a low rank update
+
+        support = np.max(np.diff(sp.csc_matrix(self.W).indptr))
+        if self.simulation.pol == 'Hz':
+            # eps enters A on the edges, so the neighbouring columns change too
+            support = 3*support
+        return support <= max_rank
+
+    def _check_deriv_directional(self, Ndirs=5, d_rho=1e-3):
+        """ Compares the adjoint gradient projected on random directions d (dJ . d) to the
+            central difference (J(rho + d_rho*d) - J(rho - d_rho*d)) / (2*d_rho).
+            This tests the whole chain (filter, projection, dA/deps, adjoint) for all
+            pixels at once, with two solves per direction.  Prints the error statistics.
+        """
+
+        if not np.any(self.design_region == 1):
+            raise ValueError("the design region is empty, there are no directions to check")
+
+        self.fields_current = False
+        self.simulation.eps_r = rho2eps(rho=self.simulation.rho, eps_m=self.eps_m, W=self.W,
+                                        eta=self.eta, beta=self.beta)
+        grad_avm = self.compute_dJ(self.simulation, self.design_region)
+
+        # the perturbed permittivities are solved on one copy of the simulation
+        sim_new = copy.deepcopy(self.simulation)
+
+        avm_grads = []
+        num_grads = []
+
+        for _ in range(Ndirs):
+
+            # random direction over the design region, normalized to a max step of d_rho
+            d = np.random.randn(*self.design_region.shape)*(self.design_region == 1)
+            d = d / np.max(np.abs(d))
+
+            J_pm = []
+            for sign in [1, -1]:
+                rho_new = self.simulation.rho + sign*d_rho*d
+                sim_new.rho = rho_new
+                sim_new.eps_r = rho2eps(rho=rho_new, eps_m=self.eps_m, W=self.W,
+                                        eta=self.eta, beta=self.beta)
+                self.fields_current = False
+                J_pm.append(self.compute_J(sim_new))
+
+            avm_grads.append(np.sum(grad_avm*d))
+            num_grads.append((J_pm[0] - J_pm[1]) / 2 / d_rho)
+
+        # the stored fields belong to sim_new now
+        self.fields_current = False
+
+        stats = deriv_error_stats(avm_grads, num_grads)
+        print('directional derivative check over {} directions: relative error max = {:.2e}, mean = {:.2e}, median = {:.2e}'.format(
+              Ndirs, stats['max'], stats['mean'], stats['median']))
+
+        return avm_grads, num_grads
+
     def _make_progressbar(self, N):
         """ Returns a progressbar to use during optimization"""
 
@@ -266,25 +362,23 @@ class Optimization():
 
         pbar = self._make_progressbar(self.Nsteps)
 
-        def _objfn(rho, *argv):
-            """ Returns objective function given some permittivity distribution"""
-
-            self._set_design_region(rho)
-            J = self.compute_J(self.simulation)
-
-            # return minus J because we technically will minimize
-            return -J
+        # the last evaluation, so that each distinct rho costs one forward and one adjoint solve
+        evaluation = {'rho': None, 'J': None, 'grad': None}
 
-        def _grad(rho,  *argv):
-            """ Returns full grad given some permittivity distribution"""
+        def _objfn_and_grad(rho, *argv):
+            """ Returns objective function and full grad given some permittivity distribution"""
 
-            self._set_design_region(rho)
+            if evaluation['rho'] is None or not np.array_equal(rho, evaluation['rho']):
+                self._set_design_region(rho)
 
-            # compute grad, extract design region, turn into vector, return
-            grad = self.compute_dJ(self.simulation, self.design_region)
-            grad_vec = self._get_design_region(grad)
+                # compute grad, extract design region, turn into vector (J comes from the same fields)
+                grad = self.compute_dJ(self.simulation, self.design_region)
+                evaluation['J'] = self.compute_J(self.simulation)
+                evaluation['grad'] = self._get_design_region(grad)
+                evaluation['rho'] = np.copy(rho)
 
-            return -grad_vec
+            # return minus J because we technically will minimize
+            return -evaluation['J'], -evaluation['grad']
 
         # this simple callback function gets run each iteration
         # keeps track of the current iteration step for the progressbar
@@ -292,10 +386,13 @@ class Optimization():
         iter_list = [0]
 
         def _update_iter_count(x_current):
-            J = self.compute_J(self.simulation)
+            (J, _) = _objfn_and_grad(x_current)
+            J = -J
             self._update_progressbar(pbar, iter_list[0], J)
             self.objfn_list.append(J)
-            self._set_design_region(x_current)
+            if self.max_ind_shift is not None:
+                # the source changes, so the stored evaluation does too
+                evaluation['rho'] = None
             self._set_source_amplitude()
             if self.temp_plt is not None:
                 if np.mod(iter_list[0], self.temp_plt.it_plot) == 0:
@@ -312,7 +409,7 @@ class Optimization():
         rho0 = np.reshape(rho0, (-1,))
 
         # minimize
-        (rho_final, _, _) = fmin_l_bfgs_b(_objfn, rho0, fprime=_grad, args=(), approx_grad=0,
+        (rho_final, _, _) = fmin_l_bfgs_b(_objfn_and_grad, rho0, fprime=None, args=(), approx_grad=0,
                             bounds=rho_bounds, m=10, factr=10,
                             pgtol=1e-15, epsilon=1e-08, iprint=-1,
                             maxfun=15000, maxiter=self.Nsteps, disp=self.verbose,
@@ -383,15 +480,14 @@ class Optimization():
         # Only update the rho if it actually differs from the current one
         # If it doesn't, we don't want to erase the stored fields
 
-        if np.linalg.norm(x - rho_vec[des_vec == 1])/np.linalg.norm(x) > 1e-10:
+        if not np.array_equal(x, rho_vec[des_vec == 1]):
             rho_vec[des_vec == 1] = x
             rho_new = np.reshape(rho_vec, self.simulation.rho.shape)
             self.simulation.rho = rho_new
             eps_new = rho2eps(rho=rho_new, eps_m=self.eps_m, W=self.W,
                               eta=self.eta, beta=self.beta)
             self.simulation.eps_r = eps_new
-
-        self.fields_current = False
+            self.fields_current = False
 
     def _get_design_region(self, spatial_array):
         """ Returns a vector of the elements of spatial_array that are in design_region"""
@@ -422,7 +518,7 @@ class Optimization():
                 ratio = self.max_ind_shift / max_dn
 
                 self.simulation.src = self.simulation.src * (np.sqrt(ratio) - epsilon)
-        self.fields_current = False
+            self.fields_current = False
 
     def _update_rho(self, grad, step_size):
         """ Manually updates the permittivity with the grad info """
@@ -466,36 +562,49 @@ class Optimization():
         ax.set_title('optimization results')
         return ax
 
-    def scan_frequency(self, Nf=50, df=1/20, pbar=True):
-        """ Scans the objective function vs. frequency """
+    def scan_frequency(self, Nf=50, df=1/20, pbar=True, processes=1,
+                       method='direct', tol=1e-4):
+        """ Scans the objective function vs. frequency
+            method='direct' solves each frequency, serially by default or in parallel on
+            'processes' worker processes (None for one per core, see angler.sweep.sweep_frequency).
+            method='reduced' solves a few frequencies to build a reduced order model
+            (see angler.reduced) with a relative residual below tol over the band, checked
+            at the scanned frequencies, and evaluates the objective from it.  Only for linear objective functions.
+        """
 
         # create frequencies (in Hz)
         delta_f = self.simulation.omega*df
         freqs = 1/2/np.pi*np.linspace(self.simulation.omega - delta_f/2,
                                       self.simulation.omega + delta_f/2,  Nf)
 
-        if pbar:
-            bar = progressbar.ProgressBar(max_value=Nf)
+        bar = progressbar.ProgressBar(max_value=Nf) if pbar else None
 
-        # loop through frequencies
-        objs = []
-        for i, f in enumerate(freqs):
+        if method == 'reduced':
+            if not self.objective.is_linear():
+                raise ValueError("the reduced order model only supports linear objective functions")
 
-            if pbar:
-                bar.update(i + 1)
+            omegas = 2*np.pi*freqs
+            model = ReducedModel(self.simulation, omegas[0], omegas[-1], tol=tol, omegas=omegas)
+            objs = []
+            for i, f in enumerate(freqs):
+                fields = model.fields(2*np.pi*f)
+                objs.append(self.objective.J(*[fields[arg.component] for arg in self.objective.arg_list]))
+                if bar is not None:
+                    bar.update(i + 1)
 
-            # make a new simulation object
-            sim_new = copy.deepcopy(self.simulation)
+        elif method == 'direct':
+            def _objfn(simulation):
+                # the stored fields are never current for a new frequency
+                self.fields_current = False
+                return self.compute_J(simulation)
 
-            # reset the simulation to compute new A (hacky way of doing it)
-            sim_new.omega = 2*np.pi*f
-            sim_new.eps_r = self.simulation.eps_r
+            objs = sweep.scan_frequency(self.simulation, freqs, _objfn, processes=processes, pbar=bar)
 
-            self.fields_current = False
+        else:
+            raise ValueError("method must be one of 'direct' or 'reduced', given {}".format(method))
 
-            # compute objective function and append to list
-            obj_fn = self.compute_J(sim_new)
-            objs.append(obj_fn)
+        # the stored fields (if any) are not the ones of self.simulation
+        self.fields_current = False
 
         # compute HM
         objs_array = np.array(objs)
@@ -518,10 +627,14 @@ class Optimization():
 
         return freqs, objs, FWHM
 
-    def scan_power(self, probes=None, Ns=50, s_min=1e-2, s_max=1e2, solver='newton'):
+    def scan_power(self, probes=None, Ns=50, s_min=1e-2, s_max=1e2, solver='newton',
+                   continuation=None):
         """ Scans the source amplitude and computes the objective function
             probes is a list of functions for computing the power, for example:
             [lambda simulation: simulation.flux_probe('x', [-NPML[0]-int(l/2/dl), ny + int(d/2/dl)], int(H/2/dl))]
+            continuation='natural' or 'arclength' normalizes the source once and follows
+            the nonlinear solution from one amplitude to the next (see continuation.py),
+            'arclength' also traces bistable branches (hysteresis).
         """
 
         if probes is None:
@@ -533,6 +646,11 @@ class Optimization():
 
         bar = progressbar.ProgressBar(max_value=Ns)
 
+        if continuation is not None:
+            (_, powers, transmissions) = power_sweep(self.simulation, s_list, probes,
+                                                     method=continuation, pbar=bar)
+            return list(powers), transmissions
+
         # transmission
         transmissions = [[] for _ in range(num_probes)]
         powers = []
@@ -550,23 +668,9 @@ class Optimization():
 
             powers.append(W_in)
 
-            if solver == 'hybrid':
-                # NOTE: sometimes a mix of born and newtons method (hybrid) works best.  dont know why yet
-
-                # compute the fields
-                (_,_,_,c) = sim_new.solve_fields_nl(timing=False, averaging=False,
-                            Estart=None, solver_nl='born', conv_threshold=1e-10,
-                            max_num_iter=100)
-
-                if c[-1] > 1e-10:
-                    # compute the fields
-                    (_,_,_,c) = sim_new.solve_fields_nl(timing=False, averaging=False,
-                                Estart=None, solver_nl='newton', conv_threshold=1e-10,
-                                max_num_iter=100)
-            else:
-                (_,_,_,c) = sim_new.solve_fields_nl(timing=False, averaging=False,
-                            Estart=None, solver_nl=solver, conv_threshold=1e-10,
-                            max_num_iter=100)
+            (_,_,_,c) = sim_new.solve_fields_nl(timing=False, averaging=False,
+                        Estart=None, solver_nl=solver, conv_threshold=1e-10,
+                        max_num_iter=100)
 
             # compute power transmission using each probe
             for probe_index, probe in enumerate(probes):
@@ -599,4 +703,19 @@ class Optimization():
             for the_file in os.listdir(folder):
                 file_path = os.path.join(folder, the_file)
                 if os.path.isfile(file_path):
-                    os.unlink(file_path)
\ No newline at end of file
+                    os.unlink(file_path)
+
+
+def deriv_error_stats(avm_grads, num_grads):
+    """ Relative errors between adjoint and numerical derivatives (as returned by check_deriv)
+        Returns a dictionary with the 'max', 'mean', 'median' relative errors and the list 'all'.
+    """
+
+    avm_grads = np.array(avm_grads)
+    num_grads = np.array(num_grads)
+    scale = np.maximum(np.abs(num_grads), np.finfo(float).tiny)
+    rel_errors = np.abs(avm_grads - num_grads) / scale
+    return {'max': np.max(rel_errors),
+            'mean': np.mean(rel_errors),
+            'median': np.median(rel_errors),
+            'all': rel_errors}
@@ -21,21 +21,18 @@ def create_sfactor(wrange, L0, s, omega, Nw, Nw_pml):
     # used to help construct the S matrices for the PML creation
 
     sfactor_array = np.ones(Nw, dtype=np.complex128)
-    if Nw_pml < 1:
+    if Nw_pml < 1 or s not in ('f', 'b'):
         return sfactor_array
     hw = np.diff(wrange)[0]/Nw
     dw = Nw_pml*hw
-    for i in range(0, Nw):
-        if s is 'f':
-            if i <= Nw_pml:
-                sfactor_array[i] = S(hw * (Nw_pml - i + 0.5), dw, omega, L0)
-            elif i > Nw - Nw_pml:
-                sfactor_array[i] = S(hw * (i - (Nw - Nw_pml) - 0.5), dw, omega, L0)
-        if s is 'b':
-            if i <= Nw_pml:
-                sfactor_array[i] = S(hw * (Nw_pml - i + 1), dw, omega, L0)
-            elif i > Nw - Nw_pml:
-                sfactor_array[i] = S(hw * (i - (Nw - Nw_pml) - 1), dw, omega, L0)
+
+    # distance into the PML, the forward grid is shifted by half a cell
+    offset = 0.5 if s == 'f' else 1
+    i = np.arange(Nw)
+    left = i <= Nw_pml
+    right = (i > Nw - Nw_pml) & ~left
+    sfactor_array[left] = S(hw*(Nw_pml - i[left] + offset), dw, omega, L0)
+    sfactor_array[right] = S(hw*(i[right] - (Nw - Nw_pml) - offset), dw, omega, L0)
     return sfactor_array
 
 
@@ -60,25 +57,11 @@ def S_create(omega, L0, N, Npml, xrange,
     s_vector_y_f = create_sfactor(yrange, L0, 'f', omega, Ny, Ny_pml)
     s_vector_y_b = create_sfactor(yrange, L0, 'b', omega, Ny, Ny_pml)
 
-    # Fill the 2D space with layers of appropriate s-factors
-    Sx_f_2D = np.zeros(N, dtype=np.complex128)
-    Sx_b_2D = np.zeros(N, dtype=np.complex128)
-    Sy_f_2D = np.zeros(N, dtype=np.complex128)
-    Sy_b_2D = np.zeros(N, dtype=np.complex128)
-
-    for i in range(0, Ny):
-        Sx_f_2D[:, i] = 1/s_vector_x_f
-        Sx_b_2D[:, i] = 1/s_vector_x_b
-
-    for i in range(0, Nx):
-        Sy_f_2D[i, :] = 1/s_vector_y_f
-        Sy_b_2D[i, :] = 1/s_vector_y_b
-
-    # Reshape the 2D s-factors into a 1D s-array
-    Sx_f_vec = Sx_f_2D.reshape((-1,))
-    Sx_b_vec = Sx_b_2D.reshape((-1,))
-    Sy_f_vec = Sy_f_2D.reshape((-1,))
-    Sy_b_vec = Sy_b_2D.reshape((-1,))
+    # Fill the 2D space with layers of appropriate s-factors, flattened (x is the slow index)
+    Sx_f_vec = np.repeat(1/s_vector_x_f, Ny)
+    Sx_b_vec = np.repeat(1/s_vector_x_b, Ny)
+    Sy_f_vec = np.tile(1/s_vector_y_f, Nx)
+    Sy_b_vec = np.tile(1/s_vector_y_b, Nx)
 
     # Construct the 1D total s-array into a diagonal matrix
     Sx_f = sp.spdiags(Sx_f_vec, 0, M, M, format=matrix_format)
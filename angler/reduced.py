@@ -0,0 +1,168 @@
+import numpy as np
+import numpy.polynomial.chebyshev as cheb
+
+from angler.sweep import light_copy
+
+""" REDUCED ORDER MODELS
+
+    For fine frequency sweeps (e.g. of high-Q resonances) the linear system
+        A(omega) x = b(omega),    A(omega) = K(omega) + omega^2 T,    b(omega) = 1j omega src
+    is projected onto a small basis V of full solutions x(omega_i) and their frequency
+    derivatives dx/domega(omega_i) at a few expansion points omega_i (Hermite moment matching).
+    The reduced system (V^H A(omega) V) y = V^H b(omega), with x ~ V y, is then solved
+    for each frequency at negligible cost.
+
+    T (the mass term) is diagonal and frequency independent, so V^H T V is exact.
+    K(omega) depends on omega only through the PML, smoothly, so V^H K V is interpolated
+    with Chebyshev polynomials over the band.
+
+    Expansion points are added adaptively, where the relative residual |A x - b| / |b|
+    of the reduced solution is the largest, until it is below tol at num_check points over
+    the band and (once those pass) at the midpoints between them and at the requested omegas,
+    so that a resonance narrower than the check spacing is not missed as easily.
+    The PML stretching is evaluated from its omega independent profile, so checking and
+    evaluating the model never rebuild the PML operators.
+"""
+
+
+class ReducedModel:
+    """ Reduced order model of the linear fields of a simulation for omega in [omega_min, omega_max] """
+
+    def __init__(self, simulation, omega_min, omega_max, tol=1e-4, max_points=10,
+                 num_cheb=8, num_check=21, omegas=None):
+
+        if omega_max <= omega_min:
+            raise ValueError("need omega_min < omega_max, given {} and {}".format(omega_min, omega_max))
+
+        # the residual is checked on a coarse grid, then between its points and at the requested omegas
+        candidates = np.linspace(omega_min, omega_max, num_check)
+        fine = (candidates[1:] + candidates[:-1])/2
+        if omegas is not None:
+            omegas = np.asarray(omegas, dtype=float).reshape((-1,))
+            if np.any(omegas < omega_min) or np.any(omegas > omega_max):
+                raise ValueError("the omegas to check must be in [omega_min, omega_max]")
+            fine = np.union1d(fine, omegas)
+
+        # a private copy, whose omega (and A) is changed to build the model
+        self.simulation = light_copy(simulation)
+        self.omega_min = omega_min
+        self.omega_max = omega_max
+        self.tol = tol
+        self.num_cheb = num_cheb
+
+        omega0 = self.simulation.omega
+        self.src = np.reshape(self.simulation.src, (-1,)).astype(np.complex128)
+        self.mass = self.simulation._mass_term()/omega0**2
+
+        self.points = []
+        self.V = np.zeros((self.src.size, 0), dtype=np.complex128)
+        self.error = np.inf
+
+        # start at the center and add points where the residual is largest
+        next_point = (omega_min + omega_max)/2
+        while True:
+            self._add_point(next_point)
+            self._project()
+            (self.error, next_point) = self._max_residual(candidates)
+            if self.error < tol:
+                (self.error, next_point) = self._max_residual(fine)
+            if self.error < tol or len(self.points) >= max_points:
+                break
+
+        if self.error > tol:
+            print("the reduced model did not reach tol={} with {} points, error estimate is {}".format(tol, max_points, self.error))
+
+    def _set_omega(self, omega):
+        if self.simulation.omega != omega:
+            self.simulation.omega = omega
+
+    def _max_residual(self, omegas):
+        # the largest residual over omegas, and where it is
+        residuals = np.array([self.residual(omega) for omega in omegas])
+        return (np.max(residuals), omegas[np.argmax(residuals)])
+
+    def _add_point(self, omega):
+        # adds x(omega) and dx/domega(omega) to the basis
+
+        # dA/domega, assembled analytically (omega^2 T and the PML stretching)
+        self._set_omega(omega)
+        dA = self.simulation._system.omega_derivative(self.simulation.eps_r)
+        factors = self.simulation.factors
+        x = factors.solve(1j*omega*self.src)
+        # A x' = b' - A' x
+        dx = factors.solve(1j*self.src - dA.dot(x))
+        self.simulation.clear_factors()
+
+        self.points.append(omega)
+        self.V = _orthonormalize(self.V, np.stack((x, dx), axis=1))
+
+    def _project(self):
+        # computes V^H T V and the Chebyshev interpolant of V^H K(omega) V
+
+        sim = self.simulation
+        V = self.V
+        r = V.shape[1]
+        self.T_r = np.conj(V.T).dot(self.mass[:, None]*V)
+        self.src_r = np.conj(V.T).dot(self.src)
+
+        nodes = np.cos(np.pi*(np.arange(self.num_cheb) + 0.5)/self.num_cheb)
+        K_r = np.zeros((self.num_cheb, r*r), dtype=np.complex128)
+        for i, t in enumerate(nodes):
+            omega = self._omega(t)
+            AV = sim._system.build_at(omega, sim.eps_r).dot(V) - omega**2*self.mass[:, None]*V
+            K_r[i, :] = np.conj(V.T).dot(AV).reshape((-1,))
+        self.K_coeffs = cheb.chebfit(nodes, K_r, self.num_cheb - 1)
+
+    def _omega(self, t):
+        # maps t in [-1, 1] to the band
+        return (self.omega_min + self.omega_max)/2 + t*(self.omega_max - self.omega_min)/2
+
+    def _t(self, omega):
+        return (2*omega - self.omega_min - self.omega_max)/(self.omega_max - self.omega_min)
+
+    def solve_reduced(self, omega):
+        # coefficients y of the solution x ~ V y at omega
+
+        r = self.V.shape[1]
+        K_r = cheb.chebval(self._t(omega), self.K_coeffs).reshape((r, r))
+        return np.linalg.solve(K_r + omega**2*self.T_r, 1j*omega*self.src_r)
+
+    def solve(self, omega):
+        # approximate solution of A(omega) x = b(omega), flattened
+        return self.V.dot(self.solve_reduced(omega))
+
+    def residual(self, omega):
+        # relative residual of the reduced solution in the full system (costs one sparse matvec)
+
+        sim = self.simulation
+        b = 1j*omega*self.src
+        Ax = sim._system.dot_at(omega, sim.eps_r, self.solve(omega))
+        return np.linalg.norm(Ax - b)/np.linalg.norm(b)
+
+    def fields(self, omega, averaging=False):
+        # dictionary of the (linear) field components at omega
+
+        sim = self.simulation
+        derivs = sim._system.derivs_at(omega)
+        F = sim._fields_from_X(self.solve(omega), sim.eps_r, averaging=averaging,
+                               omega=omega, derivs=derivs)
+        if sim.pol == 'Hz':
+            return dict(zip(('Ex', 'Ey', 'Hz'), F))
+        else:
+            return dict(zip(('Hx', 'Hy', 'Ez'), F))
+
+
+def _orthonormalize(V, X, drop_tol=1e-10):
+    # appends the columns of X to the orthonormal columns of V (Gram-Schmidt, twice)
+    # columns that are (numerically) in the span of V are dropped
+
+    for i in range(X.shape[1]):
+        x = X[:, i]
+        norm = np.linalg.norm(x)
+        if norm == 0:
+            continue
+        for _ in range(2):
+            x = x - V.dot(np.conj(V.T).dot(x))
+        if np.linalg.norm(x) > drop_tol*norm:
+            V = np.hstack((V, (x/np.linalg.norm(x))[:, None]))
+    return V
@@ -2,9 +2,10 @@ import numpy as np
 import scipy.sparse as sp
 from copy import deepcopy
 
-from angler.linalg import construct_A, solver_direct, grid_average
+from angler.linalg import SystemMatrix, solver_direct, grid_average, get_solver
 from angler.derivatives import unpack_derivs
-from angler.nonlinear_solvers import born_solve, newton_solve, newton_krylov_solve
+from angler.nonlinear_solvers import (born_solve, anderson_solve, newton_solve, hybrid_solve, chord_solve,
+                                      schur_solve, newton_krylov_solve)
 from angler.source.mode import mode
 from angler.nonlinearity import Nonlinearity
 from angler.constants import (DEFAULT_LENGTH_SCALE, DEFAULT_MATRIX_FORMAT,
@@ -12,12 +13,18 @@ from angler.constants import (DEFAULT_LENGTH_SCALE, DEFAULT_MATRIX_FORMAT,
 from angler.filter import eps2rho
 from angler.plot import plt_base_eps, plt_base
 
+# largest number of changed columns of A solved by a low rank update in solve_fields_lowrank
+LOWRANK_MAX_RANK = 50
+
 class Simulation:
 
-    def __init__(self, omega, eps_r, dl, NPML, pol, L0=DEFAULT_LENGTH_SCALE):
+    def __init__(self, omega, eps_r, dl, NPML, pol, L0=DEFAULT_LENGTH_SCALE,
+                 solver=DEFAULT_SOLVER, solver_options=None):
         # initializes Fdfd object
 
         self.L0 = L0
+        self.solver = solver
+        self.solver_options = {} if solver_options is None else solver_options
         self.omega = omega
         self.NPML = NPML
         self.pol = pol
@@ -51,39 +58,83 @@ class Simulation:
         self.modes = []
         self.nonlinearity = []
         self.eps_nl = np.zeros(eps_r.shape)
-        self.dnl_de = np.zeros(eps_r.shape)
+        self.dnl_de = np.zeros(eps_r.shape, dtype=np.complex128)
         self.dnl_deps = np.zeros(eps_r.shape)
+        self._nl_index = np.zeros(0, dtype=int)
 
-    def setup_modes(self):
-        # calculates
+    def setup_modes(self, normalization=None):
+        # calculates the mode sources and input power
+        # normalization='analytic' computes the input power from the 1D mode (exact for Ez),
+        # 'full' with a 2D straight waveguide simulation.  The default is 'analytic' for Ez, 'full' for Hz
         for modei in self.modes:
-            modei.setup_src(self)
+            modei.setup_src(self, normalization=normalization)
 
     def add_mode(self, neff, direction_normal, center, width,
-                 scale=1, order=1):
+                 scale=1, order=1, mode_solver='tridiagonal'):
         # adds a mode definition to the simulation
+        # the order-th mode closest to neff, mode_solver='arpack' finds it with a sparse eigensolver
         new_mode = mode(neff, direction_normal, center, width,
-                        scale=scale, order=order)
+                        scale=scale, order=order, solver=mode_solver)
         self.modes.append(new_mode)
 
     def compute_nl(self, e, matrix_format=DEFAULT_MATRIX_FORMAT):
         # evaluates the nonlinear functions for a field e
-        self.eps_nl = np.zeros(self.eps_r.shape)
-        self.dnl_de = np.zeros(self.eps_r.shape)
-        self.dnl_deps = np.zeros(self.eps_r.shape)
-        for nli in self.nonlinearity:
-            self.eps_nl = self.eps_nl + nli.eps_nl(e, self.eps_r)
-            self.dnl_de = self.dnl_de + nli.dnl_de(e, self.eps_r)
-            self.dnl_deps = self.dnl_deps + nli.dnl_deps(e, self.eps_r)
+        # eps_nl, dnl_de, dnl_deps and the diagonal of Anl are overwritten in place,
+        # and only on the nonlinear regions (they are zero elsewhere)
         Nbig = self.Nx*self.Ny
-        Anl = sp.spdiags(self.omega**2*EPSILON_0*self.L0*self.eps_nl.reshape((-1,)), 0, Nbig, Nbig, format=matrix_format)
-        self.Anl = Anl
+        # eps_r can be complex (e.g. from a complex filter), then so are eps_nl and dnl_deps
+        dtype = np.result_type(self.eps_r.dtype, np.float64)
+        if self.eps_nl.shape != self.eps_r.shape or self.eps_nl.dtype != dtype or self.dnl_de.dtype != np.complex128:
+            self.eps_nl = np.zeros(self.eps_r.shape, dtype=dtype)
+            self.dnl_de = np.zeros(self.eps_r.shape, dtype=np.complex128)
+            self.dnl_deps = np.zeros(self.eps_r.shape, dtype=dtype)
+            self._nl_index = np.zeros(0, dtype=int)
+            self.Anl = None
+
+        (eps_nl, dnl_de, dnl_deps) = (self.eps_nl.reshape((-1,)), self.dnl_de.reshape((-1,)),
+                                      self.dnl_deps.reshape((-1,)))
+
+        # clear where the last call wrote
+        index_prev = self._nl_index
+        eps_nl[index_prev] = 0
+        dnl_de[index_prev] = 0
+        dnl_deps[index_prev] = 0
+
+        for nli in self.nonlinearity:
+            nli.add_to(e, self.eps_r, eps_nl, dnl_de, dnl_deps)
+        indices = [nli.index for nli in self.nonlinearity]
+        if len(indices) == 1:
+            self._nl_index = indices[0]
+        else:
+            self._nl_index = np.unique(np.concatenate([np.zeros(0, dtype=int)] + indices))
+
+        # the diagonal is stored explicitly, so its values are rewritten in place
+        Anl = getattr(self, 'Anl', None)
+        if matrix_format != 'csr' or Anl is None or Anl.format != 'csr' or Anl.nnz != Nbig or Anl.dtype != dtype:
+            diagonal = np.arange(Nbig)
+            Anl = sp.csr_matrix((np.zeros(Nbig, dtype=dtype), diagonal, np.arange(Nbig + 1)), shape=(Nbig, Nbig))
+        index = self._nl_index if index_prev is self._nl_index else np.union1d(index_prev, self._nl_index)
+        Anl.data[index] = self.omega**2*EPSILON_0*self.L0*eps_nl[index]
+        self.Anl = Anl.asformat(matrix_format)
 
     def add_nl(self, chi, nl_region, nl_type='kerr', eps_scale=False, eps_max=None):
         # adds a nonlinearity to the simulation
         new_nl = Nonlinearity(chi/np.square(self.L0), nl_region, nl_type, eps_scale, eps_max)
         self.nonlinearity.append(new_nl)
 
+    @property
+    def omega(self):
+        return self.__omega
+
+    @omega.setter
+    def omega(self, new_omega):
+
+        self.__omega = new_omega
+
+        # if the system matrix exists, it (and its factors) are now stale
+        if getattr(self, 'A', None) is not None:
+            self.eps_r = self.eps_r
+
     @property
     def eps_r(self):
         return self.__eps_r
@@ -101,33 +152,177 @@ class Simulation:
         self.Ny = Ny
 
         self.__eps_r = new_eps
-        (A, derivs) = construct_A(self.omega, self.xrange, self.yrange,
-                                  self.eps_r, self.NPML, self.pol, self.L0,
-                                  matrix_format=DEFAULT_MATRIX_FORMAT,
-                                  timing=False)
-        self.A = A
-        self.derivs = derivs
+
+        # the pattern of A only depends on the grid and the PML, so when just
+        # eps_r (or omega) changed the values of A are rewritten in place
+        system = getattr(self, '_system', None)
+        if system is not None and getattr(self, 'A', None) is not None and \
+           system.matches(self.xrange, self.yrange, grid_shape, self.NPML, self.pol, self.L0):
+            if system.omega != self.omega:
+                system.set_omega(self.omega)
+            system.update(self.A, self.eps_r)
+        else:
+            system = SystemMatrix(self.omega, self.xrange, self.yrange, grid_shape,
+                                  self.NPML, self.pol, self.L0)
+            self.A = system.build(self.eps_r, matrix_format=DEFAULT_MATRIX_FORMAT)
+        self._system = system
+        self.derivs = system.derivs
+        self.clear_factors()
         self.fields = {f: None for f in ['Ex', 'Ey', 'Ez', 'Hx', 'Hy', 'Hz']}
         self.fields_nl = {f: None for f in ['Ex', 'Ey', 'Ez', 'Hx', 'Hy', 'Hz']}
 
+    @property
+    def factors(self):
+        # factorization of A, shared by the forward and adjoint solves
+        if self._factors is None:
+            backend = get_solver(self.solver, self.A)
+            options = dict(self.solver_options)
+            if backend.name == 'iterative':
+                options['mass'] = self._mass_term()
+                options['x_prev'] = self._x_prev
+            self._factors = backend(self.A, **options)
+        return self._factors
+
+    def clear_factors(self):
+        # drops the stored factorization of A (called whenever A changes)
+        # the last solutions are kept to warm start the iterative solver
+        self._x_prev = None
+        if getattr(self, '_factors', None) is not None:
+            self._x_prev = getattr(self._factors, 'x_prev', None)
+            self._factors.clear()
+        self._factors = None
+        self.clear_jacobian_nl()
+
+    def set_jacobian_nl(self, system):
+        # keeps the factored (real-equivalent) Jacobian of the last nonlinear solve, for the adjoint
+        if getattr(self, 'jacobian_nl', None) is not system:
+            self.clear_jacobian_nl()
+        self.jacobian_nl = system
+
+    def clear_jacobian_nl(self):
+        if getattr(self, 'jacobian_nl', None) is not None:
+            self.jacobian_nl.clear()
+        self.jacobian_nl = None
+
+    def _mass_term(self):
+        # diagonal omega^2 term of A, used by the shifted laplacian preconditioner
+        if self.pol == 'Ez':
+            return self.omega**2*EPSILON_0*self.L0*self.eps_r.reshape((-1,))
+        else:
+            return self.omega**2*MU_0*self.L0*np.ones(self.Nx*self.Ny)
+
     def solve_fields(self, include_nl=False, timing=False, averaging=False,
                      matrix_format=DEFAULT_MATRIX_FORMAT):
         # performs direct solve for A given source
 
-        EPSILON_0_ = EPSILON_0*self.L0
-        MU_0_ = MU_0*self.L0
-
         if include_nl==False:
             eps_tot = self.eps_r
-            X = solver_direct(self.A, self.src*1j*self.omega, timing=timing)
+            X = self.factors.solve(self.src*1j*self.omega, timing=timing)
         else:
             eps_tot = self.eps_r + self.eps_nl
-            X = solver_direct(self.A + self.Anl, self.src*1j*self.omega, timing=timing)
+            if self.factors.name == 'iterative':
+                # preconditioned with the linear A and warm started from the last iterate
+                X = self.factors.solve(self.src*1j*self.omega, timing=timing,
+                                       matrix=self.A + self.Anl)
+            else:
+                X = solver_direct(self.A + self.Anl, self.src*1j*self.omega,
+                                  timing=timing, solver=self.solver)
+
+        (Fx, Fy, Fz) = self._fields_from_X(X, eps_tot, averaging=averaging,
+                                           matrix_format=matrix_format)
+
+        if include_nl==False:
+            if self.pol == 'Hz':
+                self.fields['Ex'] = Fx
+                self.fields['Ey'] = Fy
+                self.fields['Hz'] = Fz
+            else:
+                self.fields['Hx'] = Fx
+                self.fields['Hy'] = Fy
+                self.fields['Ez'] = Fz
+
+        return (Fx, Fy, Fz)
+
+    def solve_fields_batch(self, src_list, timing=False, averaging=False,
+                           matrix_format=DEFAULT_MATRIX_FORMAT):
+        """ Solves the linear fields for several sources at once.
+            A is factored once and all sources are back-substituted as one block.
+            Returns a list with a dictionary of field components for each source.
+        """
+
+        M = self.Nx*self.Ny
+        B = np.zeros((M, len(src_list)), dtype=np.complex128)
+        for i, src in enumerate(src_list):
+            B[:, i] = np.reshape(src, (-1,))*1j*self.omega
+
+        X = self.factors.solve(B, timing=timing)
+
+        if self.pol == 'Hz':
+            components = ('Ex', 'Ey', 'Hz')
+        else:
+            components = ('Hx', 'Hy', 'Ez')
+
+        fields_list = []
+        for i in range(len(src_list)):
+            F = self._fields_from_X(X[:, i], self.eps_r, averaging=averaging,
+                                    matrix_format=matrix_format)
+            fields_list.append(dict(zip(components, F)))
+
+        return fields_list
+
+    def solve_fields_lowrank(self, eps_new, timing=False, averaging=False, max_rank=LOWRANK_MAX_RANK,
+                             matrix_format=DEFAULT_MATRIX_FORMAT):
+        """ Solves the linear fields for a permittivity eps_new that differs from eps_r
+            in only a few pixels, without changing the simulation or refactoring A.
+            A(eps_new) - A is nonzero in a few columns (U), so the stored factors of A
+            (and the stored linear field, if solved) are reused through the Woodbury identity,
+            at the cost of one back-substitution per changed column.
+            Falls back to a direct solve (with a warning) above max_rank columns.
+            Returns a dictionary of field components.
+        """
+
+        b = np.reshape(self.src*1j*self.omega, (-1,))
+        A_new = self._system.build(eps_new, matrix_format=DEFAULT_MATRIX_FORMAT)
+        dA = (A_new - self.A).tocsc()
+        dA.eliminate_zeros()
+        cols = np.flatnonzero(np.diff(dA.indptr))
+
+        if cols.size > max_rank:
+            print("the permittivity change touches {} columns of A (max_rank={}), solving directly".format(cols.size, max_rank))
+            X = solver_direct(A_new, b, timing=timing, solver=self.solver)
+        else:
+            # (A + U V^T)^-1 b = x - Z (I + V^T Z)^-1 V^T x, with x = A^-1 b, Z = A^-1 U
+            # here V^T just picks the entries in cols
+            if self.fields[self.pol] is not None:
+                X = np.reshape(self.fields[self.pol], (-1,))
+            else:
+                X = self.factors.solve(b, timing=timing)
+            if cols.size > 0:
+                Z = self.factors.solve(dA[:, cols].toarray(), timing=timing)
+                C = np.eye(cols.size) + Z[cols, :]
+                X = X - Z.dot(np.linalg.solve(C, X[cols]))
+
+        (Fx, Fy, Fz) = self._fields_from_X(X, eps_new, averaging=averaging,
+                                           matrix_format=matrix_format)
+
+        if self.pol == 'Hz':
+            return {'Ex': Fx, 'Ey': Fy, 'Hz': Fz}
+        else:
+            return {'Hx': Fx, 'Hy': Fy, 'Ez': Fz}
+
+    def _fields_from_X(self, X, eps_tot, averaging=False,
+                       matrix_format=DEFAULT_MATRIX_FORMAT, omega=None, derivs=None):
+        # computes all field components from the solved primary field X (Ez or Hz)
+        # at the simulation frequency, or at omega (with the derivs for that omega)
 
+        EPSILON_0_ = EPSILON_0*self.L0
+        MU_0_ = MU_0*self.L0
 
-        (Nx, Ny) = self.src.shape
+        (Nx, Ny) = (self.Nx, self.Ny)
         M = Nx*Ny
-        (Dyb, Dxb, Dxf, Dyf) = unpack_derivs(self.derivs)
+        X = np.reshape(X, (-1,))
+        (Dyb, Dxb, Dxf, Dyf) = unpack_derivs(self.derivs if derivs is None else derivs)
+        omega = self.omega if omega is None else omega
 
         if self.pol == 'Hz':
             if averaging:
@@ -144,33 +339,23 @@ class Simulation:
             T_eps_y_inv = sp.spdiags(1/vector_eps_y, 0, M, M,
                                   format=matrix_format)
 
-            ex =  1/1j/self.omega * T_eps_y_inv.dot(Dyb).dot(X)
-            ey = -1/1j/self.omega * T_eps_x_inv.dot(Dxb).dot(X)
+            ex =  1/1j/omega * T_eps_y_inv.dot(Dyb.dot(X))
+            ey = -1/1j/omega * T_eps_x_inv.dot(Dxb.dot(X))
 
             Ex = ex.reshape((Nx, Ny))
             Ey = ey.reshape((Nx, Ny))
             Hz = X.reshape((Nx, Ny))
 
-            if include_nl==False:
-                self.fields['Ex'] = Ex
-                self.fields['Ey'] = Ey
-                self.fields['Hz'] = Hz
-
             return (Ex, Ey, Hz)
 
         elif self.pol == 'Ez':
-            hx = -1/1j/self.omega/MU_0_ * Dyb.dot(X)
-            hy = 1/1j/self.omega/MU_0_ * Dxb.dot(X)
+            hx = -1/1j/omega/MU_0_ * Dyb.dot(X)
+            hy = 1/1j/omega/MU_0_ * Dxb.dot(X)
 
             Hx = hx.reshape((Nx, Ny))
             Hy = hy.reshape((Nx, Ny))
             Ez = X.reshape((Nx, Ny))
 
-            if include_nl==False:
-                self.fields['Hx'] = Hx
-                self.fields['Hy'] = Hy
-                self.fields['Ez'] = Ez
-
             return (Hx, Hy, Ez)
 
         else:
@@ -180,8 +365,12 @@ class Simulation:
                         timing=False, averaging=False,
                         Estart=None, solver_nl='hybrid', conv_threshold=1e-10,
                         max_num_iter=50,
-                        matrix_format=DEFAULT_MATRIX_FORMAT):
+                        matrix_format=DEFAULT_MATRIX_FORMAT, history=5):
         # solves for the nonlinear fields of the simulation.
+        # history is the number of previous iterates used by solver_nl='anderson'
+
+        # the Jacobian of a previous solve doesnt belong to the new fields
+        self.clear_jacobian_nl()
 
         # note: F just stands for the field component (could be H or E depending on polarization)
         if solver_nl == 'born':
@@ -189,11 +378,27 @@ class Simulation:
                                                   conv_threshold,
                                                   max_num_iter,
                                                   averaging=averaging)
+        elif solver_nl == 'anderson':
+            (Fx, Fy, Fz, conv_array) = anderson_solve(self, Estart,
+                                                      conv_threshold,
+                                                      max_num_iter,
+                                                      averaging=averaging,
+                                                      history=history)
         elif solver_nl == 'newton':
             (Fx, Fy, Fz, conv_array) = newton_solve(self, Estart,
                                                     conv_threshold,
                                                     max_num_iter,
                                                     averaging=averaging)
+        elif solver_nl == 'chord':
+            (Fx, Fy, Fz, conv_array) = chord_solve(self, Estart,
+                                                   conv_threshold,
+                                                   max_num_iter,
+                                                   averaging=averaging)
+        elif solver_nl == 'schur':
+            (Fx, Fy, Fz, conv_array) = schur_solve(self, Estart,
+                                                   conv_threshold,
+                                                   max_num_iter,
+                                                   averaging=averaging)
         elif solver_nl == 'LM':
             (Fx, Fy, Fz, conv_array) = LM_solve(self, Estart,
                                                 conv_threshold,
@@ -205,16 +410,13 @@ class Simulation:
                                                 max_num_iter,
                                                 averaging=averaging)
         elif solver_nl == 'hybrid':
-            (Fx, Fy, Fz, conv_array) = born_solve(self, Estart,
-                                              conv_threshold, 20,
-                                              averaging=averaging) 
-            if conv_array[-1] > 1e-10:
-                (Fx, Fy, Fz, conv_array) = newton_solve(self, Fz,
-                                                    conv_threshold, 20,
-                                                    averaging=averaging)                                       
+            (Fx, Fy, Fz, conv_array) = hybrid_solve(self, Estart,
+                                                    conv_threshold,
+                                                    max_num_iter,
+                                                    averaging=averaging)
         else:
             raise AssertionError("solver must be one of "
-                                 "{'born', 'newton', 'LM'}")
+                                 "{'born', 'anderson', 'newton', 'chord', 'schur', 'LM', 'krylov', 'hybrid'}")
 
             # return final nonlinear fields and an array of the convergences
 
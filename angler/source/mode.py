@@ -1,30 +1,78 @@
 import numpy as np
 import scipy.sparse as sp
+from collections import OrderedDict
 from copy import deepcopy
+from scipy.linalg import eigh_tridiagonal, eigvalsh_tridiagonal
 
 from angler.constants import *
 from angler.linalg import *
 
+# input powers (at unit scale) of the modes set up so far, by cross section
+_normalization_cache = OrderedDict()
+NORMALIZATION_CACHE_SIZE = 128
+
+# eigenmodes of the cross sections solved so far
+_mode_cache = OrderedDict()
+MODE_CACHE_SIZE = 128
+
 
 class mode:
 
-    def __init__(self, neff, direction_normal, center, width, scale, order=1):
+    def __init__(self, neff, direction_normal, center, width, scale, order=1, solver='tridiagonal'):
         self.neff = neff
         self.direction_normal = direction_normal
         self.center = center
         self.width = width
         self.order = order
         self.scale = scale
+        self.solver = solver
 
-    def setup_src(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT):
-        # compute the input power here using an only waveguide simulation
-        self.compute_normalization(simulation, matrix_format=matrix_format)
+    def setup_src(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT, normalization=None):
+        # compute the input power here
+        self.compute_normalization(simulation, matrix_format=matrix_format, normalization=normalization)
 
         # insert the mode into the waveguide
         self.insert_mode(simulation, simulation.src, matrix_format=matrix_format)
 
-    def compute_normalization(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT):
-        # creates a single waveguide simulation, solves the source, computes the power
+    def compute_normalization(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT, normalization=None):
+        # computes the input power of the mode and saves it in simulation.W_in
+        # 'analytic' integrates the poynting flux of the mode launched in a straight waveguide (1D)
+        # 'full' solves a straight waveguide simulation (2D)
+        # For Hz the source also launches other modes and radiation (through 1/eps in the x derivatives),
+        # so 'analytic' is only approximate there, by a few percent for narrow guides, and 'full' is the default
+
+        if normalization is None:
+            normalization = 'analytic' if simulation.pol == 'Ez' else 'full'
+        if normalization not in ('analytic', 'full'):
+            raise ValueError("normalization must be one of {{'analytic', 'full'}}, given {}".format(normalization))
+
+        (inds_x, inds_y) = self._slice_indices()
+        eps_r = simulation.eps_r[inds_x[0]:inds_x[1], inds_y[0]:inds_y[1]]
+        key = (normalization, eps_r.tobytes(), eps_r.shape, simulation.omega, simulation.pol,
+               self.width, self.order, self.neff, self.solver, self.direction_normal,
+               simulation.dl, simulation.L0)
+        if normalization == 'full':
+            # the 2D result also depends on the rest of the grid
+            key += (simulation.eps_r.shape, tuple(simulation.NPML), tuple(self.center),
+                    simulation.eps_r[self.center[0], :].tobytes() if self.direction_normal == 'x'
+                    else simulation.eps_r[:, self.center[1]].tobytes())
+
+        if key in _normalization_cache:
+            _normalization_cache.move_to_end(key)
+        else:
+            if normalization == 'analytic':
+                W_unit = self._normalization_analytic(simulation, matrix_format=matrix_format)
+            else:
+                W_unit = self._normalization_full(simulation, matrix_format=matrix_format)
+            _normalization_cache[key] = W_unit
+            if len(_normalization_cache) > NORMALIZATION_CACHE_SIZE:
+                _normalization_cache.popitem(last=False)
+
+        # save this value in the original simulation
+        simulation.W_in = _normalization_cache[key]*np.square(np.abs(self.scale))
+
+    def _normalization_full(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT):
+        # creates a single waveguide simulation, solves the source, computes the power (at unit scale)
 
         # get some information from the permittivity
         original_eps = simulation.eps_r
@@ -50,18 +98,65 @@ class mode:
 
         # reset the permittivity to be a straight waveguide, solve fields, compute power
         simulation_norm.eps_r = norm_eps
-        self.insert_mode(simulation_norm, simulation_norm.src, matrix_format=matrix_format)
+        simulation_norm.src = np.zeros(norm_eps.shape, dtype=np.complex128)
+        scale = self.scale
+        self.scale = 1
+        try:
+            self.insert_mode(simulation_norm, simulation_norm.src, matrix_format=matrix_format)
+        finally:
+            self.scale = scale
         simulation_norm.solve_fields()
-        W_in = simulation_norm.flux_probe(self.direction_normal, new_center, self.width)
+        return simulation_norm.flux_probe(self.direction_normal, new_center, self.width)
 
-        # save this value in the original simulation
-        simulation.W_in = W_in
+    def _normalization_analytic(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT):
+        # power (at unit scale) of the mode launched into a straight waveguide, measured where
+        # the 'full' normalization puts its probe.
+        # In a waveguide along x, the field of the source u(y) delta(x - x0) is g(x) u(y), where g solves
+        # the discrete 1D problem (Dxx + beta^2) g = c delta(x - x0), beta^2 being the eigenvalue of u.
+        # Its outgoing solution is g[n] = 1j c dl^2 / (2 sin(k dl)) exp(-1j k dl |n - n0|),
+        # with cos(k dl) = 1 - beta^2 dl^2 / 2.  The flux is then computed as in Simulation.flux_probe.
+        # (for Hz, c is the amplitude of the mode in the source, which also launches other modes,
+        # so this is an approximation there, see compute_normalization)
 
-    def insert_mode(self, simulation, destination, matrix_format=DEFAULT_MATRIX_FORMAT):
         EPSILON_0_ = EPSILON_0*simulation.L0
         MU_0_ = MU_0*simulation.L0
+        omega = simulation.omega
+        dl = simulation.dl
+
+        (beta2, u, vector_eps) = self.solve_mode(simulation, matrix_format=matrix_format)
+
+        if simulation.pol == 'Ez':
+            c = 1j*omega*MU_0_
+        else:
+            c = 1j*omega*np.sum(u*u)/np.sum(u*u/vector_eps)
+
+        # outgoing (decaying) branch of the discrete wavenumber
+        kdl = np.arccos(1 - beta2*dl**2/2 + 0j)
+        if np.imag(kdl) > 0:
+            kdl = -kdl
+        g = lambda n: 1j*c*dl**2/(2*np.sin(kdl))*np.exp(-1j*kdl*np.abs(n))
+
+        # probe position, relative to the source
+        if self.direction_normal == 'x':
+            n = simulation.Nx - 2*self.center[0]
+        else:
+            n = simulation.Ny - 2*self.center[1]
+
+        # field at the probe (averaged to the cell edge) and its backward derivative
+        F_avg = u*(g(n) + g(n + 1))/2
+        dF = u*(g(n) - g(n - 1))/dl
 
-        # first extract the slice of the permittivity
+        if simulation.pol == 'Ez':
+            H = dF/1j/omega/MU_0_
+            S = -1/2*np.real(F_avg*np.conj(H))
+        else:
+            E = -dF/1j/omega/vector_eps
+            S = 1/2*np.real(E*np.conj(F_avg))
+
+        return dl*np.sum(S)
+
+    def _slice_indices(self):
+        # indices of the cross section where the mode is inserted
         if self.direction_normal == "x":
             inds_x = [self.center[0], self.center[0]+1]
             inds_y = [int(self.center[1]-self.width/2), int(self.center[1]+self.width/2)]
@@ -70,37 +165,138 @@ class mode:
             inds_y = [self.center[1], self.center[1]+1]
         else:
             raise ValueError("The value of direction_normal is not x or y!")
+        return (inds_x, inds_y)
 
-        eps_r = simulation.eps_r[inds_x[0]:inds_x[1], inds_y[0]:inds_y[1]]
-        N = eps_r.size
-
-        Dxb = createDws('x', 'b', [simulation.dl], [N], matrix_format=matrix_format)
-        Dxf = createDws('x', 'f', [simulation.dl], [N], matrix_format=matrix_format)
+    def solve_mode(self, simulation, matrix_format=DEFAULT_MATRIX_FORMAT):
+        # solves for the mode of the cross section
+        # returns the eigenvalue (beta^2), the real mode profile (at unit scale) and EPSILON_0*eps_r on the slice
 
-        vector_eps = EPSILON_0_*eps_r.reshape((-1,))
-        vector_eps_x = EPSILON_0_*grid_average(eps_r, 'x').reshape((-1,))
-        T_eps = sp.spdiags(vector_eps, 0, N, N, format=matrix_format)
-        T_epsxinv = sp.spdiags(vector_eps_x**(-1), 0, N, N, format=matrix_format)
+        (inds_x, inds_y) = self._slice_indices()
+        eps_r = simulation.eps_r[inds_x[0]:inds_x[1], inds_y[0]:inds_y[1]]
 
-        if simulation.pol == 'Ez':
-            A = np.square(simulation.omega)*MU_0_*T_eps + Dxf.dot(Dxb)
+        (vals, vecs, vector_eps) = solve_modes(eps_r, simulation.omega, simulation.dl, simulation.pol,
+                                               simulation.L0, self.order, solver=self.solver,
+                                               neff=self.neff, matrix_format=matrix_format)
 
-        elif simulation.pol == 'Hz':
-            A = np.square(simulation.omega)*MU_0_*T_eps + T_eps.dot(Dxf).dot(T_epsxinv).dot(Dxb)
+        return (vals[self.order-1], vecs[:, self.order-1], vector_eps)
 
-        est_beta = simulation.omega*np.sqrt(MU_0_*EPSILON_0_)*self.neff
-        (vals, vecs) = solver_eigs(A, self.order, guess_value=np.square(est_beta))
+    def insert_mode(self, simulation, destination, matrix_format=DEFAULT_MATRIX_FORMAT):
 
-        if self.order == 1:
-            src = vecs
-        else:
-            src = vecs[:, self.order-1]
+        (inds_x, inds_y) = self._slice_indices()
+        (_, src, _) = self.solve_mode(simulation, matrix_format=matrix_format)
 
-        src *= self.scale
+        src = src*self.scale
 
         if self.direction_normal == 'x':
             src = src.reshape((1, -1))
-            destination[inds_x[0]:inds_x[1], inds_y[0]:inds_y[1]] = np.abs(src)*np.sign(np.real(src))
         else:
             src = src.reshape((-1, 1))
-            destination[inds_x[0]:inds_x[1], inds_y[0]:inds_y[1]] = np.abs(src)*np.sign(np.real(src))
+        destination[inds_x[0]:inds_x[1], inds_y[0]:inds_y[1]] = src
+
+
+def solve_modes(eps_r, omega, dl, pol, L0, num_modes, solver='tridiagonal', neff=None,
+                matrix_format=DEFAULT_MATRIX_FORMAT):
+    """ Solves for the first num_modes modes of a 1D cross section eps_r.
+        Returns the eigenvalues (beta^2), the real mode profiles (as columns) and EPSILON_0*eps_r.
+        solver='tridiagonal' uses a symmetric tridiagonal eigensolver.  Given neff, it returns the
+        num_modes modes with beta^2 closest to (neff omega/c)^2, nearest first, as the shift-invert
+        of solver='arpack' does.  Without neff it computes all the guided modes (and at least
+        num_modes) in one call, ordered by decreasing beta^2.
+        Here the ends of the cross section are closed instead of periodic, which only changes
+        modes that have not decayed there.
+        solver='arpack' uses shift-invert around the effective index neff.
+        Results are cached by cross section.
+    """
+
+    if solver not in ('tridiagonal', 'arpack'):
+        raise ValueError("solver must be one of {{'tridiagonal', 'arpack'}}, given {}".format(solver))
+
+    key = (eps_r.tobytes(), eps_r.shape, omega, dl, pol, L0, solver, neff)
+    if solver == 'arpack':
+        key += (num_modes,)
+
+    if key in _mode_cache and _mode_cache[key][0].size >= num_modes:
+        _mode_cache.move_to_end(key)
+        return _mode_cache[key]
+
+    EPSILON_0_ = EPSILON_0*L0
+    MU_0_ = MU_0*L0
+
+    N = eps_r.size
+    vector_eps = EPSILON_0_*eps_r.reshape((-1,))
+    vector_eps_x = EPSILON_0_*grid_average(eps_r, 'x').reshape((-1,))
+
+    if pol not in ('Ez', 'Hz'):
+        raise ValueError('Invalid polarization: {}'.format(str(pol)))
+
+    if solver == 'tridiagonal':
+        # guided modes are above the light line of the lowest permittivity
+        lower = np.square(omega)*MU_0_*np.min(vector_eps)
+
+        # diagonals of the operator below (without the periodic corners)
+        if pol == 'Ez':
+            d = np.square(omega)*MU_0_*vector_eps - 2/dl**2
+            e = np.ones(N - 1)/dl**2
+        else:
+            # A = T_eps (omega^2 MU_0 + Dxf T_epsxinv Dxb) is similar to the symmetric
+            # T_eps^1/2 (omega^2 MU_0 + Dxf T_epsxinv Dxb) T_eps^1/2, with eigenvectors T_eps^-1/2 u
+            inv_eps_x = 1/vector_eps_x
+            d = vector_eps*(np.square(omega)*MU_0_ - (inv_eps_x + np.roll(inv_eps_x, -1))/dl**2)
+            e = np.sqrt(vector_eps[:-1]*vector_eps[1:])*inv_eps_x[1:]/dl**2
+
+        if neff is not None:
+            # the num_modes eigenvalues closest to the shift are consecutive in the sorted spectrum
+            shift = np.square(omega*np.sqrt(MU_0_*EPSILON_0_)*neff)
+            num_modes = min(num_modes, N)
+            all_vals = eigvalsh_tridiagonal(d, e)
+            first = np.searchsorted(all_vals, shift)
+            (low, high) = (first, first)
+            while high - low < num_modes:
+                if high == N or (low > 0 and shift - all_vals[low - 1] <= all_vals[high] - shift):
+                    low -= 1
+                else:
+                    high += 1
+            (vals, vecs) = eigh_tridiagonal(d, e, select='i', select_range=(low, high - 1))
+            nearest = np.argsort(np.abs(vals - shift), kind='stable')
+            vals = vals[nearest]
+            vecs = vecs[:, nearest]
+        else:
+            upper = np.max(d) + 2*np.max(np.abs(e), initial=0)
+            vals = np.zeros(0)
+            if upper > lower:
+                (vals, vecs) = eigh_tridiagonal(d, e, select='v', select_range=(lower, upper))
+            if vals.size < num_modes:
+                (vals, vecs) = eigh_tridiagonal(d, e, select='i', select_range=(N - num_modes, N - 1))
+            vals = vals[::-1]
+            vecs = vecs[:, ::-1]
+        if np.any(vals[:num_modes] <= lower):
+            print("some of the {} modes requested are not guided, they depend on the ends of the cross section "
+                  "(closed here, periodic with solver='arpack')".format(num_modes))
+        if pol == 'Hz':
+            vecs = np.sqrt(vector_eps)[:, None]*vecs
+
+        # unit norm, with the largest entry positive
+        signs = np.sign(vecs[np.argmax(np.abs(vecs), axis=0), np.arange(vecs.shape[1])])
+        vecs = vecs*signs/np.linalg.norm(vecs, axis=0)
+
+    else:
+        Dxb = createDws('x', 'b', [dl], [N], matrix_format=matrix_format)
+        Dxf = createDws('x', 'f', [dl], [N], matrix_format=matrix_format)
+
+        T_eps = sp.spdiags(vector_eps, 0, N, N, format=matrix_format)
+        T_epsxinv = sp.spdiags(vector_eps_x**(-1), 0, N, N, format=matrix_format)
+
+        if pol == 'Ez':
+            A = np.square(omega)*MU_0_*T_eps + Dxf.dot(Dxb)
+        else:
+            A = np.square(omega)*MU_0_*T_eps + T_eps.dot(Dxf).dot(T_epsxinv).dot(Dxb)
+
+        est_beta = omega*np.sqrt(MU_0_*EPSILON_0_)*neff
+        (vals, vecs) = solver_eigs(A, num_modes, guess_value=np.square(est_beta))
+        vals = np.real(vals)
+        vecs = np.abs(vecs)*np.sign(np.real(vecs))
+
+    _mode_cache[key] = (vals, vecs, vector_eps)
+    if len(_mode_cache) > MODE_CACHE_SIZE:
+        _mode_cache.popitem(last=False)
+    return _mode_cache[key]
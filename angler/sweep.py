@@ -0,0 +1,111 @@
+import numpy as np
+import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+""" PARALLEL SWEEPS
+
+    Evaluates a function of the simulation at many frequencies, serially by default or
+    on a pool of processes if asked for (processes > 1 or None).  Each worker is sent a
+    stripped copy of the simulation once (its permittivity, sources and nonlinearities,
+    but no system matrix, operators, factors or fields), builds its system matrix from
+    it and then only receives frequencies.  Within a worker, changing the frequency reuses the sparsity
+    pattern and derivative operators of the previous one (see linalg.SystemMatrix).
+
+    Workers are forked where possible, so the function may be any callable (lambdas,
+    closures over an Optimization, ...).  Where fork is not available it must be picklable.
+"""
+
+# attributes that are rebuilt from eps_r in each worker instead of being copied
+_HEAVY_ATTRIBUTES = ('A', 'derivs', '_system', '_factors', '_x_prev', 'Anl', 'jacobian_nl',
+                     'fields', 'fields_nl')
+
+# state of a worker process: its simulation and the function to evaluate
+_worker = {}
+
+
+def _stripped_copy(simulation):
+    # copy of the simulation without the system matrix, operators, factors or fields (A is None)
+
+    stripped = copy.copy(simulation)
+    for attr in _HEAVY_ATTRIBUTES:
+        if hasattr(stripped, attr):
+            setattr(stripped, attr, None)
+    return copy.deepcopy(stripped)
+
+
+def _rebuild(simulation):
+    # setting eps_r constructs A (and resets the fields) again
+    simulation.eps_r = simulation.eps_r
+    return simulation
+
+
+def light_copy(simulation):
+    # copy of the simulation without the operators, factors or fields, with a new A
+    return _rebuild(_stripped_copy(simulation))
+
+
+def _init_worker(stripped, fn):
+    _worker['simulation'] = _rebuild(stripped)
+    _worker['fn'] = fn
+
+
+def _evaluate(simulation, fn, index, freq):
+    # evaluates the function at one frequency (Hz)
+    simulation.omega = 2*np.pi*freq
+    return (index, freq, fn(simulation))
+
+
+def _run_point(index, freq):
+    # evaluates the function at one frequency (Hz) in a worker
+    return _evaluate(_worker['simulation'], _worker['fn'], index, freq)
+
+
+def sweep_frequency(simulation, freqs, fn, processes=1):
+    """ Evaluates fn(simulation) at each frequency in freqs (Hz).
+        Results are yielded as (index, freq, fn(simulation)) as soon as they finish,
+        so not necessarily in order.  The simulation passed in is not modified.
+        processes is the number of worker processes, processes=1 (default) runs serially
+        in this process and processes=None uses one per core.
+        Note: workers are forked where possible.  Forking a process whose BLAS (MKL, OpenBLAS)
+        or scipy threads have already started can deadlock, and each worker holds its own
+        copy of the simulation, so the memory grows with the number of processes.
+    """
+
+    freqs = np.asarray(freqs)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = max(1, min(processes, freqs.size))
+
+    # only the permittivity, geometry, sources and nonlinearities are copied (and sent to the workers)
+    stripped = _stripped_copy(simulation)
+
+    if processes == 1:
+        sim = _rebuild(stripped)
+        for index, freq in enumerate(freqs):
+            yield _evaluate(sim, fn, index, freq)
+        return
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                             initializer=_init_worker, initargs=(stripped, fn)) as pool:
+        futures = [pool.submit(_run_point, index, freq) for index, freq in enumerate(freqs)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def scan_frequency(simulation, freqs, fn, processes=1, pbar=None):
+    """ Like sweep_frequency, but returns the list of results in the order of freqs.
+        pbar is an optional progressbar, updated as the results come in.
+    """
+
+    results = [None]*len(freqs)
+    for count, (index, _, result) in enumerate(sweep_frequency(simulation, freqs, fn, processes=processes)):
+        results[index] = result
+        if pbar is not None:
+            pbar.update(count + 1)
+    return results
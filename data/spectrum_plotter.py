@@ -6,6 +6,7 @@ import matplotlib.pylab as plt
 from string import ascii_lowercase
 
 from angler import Optimization as optimization
+from angler import sweep
 from device_saver import load_device
 
 """ Opens a device and prints its stored stats for the paper"""
@@ -29,7 +30,7 @@ def apply_sublabels(axs, invert_color_inds, x=19, y=-5, size='large', ha='right'
                     verticalalignment=va)
 
 
-def scan_frequency(D, probe, Nf=300, df=1/200, pbar=True):
+def scan_frequency(D, probe, Nf=300, df=1/200, pbar=True, processes=1):
     """ Scans the objective function vs. frequency """
 
     # create frequencies (in Hz)
@@ -37,32 +38,19 @@ def scan_frequency(D, probe, Nf=300, df=1/200, pbar=True):
     freqs = 1/2/np.pi*np.linspace(D.simulation.omega - delta_f/2,
                                   D.simulation.omega + delta_f/2,  Nf)
 
-    if pbar:
-        bar = progressbar.ProgressBar(max_value=Nf)
+    bar = progressbar.ProgressBar(max_value=Nf) if pbar else None
 
     (_, _, E_prev) = D.simulation.solve_fields()
 
-    # loop through frequencies
-    spectrum = []
-    for i, f in enumerate(freqs):
-
-        if pbar:
-            bar.update(i + 1)
-
-        # make a new simulation object
-        sim_new = copy.deepcopy(D.simulation)
-
-        # reset the simulation to compute new A (hacky way of doing it)
-        sim_new.omega = 2*np.pi*f
-        sim_new.eps_r = D.simulation.eps_r
-
+    def transmission(simulation):
         # # solve fields
-        # _ = sim_new.solve_fields()
-        _ = sim_new.solve_fields_nl(Estart=E_prev)
+        # _ = simulation.solve_fields()
+        _ = simulation.solve_fields_nl(Estart=E_prev)
+        return probe(simulation) / D.W_in
 
-        # compute objective function and append to list
-        transmission = probe(sim_new) / D.W_in
-        spectrum.append(transmission)
+    # frequencies are solved serially by default, or in parallel on that many worker processes
+    spectrum = sweep.scan_frequency(D.simulation, freqs, transmission,
+                                    processes=processes, pbar=bar)
 
     return freqs, spectrum
 
@@ -0,0 +1,71 @@
+import unittest
+import numpy as np
+import copy
+from numpy.testing import assert_allclose
+
+from angler import Simulation
+from angler.continuation import power_sweep
+
+
+class TestContinuation(unittest.TestCase):
+    """ Tests the power sweeps by continuation on a bistable Kerr cavity """
+
+    def setUp(self):
+
+        n0 = 3.4
+        omega = 2*np.pi*200e12
+        dl = 0.02
+        chi3 = 2.8e-14
+
+        (Nx, Ny) = (110, 50)
+        width = 15
+        yc = int(Ny/2)
+
+        # a waveguide cavity between two air gaps, filled with kerr material
+        eps_r = np.ones((Nx, Ny))
+        eps_r[:, yc-int(width/2):yc+int(width/2)+1] = np.square(n0)
+        eps_r[35:38, :] = 1
+        eps_r[68:71, :] = 1
+        nl_region = np.zeros((Nx, Ny))
+        nl_region[38:68, yc-int(width/2):yc+int(width/2)+1] = 1
+
+        self.simulation = Simulation(omega, eps_r, dl, [10, 10], 'Ez')
+        self.simulation.add_mode(n0, 'x', [15, yc], 2*width)
+        self.simulation.setup_modes()
+        self.simulation.add_nl(chi3, nl_region, eps_scale=True, eps_max=np.max(eps_r))
+
+        self.probe = lambda simulation: simulation.flux_probe('x', [Nx-15, yc], 2*width, nl=True)
+
+    def test_natural(self):
+        """ natural continuation gives the transmissions of independent solves """
+
+        s_list = np.logspace(-1, 1, 4)
+        (scales, powers, transmissions) = power_sweep(self.simulation, s_list, [self.probe], method='natural')
+        assert_allclose(scales, s_list)
+
+        for i, s in enumerate(s_list):
+            sim_new = copy.deepcopy(self.simulation)
+            sim_new.modes[0].scale = s
+            sim_new.modes[0].setup_src(sim_new)
+            sim_new.solve_fields_nl(solver_nl='newton', conv_threshold=1e-10, max_num_iter=100)
+            assert_allclose(powers[i], sim_new.W_in, rtol=1e-6)
+            assert_allclose(transmissions[0][i], self.probe(sim_new)/sim_new.W_in, rtol=1e-6)
+
+    def test_arclength(self):
+        """ arc-length continuation follows the branch around the folds of the bistable region """
+
+        s_list = np.logspace(0, 1.4, 6)
+        (scales, _, transmissions) = power_sweep(self.simulation, s_list, [self.probe], method='arclength')
+
+        self.assertEqual(scales[0], s_list[0])
+        self.assertEqual(scales[-1], s_list[-1])
+        self.assertTrue(np.any(np.diff(scales) < 0))
+        self.assertEqual(len(transmissions[0]), len(scales))
+
+        # on the first point it agrees with the natural continuation
+        (_, _, transmissions_natural) = power_sweep(self.simulation, s_list[:2], [self.probe], method='natural')
+        assert_allclose(transmissions[0][0], transmissions_natural[0][0], rtol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()
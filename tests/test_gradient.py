@@ -3,9 +3,14 @@ import numpy as np
 from numpy.testing import assert_allclose
 import copy
 import sys
+from unittest import mock
 sys.path.append('..')
 from angler import Simulation, Optimization
+from angler.objective import Objective, obj_arg
+from angler.optimization import deriv_error_stats
 from angler.structures import three_port
+from angler.adjoint import adjoint_linear_Ez
+from angler.filter import get_W
 
 import autograd.numpy as npa
 
@@ -102,5 +107,127 @@ class TestGradient(unittest.TestCase):
 
         assert_allclose(avm_grads, num_grads, rtol=1e-03, atol=.1)
 
+
+class TestDirectionalDerivative(unittest.TestCase):
+
+    def setUp(self):
+
+        lambda0 = 2e-6
+        omega = 2*np.pi*3e8/lambda0
+        dl = 1.1e-1
+        NPML = [15, 15]
+        eps_m = 2.44**2
+        (L, H, w, d, l, spc) = (4, 4, .2, 4/2.44, 3, 2)
+
+        (eps_r, design_region) = three_port(L, H, w, d, dl, l, spc, NPML, eps_start=eps_m)
+        (Nx, Ny) = eps_r.shape
+
+        self.simulation = Simulation(omega, eps_r, dl, NPML, 'Ez')
+        self.simulation.add_mode(np.sqrt(eps_m), 'x', [NPML[0]+int(l/2/dl), Ny//2], int(H/2/dl), scale=100)
+        self.simulation.setup_modes()
+        self.simulation.init_design_region(design_region, eps_m)
+        self.simulation.add_nl(4.1e-19, copy.deepcopy(design_region), eps_scale=True, eps_max=eps_m)
+
+        J_top = np.zeros(eps_r.shape)
+        J_top[-NPML[0]-int(l/2/dl), :] = 1
+
+        def J(e, e_nl):
+            return npa.sum(npa.square(npa.abs(e))*J_top) - npa.sum(npa.square(npa.abs(e_nl))*J_top)
+
+        arg_list = [obj_arg('e', component='Ez', nl=False), obj_arg('e_nl', component='Ez', nl=True)]
+        self.optimization = Optimization(objective=Objective(J, arg_list), simulation=self.simulation,
+                                         design_region=design_region, eps_m=eps_m)
+
+    def test_directional(self):
+
+        avm_grads, num_grads = self.optimization.check_deriv(Npts=2, d_rho=1e-4, method='directional')
+        stats = deriv_error_stats(avm_grads, num_grads)
+        self.assertEqual(len(stats['all']), 2)
+        self.assertLess(stats['max'], 1e-4)
+
+
+class TestFilteredGradient(unittest.TestCase):
+    """ gradient through the filter and projection, with an objective of several field components """
+
+    def setUp(self):
+
+        np.random.seed(0)
+        (Nx, Ny) = (60, 50)
+        eps_m = 6
+        eps_r = np.ones((Nx, Ny))
+        eps_r[:, 22:28] = eps_m
+        design_region = np.zeros((Nx, Ny))
+        design_region[22:38, 15:35] = 1
+
+        self.simulation = Simulation(2*np.pi*200e12, eps_r, 0.05, [10, 10], 'Ez')
+        self.simulation.add_mode(np.sqrt(eps_m), 'x', [13, Ny//2], 20)
+        self.simulation.setup_modes()
+        self.simulation.init_design_region(design_region, eps_m)
+        self.simulation.rho = design_region*np.random.random((Nx, Ny))
+
+        probe = np.zeros((Nx, Ny))
+        probe[48, 15:35] = 1
+
+        def J(e, hy):
+            return npa.sum(npa.square(npa.abs(e))*probe) + 1e3*npa.sum(npa.square(npa.abs(hy))*probe)
+
+        arg_list = [obj_arg('e', component='Ez'), obj_arg('hy', component='Hy')]
+        self.optimization = Optimization(objective=Objective(J, arg_list), simulation=self.simulation,
+                                         design_region=design_region, eps_m=eps_m, R=3, beta=5)
+
+    def test_filtered_gradient(self):
+
+        avm_grads, num_grads = self.optimization.check_deriv(Npts=4, d_rho=1e-5, method='full')
+        assert_allclose(avm_grads, num_grads, rtol=1e-4, atol=1e-4*np.max(np.abs(num_grads)))
+
+    def test_lowrank(self):
+        """ the default check uses low rank updates for a small filter, and full solves for a large one """
+
+        optimization = self.optimization
+        with mock.patch.object(self.simulation, 'solve_fields_lowrank',
+                               wraps=self.simulation.solve_fields_lowrank) as lowrank:
+            avm_grads, num_grads = optimization.check_deriv(Npts=3, d_rho=1e-5)
+        self.assertEqual(lowrank.call_count, 3)
+        assert_allclose(avm_grads, num_grads, rtol=1e-4, atol=1e-4*np.max(np.abs(num_grads)))
+
+        optimization.W = get_W(*self.simulation.eps_r.shape, optimization.design_region,
+                               NPML=self.simulation.NPML, R=10)
+        self.assertFalse(optimization._lowrank_fits())
+
+    def test_directional_empty(self):
+
+        self.optimization.design_region = np.zeros(self.simulation.eps_r.shape)
+        with self.assertRaises(ValueError):
+            self.optimization.check_deriv(method='directional')
+
+    def test_single_adjoint(self):
+        """ the adjoint sources of all the linear arguments are solved for at once """
+
+        optimization = self.optimization
+        with mock.patch('angler.gradients.adjoint_linear_Ez', wraps=adjoint_linear_Ez) as adjoint:
+            grad_sum = optimization.compute_dJ(self.simulation, optimization.design_region)
+        self.assertEqual(adjoint.call_count, 1)
+
+        # the sum of the gradients of each argument
+        Ez = self.simulation.fields['Ez']
+        objective = optimization.objective
+        grads = [grad_fn(optimization, dJ, Ez, optimization.field_arg_list)
+                 for (grad_fn, dJ) in zip(objective.grad_fn_list, objective.dJ_list)]
+        assert_allclose(grad_sum, np.sum(grads, axis=0), rtol=1e-8, atol=1e-8*np.max(np.abs(grad_sum)))
+
+    def test_lbfgs_evaluations(self):
+        """ each design visited by L-BFGS costs one forward and one adjoint solve """
+
+        optimization = self.optimization
+        with mock.patch.object(self.simulation, 'solve_fields', wraps=self.simulation.solve_fields) as forward, \
+             mock.patch('angler.gradients.adjoint_linear_Ez', wraps=adjoint_linear_Ez) as adjoint:
+            optimization.run(method='lbfgs', Nsteps=3, verbose=False)
+
+        self.assertEqual(len(optimization.objfn_list), 3)
+        self.assertGreater(optimization.objfn_list[-1], optimization.objfn_list[0])
+        self.assertEqual(forward.call_count, adjoint.call_count)
+        self.assertLess(forward.call_count, 3*len(optimization.objfn_list))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,174 @@
+import unittest
+import numpy as np
+import scipy.sparse as sp
+from numpy.testing import assert_allclose
+
+from angler import Simulation
+import angler.linalg as linalg
+from angler.linalg import (SOLVER_BACKENDS, available_solvers, get_solver, factorize,
+                           select_solver, solver_direct, solver_complex2real,
+                           Complex2RealSystem)
+
+
+class TestLinearSolvers(unittest.TestCase):
+    """ Tests the registry of linear solver backends """
+
+    def setUp(self):
+
+        S = Simulation(2*np.pi*200e12, np.ones((60, 40)), 0.02, [10, 10], 'Ez')
+        self.A = S.A
+        self.b = np.random.random(self.A.shape[0]) + 1j*np.random.random(self.A.shape[0])
+
+    def test_registry(self):
+
+        for name in ['scipy', 'umfpack', 'pardiso', 'iterative']:
+            self.assertIn(name, SOLVER_BACKENDS)
+            caps = SOLVER_BACKENDS[name].capabilities
+            for cap in ['factor', 'solve', 'transpose', 'refactor']:
+                self.assertIn(cap, caps)
+
+        self.assertIn('scipy', available_solvers())
+
+        with self.assertRaises(ValueError):
+            get_solver('not_a_solver')
+
+    def test_backends(self):
+
+        for name in available_solvers():
+            factors = factorize(self.A, solver=name, tol=1e-12)
+            x = factors.solve(self.b)
+            x_T = factors.solve(self.b, transpose=True)
+            self.assertLess(np.linalg.norm(self.A.dot(x) - self.b)/np.linalg.norm(self.b), 1e-8)
+            self.assertLess(np.linalg.norm(self.A.T.dot(x_T) - self.b)/np.linalg.norm(self.b), 1e-8)
+
+            # refactoring a matrix with the same pattern
+            A2 = self.A.copy()
+            A2.data *= 1.01
+            factors.refactor(A2)
+            x2 = factors.solve(self.b)
+            self.assertLess(np.linalg.norm(A2.dot(x2) - self.b)/np.linalg.norm(self.b), 1e-8)
+            x2_T = factors.solve(self.b, transpose=True)
+            self.assertLess(np.linalg.norm(A2.T.dot(x2_T) - self.b)/np.linalg.norm(self.b), 1e-8)
+
+    def test_auto(self):
+
+        self.assertIn(select_solver(self.A), available_solvers())
+        self.assertEqual(get_solver('auto', self.A).name, select_solver(self.A))
+
+        # with no memory to spare, 'auto' should go iterative
+        available_memory = linalg.available_memory
+        linalg.available_memory = lambda: 1
+        try:
+            self.assertEqual(select_solver(self.A), 'iterative')
+        finally:
+            linalg.available_memory = available_memory
+
+    def test_complex2real(self):
+
+        M = self.A.shape[0]
+        A12 = sp.spdiags(np.random.random(M), 0, M, M, format='csr')
+        x = solver_complex2real(self.A, A12, self.b, solver='scipy')
+        residual = self.A.dot(x) + A12.dot(np.conj(x)) - self.b
+        self.assertLess(np.linalg.norm(residual)/np.linalg.norm(self.b), 1e-8)
+
+    def test_complex2real_refactor(self):
+
+        M = self.A.shape[0]
+        nl = np.zeros(M)
+        nl[:M//2] = 1e3
+
+        # the pattern is fixed by the first system, then only the values change
+        system = Complex2RealSystem(self.A, sp.spdiags(nl, 0, M, M, format='csr'), solver='scipy')
+        for i in range(3):
+            d = nl*np.random.random(M)*(1 + 1j)
+            A11 = self.A + sp.spdiags(d, 0, M, M, format='csr')
+            A12 = sp.spdiags(np.conj(d), 0, M, M, format='csr')
+            self.assertTrue(system.update(A11, A12))
+            x = system.solve(self.b)
+            residual = A11.dot(x) + A12.dot(np.conj(x)) - self.b
+            self.assertLess(np.linalg.norm(residual)/np.linalg.norm(self.b), 1e-8)
+
+        # entries outside of the pattern need a new system
+        A12 = sp.csr_matrix((np.ones(1), ([0], [M-1])), shape=(M, M))
+        self.assertFalse(system.update(self.A, A12))
+
+
+class TestOperators(unittest.TestCase):
+    """ Tests the PML and derivative operators """
+
+    def test_sfactor(self):
+        """ the vectorized s-factors agree with the cell by cell definition """
+
+        from angler.pml import create_sfactor, S
+
+        (omega, L0, wrange) = (2*np.pi*200e12, 1e-6, [-1, 1])
+        for (Nw, Nw_pml) in [(50, 10), (7, 4), (30, 0)]:
+            hw = np.diff(wrange)[0]/Nw
+            for (s, offset) in [('f', 0.5), ('b', 1)]:
+                expected = np.ones(Nw, dtype=np.complex128)
+                for i in range(Nw if Nw_pml > 0 else 0):
+                    if i <= Nw_pml:
+                        expected[i] = S(hw*(Nw_pml - i + offset), Nw_pml*hw, omega, L0)
+                    elif i > Nw - Nw_pml:
+                        expected[i] = S(hw*(i - (Nw - Nw_pml) - offset), Nw_pml*hw, omega, L0)
+                assert_allclose(create_sfactor(wrange, L0, s, omega, Nw, Nw_pml), expected, rtol=1e-14)
+
+    def test_omega_derivative(self):
+        """ the analytic dA/domega agrees with central differences of A """
+
+        omega = 2*np.pi*200e12
+        eps_r = 1 + 11*np.random.random((40, 30))
+        for pol in ['Ez', 'Hz']:
+            system = linalg.SystemMatrix(omega, [-0.4, 0.4], [-0.3, 0.3], eps_r.shape, [10, 10], pol, 1e-6)
+            dA = system.omega_derivative(eps_r)
+
+            h = 1e-4*omega
+            system.set_omega(omega + h)
+            A_plus = system.build(eps_r)
+            system.set_omega(omega - h)
+            A_minus = system.build(eps_r)
+            dA_num = (A_plus - A_minus)/(2*h)
+            assert_allclose(dA.toarray(), dA_num.toarray(), rtol=1e-6, atol=1e-7*np.max(np.abs(dA_num)))
+
+    def test_build_at(self):
+        """ A, A.x and the derivatives at another omega (without the cache) agree with set_omega() """
+
+        omega = 2*np.pi*200e12
+        eps_r = 1 + 11*np.random.random((40, 30))
+        x = np.random.random(40*30) + 1j*np.random.random(40*30)
+        for pol in ['Ez', 'Hz']:
+            system = linalg.SystemMatrix(omega, [-0.4, 0.4], [-0.3, 0.3], eps_r.shape, [10, 10], pol, 1e-6)
+            linalg._operator_cache.clear()
+            A = system.build_at(1.1*omega, eps_r)
+            Ax = system.dot_at(1.1*omega, eps_r, x)
+            derivs = system.derivs_at(1.1*omega)
+            self.assertEqual(len(linalg._operator_cache), 0)
+            self.assertEqual(system.omega, omega)
+
+            system.set_omega(1.1*omega)
+            A_expected = system.build(eps_r)
+            assert_allclose(A.toarray(), A_expected.toarray(), rtol=1e-12, atol=1e-12*np.max(np.abs(A_expected)))
+            assert_allclose(Ax, A_expected.dot(x), rtol=1e-10, atol=1e-12*np.max(np.abs(Ax)))
+            for name, D in derivs.items():
+                D_expected = system.derivs[name]
+                assert_allclose(D.dot(x), D_expected.dot(x), rtol=1e-12, atol=1e-12*np.max(np.abs(D_expected)))
+
+    def test_operator_cache(self):
+        """ the operators are memoized by grid and frequency, with bounded size """
+
+        linalg._operator_cache.clear()
+        args = (1e-6, (60, 40), [10, 10], [-0.6, 0.6], [-0.4, 0.4])
+        ops = linalg.create_operators(2*np.pi*200e12, *args)
+        self.assertIs(linalg.create_operators(2*np.pi*200e12, *args)[4], ops[4])
+
+        (A, derivs) = linalg.construct_A(2*np.pi*200e12, args[3], args[4], np.ones(args[1]), args[2], 'Ez', args[0])
+        self.assertIs(derivs['Dxf'], ops[4])
+
+        for i in range(linalg.OPERATOR_CACHE_SIZE + 1):
+            linalg.create_operators(2*np.pi*(201 + i)*1e12, *args)
+        self.assertLessEqual(len(linalg._operator_cache), linalg.OPERATOR_CACHE_SIZE)
+        self.assertIsNot(linalg.create_operators(2*np.pi*200e12, *args)[4], ops[4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import unittest
+import numpy as np
+from numpy.testing import assert_allclose
+
+from angler import Simulation
+from angler.source import mode as mode_module
+
+
+class TestMode(unittest.TestCase):
+    """ Tests the mode sources and their normalization """
+
+    def setUp(self):
+
+        self.omega = 2*np.pi*200e12
+        self.dl = 0.02
+        (self.Nx, self.Ny) = (150, 100)
+        self.width = 20
+        self.eps_r = np.ones((self.Nx, self.Ny))
+        self.eps_r[:, 40:60] = 12
+
+    def _simulation(self, pol, scale=1):
+        simulation = Simulation(self.omega, self.eps_r, self.dl, [15, 15], pol)
+        simulation.add_mode(np.sqrt(12), 'x', [25, 50], 3*self.width, scale=scale)
+        return simulation
+
+    def test_normalization(self):
+        """ the analytic input power agrees with the one from a 2D straight waveguide """
+
+        for (pol, rtol) in [('Ez', 1e-4), ('Hz', 2e-2)]:
+            simulation = self._simulation(pol, scale=3)
+            simulation.setup_modes(normalization='full')
+            W_full = simulation.W_in
+            src_full = np.copy(simulation.src)
+
+            simulation.src = np.zeros(self.eps_r.shape, dtype=np.complex128)
+            simulation.setup_modes(normalization='analytic')
+            assert_allclose(simulation.W_in, W_full, rtol=rtol)
+            assert_allclose(np.abs(simulation.src), np.abs(src_full), atol=1e-6*np.max(np.abs(src_full)))
+
+    def test_normalization_narrow(self):
+        """ for a narrow guide, the default input power agrees with the 2D one (which it is for Hz) """
+
+        eps_r = np.ones((self.Nx, self.Ny))
+        eps_r[:, 45:55] = 12
+        for (pol, rtol) in [('Ez', 1e-5), ('Hz', 1e-12)]:
+            W_in = {}
+            for normalization in [None, 'full']:
+                simulation = Simulation(self.omega, eps_r, self.dl, [15, 15], pol)
+                simulation.add_mode(np.sqrt(12), 'x', [25, 50], 80)
+                simulation.setup_modes(normalization=normalization)
+                W_in[normalization] = simulation.W_in
+            assert_allclose(W_in[None], W_in['full'], rtol=rtol)
+
+    def test_normalization_cache(self):
+        """ the normalization is reused for the same cross section and scales with the amplitude """
+
+        mode_module._normalization_cache.clear()
+        simulation = self._simulation('Ez')
+        simulation.setup_modes()
+        W_in = simulation.W_in
+        self.assertEqual(len(mode_module._normalization_cache), 1)
+
+        simulation.modes[0].scale = 2
+        simulation.setup_modes()
+        self.assertEqual(len(mode_module._normalization_cache), 1)
+        assert_allclose(simulation.W_in, 4*W_in)
+
+        # a different frequency is a different cross section
+        simulation.omega = 1.1*self.omega
+        simulation.setup_modes()
+        self.assertEqual(len(mode_module._normalization_cache), 2)
+
+    def test_solve_modes(self):
+        """ the tridiagonal mode solver agrees with arpack and returns all orders at once """
+
+        for pol in ['Ez', 'Hz']:
+            for eps_slice in [self.eps_r[25:26, 5:95], self.eps_r[25:26, 5:95].T]:
+                mode_module._mode_cache.clear()
+                (vals, vecs, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 2)
+                self.assertGreaterEqual(vals.size, 2)
+                self.assertTrue(np.all(np.diff(vals) < 0))
+
+                # they differ by the (periodic or closed) ends of the slice, more for weakly guided modes
+                for (order, rtol) in [(1, 1e-6), (2, 2e-3)]:
+                    (vals_arpack, vecs_arpack, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, order,
+                                                                            solver='arpack', neff=np.sqrt(12))
+                    assert_allclose(vals[order-1], vals_arpack[order-1], rtol=rtol)
+                assert_allclose(np.abs(vecs[:, 0]), np.abs(vecs_arpack[:, 0]), atol=1e-4)
+
+                # the second call is served from the cache
+                self.assertIs(mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 1)[0], vals)
+
+    def test_solve_modes_neff(self):
+        """ given neff, the tridiagonal mode solver picks the same guided modes as arpack """
+
+        eps_slice = self.eps_r[25:26, 5:95]
+        # the weakly guided second Hz mode reaches the (periodic or closed) ends of the slice
+        for (pol, rtol, atol) in [('Ez', 1e-6, 1e-4), ('Hz', 2e-3, 3e-3)]:
+            (vals, _, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 2)
+            neffs = np.sqrt(vals[:2])/(self.omega/299792458*1e-6)
+
+            # closest to neff first, so a neff near the second mode selects it as order=1
+            for (neff, expected) in [(np.sqrt(12), vals[0]), (neffs[1] + 0.01, vals[1])]:
+                (vals_tri, vecs_tri, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 1, neff=neff)
+                (vals_arpack, vecs_arpack, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 1,
+                                                                        solver='arpack', neff=neff)
+                assert_allclose(vals_tri[0], expected)
+                assert_allclose(vals_tri[0], vals_arpack[0], rtol=rtol)
+                assert_allclose(np.abs(vecs_tri[:, 0]), np.abs(vecs_arpack[:, 0]), atol=atol)
+
+            # both guided modes, in the order arpack gives them
+            (vals_tri, _, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 2, neff=np.sqrt(12))
+            (vals_arpack, _, _) = mode_module.solve_modes(eps_slice, self.omega, self.dl, pol, 1e-6, 2,
+                                                          solver='arpack', neff=np.sqrt(12))
+            assert_allclose(vals_tri[:2], vals_arpack[:2], rtol=rtol)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,14 @@
 import unittest
+import copy
 
 import numpy as np
 import matplotlib.pylab as plt
 from numpy.testing import assert_allclose
 
 from angler import Simulation
+from angler.constants import EPSILON_0
+from angler import nonlinear_solvers
+from angler.adjoint import adjoint_kerr_Ez
 
 
 class Test_NLSolve(unittest.TestCase):
@@ -57,5 +61,161 @@ class Test_NLSolve(unittest.TestCase):
 
             assert_allclose(E_newton, E_born, rtol=1e-3)
 
+    def _kerr_cavity(self, scale):
+        # a kerr cavity between two air gaps in a waveguide
+
+        n0 = 3.4
+        omega = 2*np.pi*200e12
+        dl = 0.02
+        chi3 = 2.8e-14
+
+        (Nx, Ny) = (110, 50)
+        width = 15
+        yc = int(Ny/2)
+
+        eps_r = np.ones((Nx, Ny))
+        eps_r[:, yc-int(width/2):yc+int(width/2)+1] = np.square(n0)
+        eps_r[35:38, :] = 1
+        eps_r[68:71, :] = 1
+        nl_region = np.zeros((Nx, Ny))
+        nl_region[38:68, yc-int(width/2):yc+int(width/2)+1] = 1
+
+        simulation = Simulation(omega, eps_r, dl, [10, 10], 'Ez')
+        simulation.add_mode(n0, 'x', [15, yc], 2*width, scale=scale)
+        simulation.setup_modes()
+        simulation.add_nl(chi3, nl_region, eps_scale=True, eps_max=np.max(eps_r))
+        return simulation
+
+    def test_anderson(self):
+        """Tests whether the anderson accelerated born iteration converges to the newton result, faster than born"""
+
+        simulation = self._kerr_cavity(15)
+
+        conv = {}
+        fields = {}
+        for solver_nl in ['born', 'anderson', 'newton']:
+            (_, _, fields[solver_nl], conv[solver_nl]) = simulation.solve_fields_nl(solver_nl=solver_nl, max_num_iter=100)
+
+        E_newton = fields['newton']
+        assert_allclose(fields['anderson'], E_newton, rtol=1e-6, atol=1e-8*np.max(np.abs(E_newton)))
+        self.assertLess(np.sum(conv['anderson'] > 0), np.sum(conv['born'] > 0))
+
+    def test_newton_krylov(self):
+        """Tests whether newton-krylov gets the newton result, in as many iterations"""
+
+        simulation = self._kerr_cavity(10)
+
+        (_, _, E_newton, conv_newton) = simulation.solve_fields_nl(solver_nl='newton')
+        (Hx, Hy, E_krylov, conv_krylov) = simulation.solve_fields_nl(solver_nl='krylov')
+
+        assert_allclose(E_krylov, E_newton, rtol=1e-6, atol=1e-8*np.max(np.abs(E_newton)))
+        assert_allclose(Hy, simulation.fields_nl['Hy'])
+        self.assertLessEqual(np.sum(conv_krylov > 0), np.sum(conv_newton > 0))
+        self.assertLess(conv_krylov[np.sum(conv_krylov > 0) - 1], 1e-10)
+
+    def test_chord(self):
+        """Tests whether the chord method gets the newton result with fewer factorizations"""
+
+        simulation = self._kerr_cavity(10)
+
+        (_, _, E_newton, conv_newton) = simulation.solve_fields_nl(solver_nl='newton')
+        (_, _, E_chord, conv_chord) = simulation.solve_fields_nl(solver_nl='chord')
+
+        assert_allclose(E_chord, E_newton, rtol=1e-6, atol=1e-8*np.max(np.abs(E_newton)))
+        stats = simulation.nl_stats
+        self.assertEqual(stats['solves'], np.sum(conv_chord > 0))
+        self.assertLess(stats['factorizations'], np.sum(conv_newton > 0))
+
+    def test_hybrid(self):
+        """Tests whether the hybrid solver switches to damped newton and converges where newton does not"""
+
+        simulation = self._kerr_cavity(20)
+
+        (_, _, _, conv_newton) = simulation.solve_fields_nl(solver_nl='newton', max_num_iter=20)
+        self.assertGreater(conv_newton[-1], 1e-10)
+
+        (_, _, E_hybrid, conv_hybrid) = simulation.solve_fields_nl(solver_nl='hybrid')
+        num_iter = np.sum(conv_hybrid > 0)
+        self.assertLess(conv_hybrid[num_iter - 1], 1e-10)
+
+        stats = simulation.nl_stats
+        self.assertLess(stats['born_steps'], 20)
+        self.assertEqual(stats['born_steps'] + stats['newton_steps'], num_iter)
+        self.assertIn('switching to newton', stats['log'][0])
+
+        # the born iteration from the result stays there
+        (_, _, E_born, _) = simulation.solve_fields_nl(solver_nl='born', Estart=E_hybrid, max_num_iter=1)
+        assert_allclose(E_born, E_hybrid, rtol=1e-6, atol=1e-8*np.max(np.abs(E_hybrid)))
+
+    def test_compute_nl(self):
+        """Tests whether the fused, in place compute_nl agrees with the nonlinearity functions"""
+
+        simulation = self._kerr_cavity(1)
+        simulation.add_nl(1e-14, np.eye(*simulation.eps_r.shape))
+        E = np.random.random(simulation.eps_r.shape) + 1j*np.random.random(simulation.eps_r.shape)
+
+        simulation.compute_nl(E)
+        (eps_nl, Anl) = (simulation.eps_nl, simulation.Anl)
+        for name in ['eps_nl', 'dnl_de', 'dnl_deps']:
+            expected = sum(getattr(nli, name)(E, simulation.eps_r) for nli in simulation.nonlinearity)
+            assert_allclose(getattr(simulation, name), expected, rtol=1e-12)
+        assert_allclose(Anl.diagonal(), simulation.omega**2*EPSILON_0*simulation.L0*simulation.eps_nl.reshape((-1,)))
+
+        # the buffers are reused, and cleared where a removed nonlinearity was
+        simulation.nonlinearity = simulation.nonlinearity[1:]
+        simulation.compute_nl(E)
+        self.assertIs(simulation.eps_nl, eps_nl)
+        self.assertIs(simulation.Anl, Anl)
+        assert_allclose(simulation.eps_nl, simulation.nonlinearity[0].eps_nl(E, simulation.eps_r), rtol=1e-12)
+        assert_allclose(Anl.diagonal(), simulation.omega**2*EPSILON_0*simulation.L0*simulation.eps_nl.reshape((-1,)))
+
+        # a complex permittivity (e.g. through a complex filter) gives a complex eps_nl
+        simulation.eps_r = simulation.eps_r.astype(np.complex128)
+        simulation.compute_nl(E)
+        assert_allclose(simulation.eps_nl, simulation.nonlinearity[0].eps_nl(E, simulation.eps_r), rtol=1e-12)
+
+    def test_schur(self):
+        """Tests whether the solve on the nonlinear cells gets the newton result, and reuses the green's function"""
+
+        simulation = self._kerr_cavity(10)
+        nonlinear_solvers._green_cache.clear()
+
+        (_, _, E_newton, conv_newton) = simulation.solve_fields_nl(solver_nl='newton')
+        (_, Hy, E_schur, conv_schur) = simulation.solve_fields_nl(solver_nl='schur')
+
+        assert_allclose(E_schur, E_newton, rtol=1e-6, atol=1e-8*np.max(np.abs(E_newton)))
+        assert_allclose(Hy, simulation.fields_nl['Hy'])
+        self.assertLessEqual(np.sum(conv_schur > 0), np.sum(conv_newton > 0))
+
+        # a copy at another amplitude has the same A
+        sim_new = copy.deepcopy(simulation)
+        sim_new.src = 1.5*simulation.src
+        sim_new.solve_fields_nl(solver_nl='schur')
+        self.assertEqual(len(nonlinear_solvers._green_cache), 1)
+
+    def test_adjoint_jacobian(self):
+        """Tests whether the kerr adjoint from the jacobian kept by newton agrees with the one from the full system"""
+
+        simulation = self._kerr_cavity(10)
+        simulation.solve_fields_nl(solver_nl='newton')
+        self.assertIsNotNone(simulation.jacobian_nl)
+
+        b_aj = np.random.random(simulation.eps_r.shape) + 1j*np.random.random(simulation.eps_r.shape)
+        Ez_aj = adjoint_kerr_Ez(simulation, b_aj)
+        Ez_aj_full = adjoint_kerr_Ez(simulation, b_aj, solver=simulation.solver)
+        assert_allclose(Ez_aj, Ez_aj_full, rtol=1e-6, atol=1e-8*np.max(np.abs(Ez_aj_full)))
+
+        # a solve without a jacobian drops the old one
+        simulation.solve_fields_nl(solver_nl='born')
+        self.assertIsNone(simulation.jacobian_nl)
+
+        # so does a newton solve that did not converge, and the adjoint is the one at the returned field
+        for solver_nl in ['newton', 'hybrid']:
+            simulation.solve_fields_nl(solver_nl=solver_nl, max_num_iter=1)
+            self.assertIsNone(simulation.jacobian_nl)
+            Ez_aj = adjoint_kerr_Ez(simulation, b_aj)
+            Ez_aj_full = adjoint_kerr_Ez(simulation, b_aj, solver=simulation.solver)
+            assert_allclose(Ez_aj, Ez_aj_full)
+
 if __name__ == '__main__':
     unittest.main()
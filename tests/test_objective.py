@@ -59,6 +59,23 @@ class TestGradient(unittest.TestCase):
         for dj in self.objective_nl.dJ_list:
             self.assertIsNot(dj, None)
 
+    def test_value_and_partials(self):
+        # tests the single-trace partials against the ones of each argument, and their cache
+
+        F3 = self.F3 + 1j*np.random.random(self.F3.shape)
+        args = (self.F1, self.F2, F3)
+        (J_value, partials) = self.objective_lin.value_and_partials(*args)
+        self.assertAlmostEqual(J_value, self.objective_lin.J(*args))
+        for dJ, partial in zip(self.objective_lin.dJ_list, partials):
+            np.testing.assert_allclose(partial, dJ(*args))
+
+        self.assertIs(self.objective_lin.value_and_partials(*args)[1], partials)
+        self.assertEqual(self.objective_lin.value(*args), J_value)
+
+        # new arguments are traced again
+        F3[0, 0] += 1
+        self.assertIsNot(self.objective_lin.value_and_partials(*args)[1], partials)
+
     def test_gradient_load(self):
         # test to see of the the gradients are loaded in correctly
 
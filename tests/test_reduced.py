@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+import copy
+
+from angler import Simulation
+import angler.linalg as linalg
+from angler.reduced import ReducedModel
+
+
+class TestReducedModel(unittest.TestCase):
+    """ Tests the reduced order model for frequency sweeps """
+
+    def setUp(self):
+
+        self.omega = 2*np.pi*200e12
+        self.eps_r = np.ones((80, 60))
+        self.eps_r[25:55, 15:45] = 12
+        self.band = (0.95*self.omega, 1.05*self.omega)
+
+    def test_fields(self):
+
+        for pol in ['Ez', 'Hz']:
+            S = Simulation(self.omega, self.eps_r, 0.02, [10, 10], pol)
+            S.src[15, 30] = 1
+            model = ReducedModel(S, *self.band, tol=1e-6)
+            self.assertLess(model.error, 1e-6)
+            self.assertEqual(S.omega, self.omega)
+
+            for omega in np.linspace(*self.band, 4):
+                fields = model.fields(omega)
+                sim_new = copy.deepcopy(S)
+                sim_new.omega = omega
+                for comp, f in zip(fields.keys(), sim_new.solve_fields()):
+                    self.assertLess(np.linalg.norm(fields[comp] - f)/np.linalg.norm(f), 1e-4)
+
+    def test_check_omegas(self):
+
+        S = Simulation(self.omega, self.eps_r, 0.02, [10, 10], 'Ez')
+        S.src[15, 30] = 1
+        omegas = np.linspace(*self.band, 7)[1:-1]
+        model = ReducedModel(S, *self.band, tol=1e-6, omegas=omegas)
+        for omega in omegas:
+            self.assertLess(model.residual(omega), 1e-6)
+
+        # evaluating more frequencies than the operator cache holds doesnt rebuild the operators
+        linalg._operator_cache.clear()
+        for omega in np.linspace(*self.band, 2*linalg.OPERATOR_CACHE_SIZE):
+            model.fields(omega)
+            model.residual(omega)
+        self.assertEqual(len(linalg._operator_cache), 0)
+
+        with self.assertRaises(ValueError):
+            ReducedModel(S, *self.band, omegas=[1.1*self.omega])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,10 @@
 import unittest
 import numpy as np
 import matplotlib.pylab as plt
+from numpy.testing import assert_allclose
 
 from angler import Simulation
+from angler.linalg import construct_A
 
 class Test_Simulation(unittest.TestCase):
     """ Tests the simulation object for various functionalities """
@@ -35,6 +37,112 @@ class Test_Simulation(unittest.TestCase):
         (Hx, Hy, Ez) = S.solve_fields()
 
 
+    def test_shared_factorization(self):
+
+        S = Simulation(self.omega, self.eps_r, self.dl, self.NPML, self.pol)
+        S.src[50, 25] = 1
+
+        (_, _, Ez) = S.solve_fields()
+        factors = S.factors
+        self.assertTrue(factors.is_factored)
+
+        # the adjoint solve is served by the same factors, transposed
+        b = np.random.random(S.eps_r.shape)
+        x_T = S.factors.solve(b, transpose=True)
+        self.assertIs(S.factors, factors)
+        assert_allclose(S.A.T.dot(x_T), b.reshape((-1,)), atol=1e-8)
+
+        # changing the permittivity or frequency invalidates the factors
+        S.eps_r = 2*np.ones(self.eps_r.shape)
+        self.assertIsNot(S.factors, factors)
+        factors = S.factors
+        S.omega = 1.1*self.omega
+        self.assertIsNot(S.factors, factors)
+
+    def test_eps_update(self):
+
+        for pol in ['Ez', 'Hz']:
+            S = Simulation(self.omega, self.eps_r, self.dl, self.NPML, pol)
+            A = S.A
+            system = S._system
+
+            # a new eps_r is written into the same matrix, reusing the operators
+            eps_new = 1 + 3*np.random.random(self.eps_r.shape)
+            S.eps_r = eps_new
+            self.assertIs(S.A, A)
+            self.assertIs(S._system, system)
+            (A_new, _) = construct_A(S.omega, S.xrange, S.yrange, eps_new, S.NPML, pol, S.L0)
+            self.assertLess(abs(S.A - A_new).max()/abs(A_new).max(), 1e-12)
+
+            # a new frequency only recomputes the PML and the omega dependent values
+            S.omega = 1.1*self.omega
+            self.assertIs(S.A, A)
+            self.assertIs(S._system, system)
+            (A_new, _) = construct_A(S.omega, S.xrange, S.yrange, eps_new, S.NPML, pol, S.L0)
+            self.assertLess(abs(S.A - A_new).max()/abs(A_new).max(), 1e-12)
+
+    def test_solve_fields_lowrank(self):
+
+        for pol in ['Ez', 'Hz']:
+            S = Simulation(self.omega, self.eps_r, self.dl, self.NPML, pol)
+            S.src[50, 25] = 1
+            S.solve_fields()
+            factors = S.factors
+
+            eps_new = np.copy(self.eps_r)
+            eps_new[40:42, 20] = 2
+            fields = S.solve_fields_lowrank(eps_new)
+
+            # the simulation and its factors are unchanged
+            self.assertIs(S.factors, factors)
+            assert_allclose(S.eps_r, self.eps_r)
+
+            S_new = Simulation(self.omega, eps_new, self.dl, self.NPML, pol)
+            S_new.src = S.src
+            F = S_new.solve_fields()
+            for comp, f in zip(fields.keys(), F):
+                self.assertLess(np.linalg.norm(fields[comp] - f)/np.linalg.norm(f), 1e-8)
+
+    def test_solve_fields_batch(self):
+
+        for pol in ['Ez', 'Hz']:
+            S = Simulation(self.omega, self.eps_r, self.dl, self.NPML, pol)
+
+            src_list = []
+            for i in range(3):
+                src = np.zeros(S.eps_r.shape, dtype=np.complex128)
+                src[30 + 20*i, 25] = 1
+                src_list.append(src)
+
+            fields_list = S.solve_fields_batch(src_list)
+
+            # each source should match a separate call to solve_fields()
+            for src, fields in zip(src_list, fields_list):
+                S.src = src
+                F = S.solve_fields()
+                for comp, f in zip(fields.keys(), F):
+                    assert_allclose(fields[comp], f)
+
+    def test_iterative_solver(self):
+
+        S = Simulation(self.omega, self.eps_r, self.dl, self.NPML, self.pol)
+        S.src[50, 25] = 1
+        (_, _, Ez) = S.solve_fields()
+
+        for method in ['gmres', 'bicgstab', 'qmr']:
+            for preconditioner in ['ilu', 'shifted_laplacian']:
+                options = {'method': method, 'preconditioner': preconditioner, 'tol': 1e-10}
+                S_it = Simulation(self.omega, self.eps_r, self.dl, self.NPML, self.pol,
+                                  solver='iterative', solver_options=options)
+                S_it.src = S.src
+                (_, _, Ez_it) = S_it.solve_fields()
+                self.assertLess(np.linalg.norm(Ez_it - Ez)/np.linalg.norm(Ez), 1e-6)
+
+                # the adjoint is solved with the same preconditioner
+                b = np.random.random(S.eps_r.shape).reshape((-1,))
+                x_T = S_it.factors.solve(b, transpose=True)
+                self.assertLess(np.linalg.norm(S.A.T.dot(x_T) - b)/np.linalg.norm(b), 1e-6)
+
     """ These functions ensuring that an error is thrown
     when passing certain arguments to Simulation """
 
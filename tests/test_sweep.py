@@ -0,0 +1,66 @@
+import unittest
+import numpy as np
+import copy
+
+from angler import Simulation
+from angler import sweep
+from angler.sweep import sweep_frequency, scan_frequency
+
+
+class TestSweep(unittest.TestCase):
+    """ Tests the parallel frequency sweeps """
+
+    def setUp(self):
+
+        self.omega = 2*np.pi*200e12
+        eps_r = np.ones((60, 40))
+        eps_r[20:40, 15:25] = 4
+        self.simulation = Simulation(self.omega, eps_r, 0.02, [10, 10], 'Ez')
+        self.simulation.src[10, 20] = 1
+        self.freqs = self.omega/2/np.pi*np.linspace(0.95, 1.05, 5)
+
+        # some function of the fields at each frequency
+        self.fn = lambda simulation: np.sum(np.abs(simulation.solve_fields()[2])**2)
+
+    def test_scan_frequency(self):
+
+        expected = []
+        for f in self.freqs:
+            sim_new = copy.deepcopy(self.simulation)
+            sim_new.omega = 2*np.pi*f
+            expected.append(self.fn(sim_new))
+
+        for processes in [1, 2]:
+            results = scan_frequency(self.simulation, self.freqs, self.fn, processes=processes)
+            np.testing.assert_allclose(results, expected, rtol=1e-10)
+
+        # the original simulation is untouched
+        self.assertEqual(self.simulation.omega, self.omega)
+
+    def test_sweep_frequency(self):
+
+        results = list(sweep_frequency(self.simulation, self.freqs, self.fn, processes=2))
+        self.assertEqual(sorted(index for (index, _, _) in results), list(range(len(self.freqs))))
+        for (index, freq, _) in results:
+            self.assertEqual(freq, self.freqs[index])
+
+    def test_nested(self):
+        """ serial sweeps keep their own state, and workers are sent no system matrix or factors """
+
+        stripped = sweep._stripped_copy(self.simulation)
+        for attr in sweep._HEAVY_ATTRIBUTES:
+            self.assertIsNone(getattr(stripped, attr, None))
+
+        expected = scan_frequency(self.simulation, self.freqs[:2], self.fn)
+
+        def fn_nested(simulation):
+            inner = scan_frequency(self.simulation, self.freqs[:2], self.fn)
+            return (self.fn(simulation), inner)
+
+        for (index, (result, inner)) in enumerate(scan_frequency(self.simulation, self.freqs[:2], fn_nested)):
+            self.assertEqual(result, expected[index])
+            self.assertEqual(inner, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()